@@ -0,0 +1,429 @@
+"""Benchmark suite for the carbus receive/transmit paths.
+
+File: run_benchmarks.py
+
+Description:
+	Runs a fixed set of benchmarks against a vcan interface (see
+	utils/bringup_vcan.sh) plus a few that need no interface at all, writes
+	the results with machine metadata to JSON and compares them to a stored
+	baseline. A benchmark that is worse than the baseline by more than the
+	tolerance makes the run exit with status 1.
+
+Usage:
+	python -m carbus.benchmarks.run_benchmarks -i vcan0 -o results.json
+	python -m carbus.benchmarks.run_benchmarks --baseline baseline.json
+	python -m carbus.benchmarks.run_benchmarks --save-baseline baseline.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess as sp
+import sys
+import time
+
+from ..can.SocketCAN import (
+	CAN_ERR_FLAG,
+	CANErrorClass,
+	CanFrame,
+	SocketCAN,
+)
+from ..obd2.DoCANProtocol import DoCANProtocol, N_TAtype
+from ..tools.Latency import LatencyHistogram
+
+DEFAULT_TOLERANCE = 0.10
+
+class BenchResult(object):
+	def __init__(self, name, value, unit, higher_is_better=True, extra=None):
+		self.name = name
+		self.value = value
+		self.unit = unit
+		self.higher_is_better = higher_is_better
+		self.extra = extra or {}
+
+	def as_dict(self):
+		ret = {"value": self.value, "unit": self.unit, "higher_is_better": self.higher_is_better}
+		ret.update(self.extra)
+		return ret
+
+def machine_metadata():
+	"""Describe the machine and tree the results were taken on."""
+	commit = None
+	try:
+		commit = sp.check_output(
+			["git", "rev-parse", "HEAD"], cwd=os.path.dirname(__file__), stderr=sp.DEVNULL
+		).decode().strip()
+	except Exception:
+		pass
+	cpu = platform.processor()
+	try:
+		with open("/proc/cpuinfo") as f:
+			for line in f:
+				if line.startswith("model name"):
+					cpu = line.split(":", 1)[1].strip()
+					break
+	except OSError:
+		pass
+	return {
+		"time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+		"hostname": socket.gethostname(),
+		"python": platform.python_version(),
+		"implementation": platform.python_implementation(),
+		"kernel": platform.release(),
+		"machine": platform.machine(),
+		"cpu": cpu,
+		"cpu_count": os.cpu_count(),
+		"commit": commit,
+	}
+
+########################
+# Helpers
+########################
+def _open_socket(ifname, receive_own=False):
+	skt = SocketCAN()
+	skt.bind(ifname)
+	if receive_own:
+		skt.set_receive_own(True)
+	return skt
+
+def _drain(skt):
+	skt.setblocking(False)
+	while skt.read_batch(256):
+		pass
+
+def _write_burst(skt, count, addr=0x123):
+	"""Write `count` frames, backing off while the TX queue is full."""
+	payload = bytes(range(8))
+	sent = 0
+	while sent < count:
+		try:
+			skt.write(payload, addr)
+			sent += 1
+		except OSError:
+			time.sleep(0.0005)
+
+class _Counter(object):
+	def __init__(self, target):
+		self.target = target
+		self.count = 0
+		self.done = asyncio.get_event_loop().create_future()
+
+	def hit(self, n=1):
+		self.count += n
+		if self.count >= self.target and not self.done.done():
+			self.done.set_result(time.perf_counter())
+
+########################
+# Benchmarks
+########################
+def bench_socketcan_write(ifname, count):
+	tx = _open_socket(ifname)
+	start = time.perf_counter()
+	_write_burst(tx, count)
+	elapsed = time.perf_counter() - start
+	tx.close()
+	return BenchResult("socketcan_write", count / elapsed, "frames/s")
+
+def bench_socketcan_read(ifname, count):
+	rx = _open_socket(ifname)
+	rx.setblocking(False)
+	tx = _open_socket(ifname)
+	results = []
+	for name, reader in (("socketcan_read", lambda: [rx.read()]), ("socketcan_read_batch", lambda: rx.read_batch(64))):
+		_drain(rx)
+		chunk = 256
+		received = 0
+		elapsed = 0.0
+		while received < count:
+			_write_burst(tx, chunk)
+			got = 0
+			start = time.perf_counter()
+			while got < chunk:
+				try:
+					got += len(reader())
+				except (OSError, RuntimeError):
+					break
+			elapsed += time.perf_counter() - start
+			received += got
+			if got < chunk:
+				#the socket receive buffer overflowed, the rest is gone
+				_drain(rx)
+		results.append(BenchResult(name, received / elapsed, "frames/s"))
+	rx.close()
+	tx.close()
+	return results
+
+def bench_canport_throughput(ifname, count, nprotos):
+	"""End-to-end frames/s through N CANPorts, one socket per protocol."""
+	from ..can.CANPort import CANPortCollection
+	from ..can.CANProtocol import CANProtocol
+
+	class Sink(CANProtocol):
+		def __init__(self, counter):
+			super(Sink, self).__init__()
+			self.counter = counter
+
+		async def frameReceived(self, frame):
+			self.counter.hit()
+
+	async def run():
+		counter = _Counter(count * nprotos)
+		coll = CANPortCollection(ifname)
+		for _ in range(nprotos):
+			coll.add_socket(Sink(counter))
+		coll.startListening()
+		tx = _open_socket(ifname)
+		start = time.perf_counter()
+		sent = 0
+		while sent < count:
+			n = min(64, count - sent)
+			_write_burst(tx, n)
+			sent += n
+			await asyncio.sleep(0)
+		try:
+			end = await asyncio.wait_for(counter.done, 10.0)
+		except asyncio.TimeoutError:
+			end = time.perf_counter()
+		coll.stopListening()
+		tx.close()
+		return counter.count / (end - start)
+
+	rate = asyncio.run(run())
+	return BenchResult(
+		"canport_throughput_{}".format(nprotos), rate, "deliveries/s", extra={"protocols": nprotos}
+	)
+
+def bench_collection_fanout(one, many):
+	"""Cost per extra protocol in a CANPortCollection.
+
+	Args:
+		one: canport_throughput result with one protocol.
+		many: canport_throughput result with several protocols.
+	"""
+	nprotos = many.extra["protocols"]
+	perDelivery = (1.0 / many.value - 1.0 / one.value) / (nprotos - 1)
+	return BenchResult(
+		"collection_fanout_cost", max(perDelivery, 0.0) * 1e6, "us/delivery",
+		higher_is_better=False, extra={"protocols": nprotos},
+	)
+
+def bench_handle_error(count):
+	"""Error frame decode rate, no interface needed."""
+	frames = []
+	for flag, offset, value in (
+		(CANErrorClass.LostArbitration, 0, 0x0A),
+		(CANErrorClass.ControllerError, 1, 0x14),
+		(CANErrorClass.ProtocolViolation, 2, 0x0C),
+		(CANErrorClass.TransceiverStatus, 4, 0x07),
+		(CANErrorClass.BusOff, 0, 0),
+	):
+		frame = CanFrame()
+		frame.can_id = CAN_ERR_FLAG | int(flag)
+		frame.len = 8
+		frame.data[offset] = value
+		frame.data[3] = 0x08
+		frames.append(frame)
+
+	decode = SocketCAN._handle_error
+	start = time.perf_counter()
+	for i in range(count):
+		decode(None, frames[i % len(frames)])
+	elapsed = time.perf_counter() - start
+	return BenchResult("handle_error_decode", count / elapsed, "frames/s")
+
+def bench_traffic_stats(count, nids=60, batch=64):
+	"""TrafficStats stage cost per frame, no interface needed.
+
+	The batches are fed from an event loop that runs the deferred folds
+	between them, like CANPort.doRead does. Returns the time spent inside
+	`process` (what the read path pays) and that plus the folds.
+	"""
+	from ..can.SocketCAN import CANFrame
+	from ..tools.TrafficStats import TrafficStats
+
+	ids = [0x100 + i for i in range(nids)]
+	frames = [CANFrame(bytes([i & 0xFF, 0, 0, 0, 0, 0, 0, 0]), ids[i % nids], False, i * 0.0001) for i in range(count)]
+	batches = [frames[i:i + batch] for i in range(0, count, batch)]
+
+	async def feed(stats):
+		inProcess = 0.0
+		start = time.perf_counter()
+		for frames in batches:
+			t = time.perf_counter()
+			if stats is not None:
+				stats.process(frames)
+			inProcess += time.perf_counter() - t
+			await asyncio.sleep(0)
+		if stats is not None:
+			stats.snapshot()
+		return inProcess, time.perf_counter() - start
+
+	#the same loop without the stage, its cost is not the stage's
+	_, idle = asyncio.run(feed(None))
+	queued, total = asyncio.run(feed(TrafficStats()))
+	return [
+		BenchResult("traffic_stats_process", queued / count * 1e9, "ns/frame", higher_is_better=False),
+		BenchResult("traffic_stats_total", max(total - idle, queued) / count * 1e9, "ns/frame", higher_is_better=False),
+	]
+
+def traffic_stats_overhead(stats, throughput, name="traffic_stats_overhead"):
+	"""TrafficStats cost in percent of the time a frame spends in the read
+	path, taken from canport_throughput_1 (read, stages and dispatch).
+	"""
+	perFrame = 1.0 / throughput
+	return BenchResult(
+		name, stats.value * 1e-9 / perFrame * 100.0, "%",
+		higher_is_better=False, extra={"stage_ns": stats.value},
+	)
+
+class _NullTransport(object):
+	def write(self, frame):
+		pass
+
+def bench_isotp_reassembly(messages, size):
+	"""ISO-TP receive throughput, no interface needed."""
+	from ..can.SocketCAN import CANFrame
+
+	async def run():
+		proto = DoCANProtocol(n_ai_type=N_TAtype.N_TAtypePhysicalCAN, tx_id=0x7E0, rx_id=0x7E8)
+		proto.makeConnection(_NullTransport())
+		payload = bytes(i & 0xFF for i in range(size))
+		frames = [CANFrame(bytes([0x10 | (size >> 8), size & 0xFF]) + payload[:6], 0x7E8, False)]
+		sn = 1
+		for pos in range(6, size, 7):
+			frames.append(CANFrame(bytes([0x20 | sn]) + payload[pos:pos + 7], 0x7E8, False))
+			sn = (sn + 1) & 0x0F
+
+		queue = proto._get_rx_queue()
+		start = time.perf_counter()
+		for _ in range(messages):
+			for frame in frames:
+				proto.n_pduReceived(frame)
+			queue.get_nowait()
+		elapsed = time.perf_counter() - start
+		proto._cancel_rx_timer()
+		return messages * size / elapsed
+
+	rate = asyncio.run(run())
+	return BenchResult("isotp_reassembly", rate, "bytes/s", extra={"message_size": size})
+
+def bench_round_trip(ifname, count):
+	"""Request/response latency through two DoCAN endpoints on the interface."""
+	from ..can.CANPort import CANPortCollection
+
+	async def run():
+		client = DoCANProtocol(n_ai_type=N_TAtype.N_TAtypePhysicalCAN, tx_id=0x7E0, rx_id=0x7E8)
+		server = DoCANProtocol(n_ai_type=N_TAtype.N_TAtypePhysicalCAN, tx_id=0x7E8, rx_id=0x7E0)
+		coll = CANPortCollection(ifname)
+		coll.add_socket(client)
+		coll.add_socket(server)
+		coll.startListening()
+
+		async def respond():
+			while True:
+				req = await server.recv(None)
+				await server.send(bytes([req[0] + 0x40]) + req[1:])
+
+		responder = asyncio.ensure_future(respond())
+		hist = LatencyHistogram()
+		for i in range(count):
+			start = time.perf_counter()
+			await client.send(bytes([0x22, 0xF1, i & 0xFF]))
+			await client.recv(1.0)
+			hist.record((time.perf_counter() - start) * 1e6)
+		responder.cancel()
+		coll.stopListening()
+		return hist
+
+	hist = asyncio.run(run())
+	return [
+		BenchResult("round_trip_p50", hist.percentile(50), "us", higher_is_better=False),
+		BenchResult("round_trip_p99", hist.percentile(99), "us", higher_is_better=False),
+		BenchResult("round_trip_max", hist.max, "us", higher_is_better=False),
+	]
+
+########################
+# Runner
+########################
+def run_all(ifname, count, nprotos, skip_vcan=False):
+	results = []
+	results.append(bench_handle_error(count))
+	results.append(bench_isotp_reassembly(max(1, count // 100), 4000))
+	stats = bench_traffic_stats(count)
+	results.extend(stats)
+
+	if skip_vcan or not SocketCAN.is_up(ifname):
+		print("Interface {} is not up, skipping the bus benchmarks".format(ifname), file=sys.stderr)
+		return results
+
+	results.append(bench_socketcan_write(ifname, count))
+	results.extend(bench_socketcan_read(ifname, count))
+	one = bench_canport_throughput(ifname, count, 1)
+	many = bench_canport_throughput(ifname, count, nprotos)
+	results.append(one)
+	results.append(many)
+	if nprotos > 1:
+		results.append(bench_collection_fanout(one, many))
+	results.append(traffic_stats_overhead(stats[0], one.value, "traffic_stats_read_overhead"))
+	results.append(traffic_stats_overhead(stats[1], one.value))
+	results.extend(bench_round_trip(ifname, max(1, count // 20)))
+	return results
+
+def compare(results, baseline, tolerance):
+	"""Compare result values to a baseline document.
+
+	Returns:
+		list of (name, baseline, current, change) for every regression.
+	"""
+	regressions = []
+	base = baseline.get("results", {})
+	for name, res in results.items():
+		ref = base.get(name)
+		if ref is None or not ref.get("value"):
+			continue
+		change = (res["value"] - ref["value"]) / ref["value"]
+		worse = -change if res["higher_is_better"] else change
+		if worse > tolerance:
+			regressions.append((name, ref["value"], res["value"], change))
+	return regressions
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="carbus benchmarks")
+	SocketCAN.add_interface_arg(parser, "vcan0")
+	parser.add_argument("-n", "--count", type=int, default=100000, help="frames per benchmark")
+	parser.add_argument("-p", "--protocols", type=int, default=8, help="protocols for the fan-out benchmarks")
+	parser.add_argument("-o", "--output", help="write the results to this JSON file")
+	parser.add_argument("--baseline", help="compare against this results file")
+	parser.add_argument("--save-baseline", help="store the results as the new baseline")
+	parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="allowed relative regression")
+	parser.add_argument("--skip-vcan", action="store_true", help="only run the benchmarks that need no interface")
+	args = parser.parse_args(argv)
+
+	results = run_all(args.interface, args.count, args.protocols, args.skip_vcan)
+	doc = {
+		"metadata": dict(machine_metadata(), interface=args.interface, count=args.count),
+		"results": {r.name: r.as_dict() for r in results},
+	}
+	for r in results:
+		print("{:<28} {:>14.1f} {}".format(r.name, r.value, r.unit))
+
+	for path in (args.output, args.save_baseline):
+		if path:
+			with open(path, "w") as f:
+				json.dump(doc, f, indent=2, sort_keys=True)
+
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		regressions = compare(doc["results"], baseline, args.tolerance)
+		for name, ref, cur, change in regressions:
+			print("REGRESSION {}: {:.1f} -> {:.1f} ({:+.1%})".format(name, ref, cur, change))
+		if regressions:
+			return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
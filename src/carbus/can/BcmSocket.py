@@ -0,0 +1,387 @@
+"""Contains python CAN broadcast manager implementation
+
+File: BcmSocket.py
+
+python wrapper for: https://www.kernel.org/doc/html/latest/networking/can.html#broadcast-manager-protocol-sockets-sock-dgram
+
+definitions for the broadcast manager can be grabbed from: https://github.com/linux-can/can-utils/blob/master/include/linux/can/bcm.h
+
+Description:
+	The broadcast manager (CAN_BCM) lets the kernel own cyclic transmission.
+	Once a TX_SETUP has been written the frames are sent by the kernel timers
+	without any further work from python, and the payload can be replaced in
+	place while the cycle keeps running.
+"""
+
+import socket
+from collections import deque, namedtuple
+from ctypes import (
+	Structure,
+	byref,
+	c_long,
+	c_uint32,
+	create_string_buffer,
+	sizeof,
+)
+from enum import IntEnum
+
+from .SocketCAN import (
+	CAN_EFF_FLAG,
+	CAN_EFF_MASK,
+	CAN_RTR_FLAG,
+	CAN_SFF_MASK,
+	CANBase,
+	CANFrame,
+	CanFrame,
+	FRAME_LEN,
+	SockAddrCan,
+	SocketCAN,
+	canid_t,
+	libc,
+)
+
+class BcmOpcode(IntEnum):
+	TX_SETUP = 1 #create (cyclic) transmission task
+	TX_DELETE = 2 #remove (cyclic) transmission task
+	TX_READ = 3 #read properties of (cyclic) transmission task
+	TX_SEND = 4 #send one CAN frame
+	RX_SETUP = 5 #create RX content filter subscription
+	RX_DELETE = 6 #remove RX content filter subscription
+	RX_READ = 7 #read properties of RX content filter subscription
+	TX_STATUS = 8 #reply to TX_READ request
+	TX_EXPIRED = 9 #notification on performed transmissions (count=0)
+	RX_STATUS = 10 #reply to RX_READ request
+	RX_TIMEOUT = 11 #cyclic message is absent
+	RX_CHANGED = 12 #updated CAN frame (detected content change)
+
+#bcm_msg_head flags
+SETTIMER = 0x0001
+STARTTIMER = 0x0002
+TX_COUNTEVT = 0x0004
+TX_ANNOUNCE = 0x0008
+TX_CP_CAN_ID = 0x0010
+RX_FILTER_ID = 0x0020
+RX_CHECK_DLC = 0x0040
+RX_NO_AUTOTIMER = 0x0080
+RX_ANNOUNCE_RESUME = 0x0100
+TX_RESET_MULTI_IDX = 0x0200
+RX_RTR_FRAME = 0x0400
+CAN_FD_FRAME = 0x0800
+
+BCM_MAX_NFRAMES = 256
+
+class BcmTimeVal(Structure):
+	_fields_ = [
+		("tv_sec", c_long),
+		("tv_usec", c_long),
+	]
+
+	@classmethod
+	def from_seconds(cls, seconds):
+		usec = int(round(seconds * 1000000))
+		return cls(usec // 1000000, usec % 1000000)
+
+	def seconds(self):
+		return self.tv_sec + self.tv_usec / 1000000.0
+
+class BcmMsgHead(Structure):
+	"""Based off of the bcm_msg_head struct in linux/can/bcm.h:
+
+	struct bcm_msg_head {
+		__u32 opcode;
+		__u32 flags;
+		__u32 count;
+		struct bcm_timeval ival1, ival2;
+		canid_t can_id;
+		__u32 nframes;
+		struct can_frame frames[0];
+	};
+	"""
+	_fields_ = [
+		("opcode", c_uint32),
+		("flags", c_uint32),
+		("count", c_uint32),
+		("ival1", BcmTimeVal),
+		("ival2", BcmTimeVal),
+		("can_id", canid_t),
+		("nframes", c_uint32),
+	]
+
+_msgTypes = {}
+
+def bcm_msg_type(nframes):
+	"""Get the structure type of a BCM message carrying `nframes` frames."""
+	msgType = _msgTypes.get(nframes)
+	if msgType is None:
+		msgType = type(
+			"BcmMsg{}".format(nframes),
+			(Structure,),
+			{"_fields_": [("head", BcmMsgHead), ("frames", CanFrame * nframes)]},
+		)
+		_msgTypes[nframes] = msgType
+	return msgType
+
+BcmMessage = namedtuple(
+	"BcmMessage",
+	("opcode", "flags", "count", "ival1", "ival2", "can_id", "frames"),
+)
+
+def bcm_can_id(addr, ext=False):
+	if ext:
+		return (addr & CAN_EFF_MASK) | CAN_EFF_FLAG
+	return addr & CAN_SFF_MASK
+
+class BcmSocket(CANBase):
+	"""Broadcast manager socket for kernel-timed transmission.
+
+	Every method writes one BCM message and raises an exception on error.
+	Cyclic jobs are identified by their CAN id, so each id can only have one
+	TX job per socket.
+
+	Notifications read while `tx_read`/`rx_read` wait for their status reply
+	are kept, with their timestamp, and returned by the next `read_msg`
+	calls; `backlog` tells a reader that messages are waiting even though
+	the socket is not readable.
+	"""
+
+	def __init__(self):
+		CANBase.__init__(self, socket.PF_CAN, socket.SOCK_DGRAM, socket.CAN_BCM)
+		self.ifindex = None
+		self._rxBuf = create_string_buffer(sizeof(bcm_msg_type(BCM_MAX_NFRAMES)))
+		self._backlog = deque()
+		self._stamp = None
+
+	def connect(self, ifname):
+		"""Connect this BCM socket to a CAN interface by name.
+
+		An ifname of `None` connects to all interfaces (ifindex 0), in which
+		case the interface has to be selected per message with sendto.
+		"""
+		ifindex = 0 if ifname is None else self._get_ifindex(ifname)
+		addr = SockAddrCan(socket.AF_CAN, ifindex)
+		libc.connect(self.fileno(), byref(addr), sizeof(SockAddrCan))
+		self.ifindex = ifindex
+
+	def send_msg(self, opcode, can_id, frames=(), flags=0, count=0, ival1=0.0, ival2=0.0):
+		"""Write one BCM message.
+
+		Args:
+			opcode: BcmOpcode of the message.
+			can_id: CAN id (including CAN_EFF_FLAG) that identifies the job.
+			frames: list of CanFrame structures.
+			flags: bcm_msg_head flags.
+			count: number of frames to send at `ival1` before using `ival2`.
+			ival1, ival2: intervals in seconds.
+		"""
+		nframes = len(frames)
+		if nframes > BCM_MAX_NFRAMES:
+			raise ValueError("BCM: Too Many Frames: {} > {}".format(nframes, BCM_MAX_NFRAMES))
+
+		msg = bcm_msg_type(nframes)()
+		head = msg.head
+		head.opcode = opcode
+		head.flags = flags
+		head.count = count
+		head.ival1 = BcmTimeVal.from_seconds(ival1)
+		head.ival2 = BcmTimeVal.from_seconds(ival2)
+		head.can_id = can_id
+		head.nframes = nframes
+		for i, frame in enumerate(frames):
+			msg.frames[i] = frame
+
+		numBytes = sizeof(msg)
+		ret = libc.write(self.fileno(), byref(msg), numBytes)
+		if ret != numBytes:
+			msg = "Invalid Write Count: {} != {}".format(ret, numBytes)
+			raise RuntimeError(msg)
+
+	@property
+	def backlog(self):
+		return len(self._backlog)
+
+	def read_msg(self):
+		"""Read one BCM message (TX_STATUS, TX_EXPIRED, RX_* notifications).
+
+		Returns:
+			BcmMessage with the frames converted to CANFrame objects.
+		"""
+		if self._backlog:
+			msg, self._stamp = self._backlog.popleft()
+			return msg
+		self._stamp = None
+		return self._read()
+
+	def get_timestamp(self):
+		"""Receive time of the message last returned by `read_msg`."""
+		if self._stamp is not None:
+			return self._stamp
+		return SocketCAN.get_timestamp(self)
+
+	def _read(self):
+		ret = libc.read(self.fileno(), byref(self._rxBuf), sizeof(self._rxBuf))
+		head = BcmMsgHead.from_buffer_copy(self._rxBuf)
+		frames = []
+		offset = sizeof(BcmMsgHead)
+		for _ in range(min(head.nframes, (ret - offset) // sizeof(CanFrame))):
+			frame = CanFrame.from_buffer_copy(self._rxBuf, offset)
+			offset += sizeof(CanFrame)
+			frames.append(self._to_can_frame(frame))
+		return BcmMessage(
+			BcmOpcode(head.opcode),
+			head.flags,
+			head.count,
+			head.ival1.seconds(),
+			head.ival2.seconds(),
+			head.can_id,
+			frames,
+		)
+
+	########################
+	# Cyclic Transmission
+	########################
+	def tx_setup(self, addr, payloads, interval, count=0, count_interval=0.0, ext=False,
+			start=True, announce=False, count_event=False):
+		"""Create or replace a cyclic transmission job.
+
+		Args:
+			addr: CAN id of the frames.
+			payloads: bytes, or list of bytes for a multi-frame sequence. The
+				kernel sends one entry per interval and then wraps around.
+			interval: period in seconds once the counted frames are done.
+			count: number of frames sent at `count_interval` first, 0 to
+				only use `interval`.
+			ext: use the extended address space.
+			start: start the timer right away.
+			announce: send the first frame immediately.
+			count_event: notify with TX_EXPIRED once `count` has run out.
+		"""
+		can_id = bcm_can_id(addr, ext)
+		frames = self._load_frames(addr, payloads, ext)
+
+		flags = SETTIMER
+		if start:
+			flags |= STARTTIMER
+		if announce:
+			flags |= TX_ANNOUNCE
+		if count_event:
+			flags |= TX_COUNTEVT
+		self.send_msg(BcmOpcode.TX_SETUP, can_id, frames, flags, count, count_interval, interval)
+
+	def tx_update(self, addr, payloads, ext=False, announce=False, reset_index=False):
+		"""Replace the payload of a running job without touching its timers.
+
+		Args:
+			announce: send the new content immediately instead of waiting
+				for the next cycle.
+			reset_index: restart a multi-frame sequence at its first frame.
+		"""
+		can_id = bcm_can_id(addr, ext)
+		frames = self._load_frames(addr, payloads, ext)
+
+		flags = 0
+		if announce:
+			flags |= TX_ANNOUNCE
+		if reset_index:
+			flags |= TX_RESET_MULTI_IDX
+		self.send_msg(BcmOpcode.TX_SETUP, can_id, frames, flags)
+
+	def tx_delete(self, addr, ext=False):
+		"""Stop and remove a cyclic transmission job."""
+		self.send_msg(BcmOpcode.TX_DELETE, bcm_can_id(addr, ext))
+
+	def tx_read(self, addr, ext=False):
+		"""Read back the current settings of a job.
+
+		The socket has to be blocking (or readable) as the TX_STATUS reply is
+		read directly.
+
+		Returns:
+			BcmMessage of type TX_STATUS.
+		"""
+		can_id = bcm_can_id(addr, ext)
+		self.send_msg(BcmOpcode.TX_READ, can_id)
+		return self._read_status(BcmOpcode.TX_STATUS, can_id)
+
+	def tx_send(self, addr, payload, ext=False):
+		"""Send a single frame through the BCM socket."""
+		self.send_msg(BcmOpcode.TX_SEND, bcm_can_id(addr, ext), self._load_frames(addr, payload, ext))
+
+	########################
+	# Content Filtering
+	########################
+	def rx_setup(self, addr, mask=None, timeout=0.0, throttle=0.0, ext=False, check_dlc=False,
+			filter_id=False, announce_resume=False):
+		"""Subscribe to changes of one CAN id.
+
+		Args:
+			addr: CAN id to watch.
+			mask: bytes of per-byte masks, an RX_CHANGED is only sent when the
+				masked content differs from the last frame. None compares the
+				whole payload.
+			timeout: seconds without the frame before RX_TIMEOUT is sent,
+				0 disables the check.
+			throttle: minimum seconds between two RX_CHANGED messages.
+			ext: use the extended address space.
+			check_dlc: also send RX_CHANGED when only the length changed.
+			filter_id: deliver every frame of the id, no content filtering.
+			announce_resume: treat the first frame after a timeout as changed.
+		"""
+		can_id = bcm_can_id(addr, ext)
+		flags = SETTIMER | STARTTIMER
+		frames = []
+		if filter_id:
+			flags |= RX_FILTER_ID
+		else:
+			frame = CanFrame()
+			frame.load(b"\xff" * FRAME_LEN if mask is None else mask, addr, ext=ext)
+			frames.append(frame)
+		if check_dlc:
+			flags |= RX_CHECK_DLC
+		if announce_resume:
+			flags |= RX_ANNOUNCE_RESUME
+		self.send_msg(BcmOpcode.RX_SETUP, can_id, frames, flags, 0, timeout, throttle)
+
+	def rx_delete(self, addr, ext=False):
+		"""Remove a content filter subscription."""
+		self.send_msg(BcmOpcode.RX_DELETE, bcm_can_id(addr, ext))
+
+	def rx_read(self, addr, ext=False):
+		"""Read back a subscription, see `tx_read`.
+
+		Returns:
+			BcmMessage of type RX_STATUS.
+		"""
+		can_id = bcm_can_id(addr, ext)
+		self.send_msg(BcmOpcode.RX_READ, can_id)
+		return self._read_status(BcmOpcode.RX_STATUS, can_id)
+
+	########################
+	# Internal Methods
+	########################
+	def _read_status(self, opcode, can_id):
+		"""Read until the `opcode` reply for `can_id`, keeping everything else."""
+		while True:
+			msg = self._read()
+			if msg.opcode == opcode and msg.can_id == can_id:
+				return msg
+			self._backlog.append((msg, SocketCAN.get_timestamp(self)))
+
+	def _load_frames(self, addr, payloads, ext):
+		if isinstance(payloads, (bytes, bytearray)):
+			payloads = [payloads]
+		frames = []
+		for payload in payloads:
+			frame = CanFrame()
+			frame.load(payload, addr, ext=ext)
+			frames.append(frame)
+		return frames
+
+	@staticmethod
+	def _to_can_frame(frame):
+		addr = frame.can_id
+		if addr & CAN_EFF_FLAG:
+			addr &= CAN_EFF_MASK
+		else:
+			addr &= CAN_SFF_MASK
+		rtr = (frame.can_id & CAN_RTR_FLAG) > 0
+		return CANFrame(bytes(frame.data[: frame.len]), addr, rtr)
@@ -0,0 +1,176 @@
+"""CAN controller health monitoring
+
+File: CANHealth.py
+
+Description:
+	CANHealth polls the controller state, the TX/RX error counters
+	(can_berr_counter), the CAN device statistics (IFLA_INFO_XSTATS) and the
+	link stats64 of a set of interfaces over rtnetlink. Each poll is one
+	RTM_GETLINK per interface on a socket kept open between polls.
+
+	The latest samples are exposed through `metrics()` for MetricsServer, and
+	`onChange` is called when an interface changes state or starts or stops
+	looking degraded, which flags a failing connection while the controller
+	is still error-active.
+"""
+
+import asyncio
+import logging
+import time
+from collections import namedtuple
+
+from .Netlink import CANState, RtNetlink
+
+#error counter level of the ERROR_WARNING state
+ERROR_WARNING_LEVEL = 96
+
+HealthSample = namedtuple(
+	"HealthSample",
+	"ifname timestamp up state txerr rxerr bus_error error_warning error_passive bus_off "
+	"arbitration_lost restarts rx_errors tx_errors rx_dropped tx_dropped rx_over_errors degraded",
+)
+
+class CANHealth(object):
+	"""Periodic netlink poller for controller health.
+
+	Args:
+		ifnames: interfaces to poll.
+		interval: seconds between polls.
+		onChange: optional callable(prev, sample) called when the state or
+			the degraded flag of an interface changes.
+		warn_level: error counter value treated as degraded.
+		loop: asyncio event loop.
+	"""
+
+	def __init__(self, ifnames, interval=1.0, onChange=None, warn_level=ERROR_WARNING_LEVEL, loop=None):
+		self.ifnames = list(ifnames)
+		self.interval = interval
+		self.onChange = onChange
+		self.warn_level = warn_level
+		self.loop = loop
+		self.samples = {}
+		self._nl = None
+		self._handle = None
+
+	def start(self):
+		if self._handle is not None:
+			return
+		if self.loop is None:
+			self.loop = asyncio.get_event_loop()
+		self._tick()
+
+	def stop(self):
+		if self._handle is not None:
+			self._handle.cancel()
+			self._handle = None
+		if self._nl is not None:
+			self._nl.close()
+			self._nl = None
+
+	def poll(self):
+		"""Sample every interface once.
+
+		Returns:
+			dict of ifname -> HealthSample for the interfaces that exist.
+		"""
+		if self._nl is None:
+			self._nl = RtNetlink()
+		now = time.time()
+		for ifname in self.ifnames:
+			try:
+				link = self._nl.get_link(ifname)
+			except OSError as e:
+				logging.debug("{} health poll failed: {}".format(ifname, e))
+				self.samples.pop(ifname, None)
+				continue
+			prev = self.samples.get(ifname)
+			sample = self._sample(ifname, now, link, prev)
+			self.samples[ifname] = sample
+			if prev is not None and self.onChange is not None and (
+				prev.state != sample.state or prev.up != sample.up or prev.degraded != sample.degraded
+			):
+				try:
+					self.onChange(prev, sample)
+				except Exception as exc:
+					logging.error("{} health callback failed: {}".format(ifname, exc))
+		return self.samples
+
+	def metrics(self):
+		"""Flatten the latest samples into (name, labels, value) samples."""
+		ret = []
+		for ifname, st in self.samples.items():
+			labels = {"ifname": ifname}
+			ret.append(("carbus_can_up", labels, int(st.up)))
+			ret.append(("carbus_can_degraded", labels, int(st.degraded)))
+			if st.state is not None:
+				ret.append(("carbus_can_state", labels, int(st.state)))
+			if st.txerr is not None:
+				ret.append(("carbus_can_tx_error_counter", labels, st.txerr))
+				ret.append(("carbus_can_rx_error_counter", labels, st.rxerr))
+			if st.bus_error is not None:
+				ret.append(("carbus_can_bus_errors_total", labels, st.bus_error))
+				ret.append(("carbus_can_error_warning_total", labels, st.error_warning))
+				ret.append(("carbus_can_error_passive_total", labels, st.error_passive))
+				ret.append(("carbus_can_bus_off_total", labels, st.bus_off))
+				ret.append(("carbus_can_arbitration_lost_total", labels, st.arbitration_lost))
+				ret.append(("carbus_can_restarts_total", labels, st.restarts))
+			if st.rx_errors is not None:
+				ret.append(("carbus_can_rx_errors_total", labels, st.rx_errors))
+				ret.append(("carbus_can_tx_errors_total", labels, st.tx_errors))
+				ret.append(("carbus_can_rx_dropped_total", labels, st.rx_dropped))
+				ret.append(("carbus_can_tx_dropped_total", labels, st.tx_dropped))
+				ret.append(("carbus_can_rx_overruns_total", labels, st.rx_over_errors))
+		return ret
+
+	########################
+	# Internal Methods
+	########################
+	def _tick(self):
+		try:
+			self.poll()
+		except Exception as exc:
+			logging.error("CAN health poll failed: {}".format(exc))
+		self._handle = self.loop.call_later(self.interval, self._tick)
+
+	def _sample(self, ifname, now, link, prev):
+		berr = link.berr_counter
+		dev = link.device_stats
+		stats = link.stats64
+		sample = HealthSample(
+			ifname=ifname,
+			timestamp=now,
+			up=link.up,
+			state=link.state,
+			txerr=berr.txerr if berr else None,
+			rxerr=berr.rxerr if berr else None,
+			bus_error=dev.bus_error if dev else None,
+			error_warning=dev.error_warning if dev else None,
+			error_passive=dev.error_passive if dev else None,
+			bus_off=dev.bus_off if dev else None,
+			arbitration_lost=dev.arbitration_lost if dev else None,
+			restarts=dev.restarts if dev else None,
+			rx_errors=stats.rx_errors if stats else None,
+			tx_errors=stats.tx_errors if stats else None,
+			rx_dropped=stats.rx_dropped if stats else None,
+			tx_dropped=stats.tx_dropped if stats else None,
+			rx_over_errors=stats.rx_over_errors if stats else None,
+			degraded=False,
+		)
+		return sample._replace(degraded=self._degraded(sample, prev))
+
+	def _degraded(self, st, prev):
+		if not st.up:
+			return True
+		if st.state is not None and st.state != CANState.ERROR_ACTIVE:
+			return True
+		if st.txerr is not None and max(st.txerr, st.rxerr) >= self.warn_level:
+			return True
+		if prev is None:
+			return False
+		#counters moving between polls mean errors right now
+		for field in ("bus_error", "restarts", "rx_dropped", "rx_over_errors", "tx_errors"):
+			cur = getattr(st, field)
+			old = getattr(prev, field)
+			if cur is not None and old is not None and cur > old:
+				return True
+		return False
@@ -8,14 +8,20 @@ Port object. This provides a mechanism to insert CAN message
 processing/listening into asyncio's reactor framework.
 """
 
+import errno
 import logging
+import time
 import traceback
 import asyncio
 
 from zope.interface import Interface, implementer
 from asyncio import Transport
 
-from .SocketCAN import CANError, SocketCAN, socket
+from .BcmSocket import BcmOpcode, BcmSocket
+from .ChangeFilter import ChangeFilter
+from .ErrorAggregator import ErrorAggregator
+from .RecoverySupervisor import RecoverySupervisor
+from .SocketCAN import CAN_EFF_MASK, CAN_SFF_MASK, CANAddress, CANError, CANErrorClass, SocketCAN, socket
 
 
 class ICANTransport(Interface):
@@ -54,11 +60,15 @@ class ICANTransport(Interface):
 class AlreadyConnectedError(RuntimeError):
 	pass
 
+#read errors that mean the interface went away rather than a bad frame
+LINK_ERRNOS = frozenset([errno.ENETDOWN, errno.ENODEV, errno.ENXIO, errno.EBADF])
+
 #@implementer(interfaces.IListeningPort, ICANTransport, interfaces.ISystemHandle)
 class CANPort(Transport):
 	addressFamily = socket.AF_CAN
 	socketType = socket.SOCK_RAW
 	maxFrameSize = 8
+	batchSize = 64
 
 	AlreadyConnectedError = AlreadyConnectedError
 	
@@ -82,6 +92,19 @@ class CANPort(Transport):
 		self.loop = loop
 		self.reader = None
 		self.writer = None
+		self.changeFilter = None
+		self.stages = []
+		self.latency = None
+		self.supervisor = None
+		#frames from interfaces outside this set are dropped, None accepts all
+		self.interfaces = None
+		self.errors = ErrorAggregator(ifname, proto.errorFrameReceived, loop=loop)
+
+		#socket options, re-applied whenever the socket is re-created
+		self.filters = None
+		self.errorMask = frozenset(CANErrorClass)
+		self.loopback = None
+		self.receiveOwn = None
 
 	def getHandle(self):
 		return self.socket
@@ -94,7 +117,40 @@ class CANPort(Transport):
 
 	def stopListening(self):
 		if self.socket:
-			self.loop.remove_reader(self.fileno)
+			self._stopReading()
+		self.errors.stop()
+		if self.changeFilter is not None:
+			self.changeFilter.stop()
+
+	def suspend(self, reason=None):
+		"""Close the socket after the interface failed, keeping its options.
+		@param reason exception or text describing the failure, passed on to
+		  the protocol's `connectionLost` hook.
+		"""
+		if self.socket is None:
+			return
+		self._stopReading()
+		try:
+			self.socket.close()
+		except OSError:
+			pass
+		self.socket = None
+		self.fileno = None
+		self.protocol.connectionLost(reason)
+
+	def resume(self):
+		"""Re-create the socket of a suspended port with the same filters,
+		error mask and loopback options, then call `connectionResumed`.
+		"""
+		if self.socket is not None:
+			return
+		self._bindSocket()
+		self._startReading()
+		self.protocol.connectionResumed()
+
+	def linkProbe(self):
+		"""Link probe a RecoverySupervisor uses for this port, None for netlink."""
+		return None
 
 	async def connectionLost(self, reason=None):
 		await self.protocol.doStop()
@@ -102,20 +158,84 @@ class CANPort(Transport):
 		self.socket = None
 		self.fileno = None
 	
+	def addStage(self, stage):
+		"""Add a processing stage that sees every batch of received frames.
+
+		@param stage object with a `process(frames)` method, called with the
+		  list of CANFrames of each read before they are dispatched.
+		"""
+		self.stages.append(stage)
+
+	def removeStage(self, stage):
+		self.stages.remove(stage)
+
+	def enableLatency(self, recorder):
+		"""Record receive path latency into a LatencyRecorder, None disables it."""
+		self.latency = recorder
+
 	def doRead(self):
 		try:
-			frame = self.socket.read()
-			if isinstance(frame, CANError):
-				logging.error("{}: Error frame: {}".format(self.ifname, frame))
-				logging.debug(traceback.format_exc())
-				self.protocol.errorFrameReceived(frame)
+			batch = self.socket.read_batch(self.batchSize)
+		except OSError as exc:
+			if self.supervisor is not None and exc.errno in LINK_ERRNOS:
+				self.supervisor.portFailed(self, exc)
 				return
+			logging.error("{} Read: {}".format(self.ifname, exc))
+			logging.debug(traceback.format_exc())
+			return
 		except Exception as exc:
 			logging.error("{} Read: {}".format(self.ifname, exc))
 			logging.debug(traceback.format_exc())
 			return
+
+		readTs = time.time() if self.latency is not None else None
+
+		frames = []
+		errors = None
+		for frame in batch:
+			if isinstance(frame, CANError):
+				if errors is None:
+					errors = []
+				errors.append(frame)
+			else:
+				frames.append(frame)
+
+		if self.interfaces is not None:
+			interfaces = self.interfaces
+			frames = [frame for frame in frames if frame.ifname in interfaces]
+
+		if errors is not None:
+			self.errorsReceived(errors, readTs)
+
+		for stage in self.stages:
+			try:
+				stage.process(frames)
+			except Exception as exc:
+				logging.error("{} Stage {}: {}".format(self.ifname, stage, exc))
+				logging.debug(traceback.format_exc())
+
+		for frame in frames:
+			self.dispatch(frame, readTs)
+
+	def errorsReceived(self, errors, ts=None):
+		"""Hand a batch of CANError tuples to the aggregator, which delivers
+		coalesced CANErrorSummary events to `protocol.errorFrameReceived`.
+		"""
+		if self.supervisor is not None:
+			for err in errors:
+				if CANErrorClass.BusOff in err.flags:
+					self.supervisor.busOff(self)
+					break
+		self.errors.add(errors, time.time() if ts is None else ts)
+
+	def dispatch(self, frame, readTs=None):
+		if self.changeFilter is not None and not self.changeFilter.accept(frame):
+			return
 		try:
-			asyncio.create_task(self.protocol.frameReceived(frame))
+			coro = self.protocol.frameReceived(frame)
+			if self.latency is not None:
+				coro = self.latency.track(self.ifname, self.protocol, coro, frame.ts, readTs, time.time())
+			asyncio.create_task(coro)
 		except Exception as exc:
 			logging.error("{} frameReceived: {}".format(self.ifname, exc))
 			logging.debug(traceback.format_exc())
@@ -124,17 +244,36 @@ class CANPort(Transport):
 		"""Write a CAN frame to the port
 		@param frame data to write in the form of a CANFrame object
 		"""
+		if self.socket is None:
+			raise OSError(errno.ENETDOWN, "{} is not connected".format(self.ifname))
 		self.socket.write(frame.data, frame.addr, frame.rtr)
 	
 	def getTimestamp(self):
 		return self.socket.get_timestamp()
 
 	def setFilters(self, filters):
-		self.socket.set_can_filters(filters)
+		self.filters = list(filters)
+		if self.socket is not None:
+			self.socket.set_can_filters(self.filters)
 
 	def getFilters(self):
 		return self.socket.get_can_filters()
 
+	def setErrorMask(self, flags):
+		self.errorMask = frozenset(flags)
+		if self.socket is not None:
+			self.socket.set_error_mask(self.errorMask)
+
+	def setLoopback(self, enable):
+		self.loopback = enable
+		if self.socket is not None:
+			self.socket.set_loopback(enable)
+
+	def setReceiveOwn(self, enable):
+		self.receiveOwn = enable
+		if self.socket is not None:
+			self.socket.set_receive_own(enable)
+
 	def getHost(self):
 		"""Returns the interface name and index"""
 		return (self.ifname, self.socket.ifindex)
@@ -149,11 +288,8 @@ class CANPort(Transport):
 	def _bindSocket(self):
 		skt = SocketCAN()
 		skt.setblocking(False)
-		skt.set_error_mask()
-		filters = self.protocol.getFilters()
-		if len(filters) > 0:
-			skt.set_can_filters(filters)
-		
+		self._configureSocket(skt)
+
 		try:
 			skt.bind(self.ifname)
 		except socket.error as exc:
@@ -164,63 +300,341 @@ class CANPort(Transport):
 		self.socket = skt
 		self.fileno = self.socket.fileno()
 
+	def _configureSocket(self, skt):
+		skt.set_error_mask(self.errorMask)
+		filters = self.filters if self.filters is not None else self.protocol.getFilters()
+		if len(filters) > 0:
+			skt.set_can_filters(filters)
+		if self.loopback is not None:
+			skt.set_loopback(self.loopback)
+		if self.receiveOwn is not None:
+			skt.set_receive_own(self.receiveOwn)
+
 	def _connectToProtocol(self):
+		subs = self.protocol.getChangeSubscriptions()
+		if len(subs) > 0:
+			self.changeFilter = ChangeFilter(subs, self.protocol.frameTimeout, self.loop)
+			self.changeFilter.start()
 		self.protocol.makeConnection(self)
+		self._startReading()
+
+	def _startReading(self):
 		self.loop.add_reader(self.fileno, lambda: self.doRead())
 
-class CANPortCollection(object):
-	"""Class for managing multiple CANPort sockets"""
+	def _stopReading(self):
+		self.loop.remove_reader(self.fileno)
+
+class BcmPort(CANPort):
+	"""CAN port that lets the kernel broadcast manager do the change detection.
+
+	Every ChangeSubscription of the protocol becomes a BCM RX_SETUP, so the
+	protocol is only woken for changed content and timeouts. Ids the protocol
+	lists in `getFilters` (or that are set with `setFilters`) but not in
+	`getChangeSubscriptions` are delivered unfiltered (RX_FILTER_ID). BCM
+	matches exact ids, masks of the protocol filters are ignored and
+	`setFilters` only accepts filters that match a single id.
+	"""
+	_filterJobs = frozenset()
+	_watched = frozenset()
+
+	def doRead(self):
+		try:
+			msg = self.socket.read_msg()
+		except OSError as exc:
+			if self.supervisor is not None and exc.errno in LINK_ERRNOS:
+				self.supervisor.portFailed(self, exc)
+				return
+			logging.error("{} Read: {}".format(self.ifname, exc))
+			logging.debug(traceback.format_exc())
+			return
+		except Exception as exc:
+			logging.error("{} Read: {}".format(self.ifname, exc))
+			logging.debug(traceback.format_exc())
+			return
+
+		self._handleMsg(msg)
+		self._drain()
+
+	def txRead(self, addr, ext=False):
+		"""
+		Read back a cyclic transmission job.
+
+		@return BcmMessage of type TX_STATUS
+		"""
+		msg = self.socket.tx_read(addr, ext)
+		self._drainSoon()
+		return msg
+
+	def rxRead(self, addr, ext=False):
+		"""
+		Read back a content filter subscription.
 
-	def __init__(self, ifname):
-		self._ifname = ifname
-		if not SocketCAN.is_up(self._ifname):
-			raise RuntimeError("CAN Interface {} is not Up".format(self._ifname))
+		@return BcmMessage of type RX_STATUS
+		"""
+		msg = self.socket.rx_read(addr, ext)
+		self._drainSoon()
+		return msg
+
+	def write(self, frame):
+		if self.socket is None:
+			raise OSError(errno.ENETDOWN, "{} is not connected".format(self.ifname))
+		self.socket.tx_send(frame.addr, frame.data)
+
+	def setFilters(self, filters):
+		"""Replace the RX_FILTER_ID jobs of the protocol filters.
+
+		@param filters list of CANFilters each matching one exact id
+		@raise ValueError for inverted filters or masks that leave id bits
+		  out, BCM can not express them
+		"""
+		filters = list(filters)
+		for filt in filters:
+			ext = self._isExtended(filt)
+			full = CAN_EFF_MASK if ext else CAN_SFF_MASK
+			if filt.invert or filt.mask & full != full:
+				raise ValueError("BCM filters match exact ids, can not apply {}".format(filt))
+		self.filters = filters
+		if self.socket is not None:
+			self._applyFilters(self.socket)
+
+	def getFilters(self):
+		return list(self.filters) if self.filters is not None else self.protocol.getFilters()
+
+	def _handleMsg(self, msg):
+		if msg.opcode == BcmOpcode.RX_TIMEOUT:
+			self.protocol.frameTimeout(msg.can_id & CAN_EFF_MASK)
+			return
+		if msg.opcode != BcmOpcode.RX_CHANGED:
+			return
+
+		ts = self.socket.get_timestamp()
+		for frame in msg.frames:
+			frame.ts = ts
+			try:
+				asyncio.create_task(self.protocol.frameReceived(frame))
+			except Exception as exc:
+				logging.error("{} frameReceived: {}".format(self.ifname, exc))
+				logging.debug(traceback.format_exc())
+
+	def _drain(self):
+		"""Handle the notifications kept while txRead/rxRead waited for their reply."""
+		while self.socket is not None and self.socket.backlog:
+			self._handleMsg(self.socket.read_msg())
+
+	def _drainSoon(self):
+		if self.socket.backlog:
+			#the socket may not become readable again for what was kept
+			self.loop.call_soon(self._drain)
+
+	def _bindSocket(self):
+		skt = BcmSocket()
+		skt.setblocking(False)
+		try:
+			skt.connect(self.ifname)
+		except socket.error as exc:
+			raise ConnectionRefusedError(self.ifname, 0, exc)
+
+		subs = self.protocol.getChangeSubscriptions()
+		watched = set()
+		for sub in subs:
+			skt.rx_setup(
+				sub.can_id,
+				mask=sub.mask,
+				timeout=sub.timeout or 0.0,
+				ext=sub.ext,
+				check_dlc=sub.check_dlc,
+				announce_resume=sub.announce_resume,
+			)
+			watched.add(sub.can_id)
+		self._watched = watched
+		#a new socket has no jobs yet
+		self._filterJobs = frozenset()
+		self._applyFilters(skt)
+
+		logging.info(f"CANProtocol starting on {self.ifname} (BCM)")
+
+		self.socket = skt
+		self.fileno = self.socket.fileno()
+
+	def _connectToProtocol(self):
+		self.protocol.makeConnection(self)
+		self._startReading()
+
+	def _applyFilters(self, skt):
+		"""Bring the RX_FILTER_ID jobs of `skt` in line with getFilters()."""
+		jobs = frozenset(
+			(filt.can_id, self._isExtended(filt)) for filt in self.getFilters()
+			if filt.can_id not in self._watched
+		)
+		for can_id, ext in self._filterJobs - jobs:
+			skt.rx_delete(can_id, ext=ext)
+		for can_id, ext in jobs - self._filterJobs:
+			skt.rx_setup(can_id, filter_id=True, ext=ext)
+		self._filterJobs = jobs
+
+	@staticmethod
+	def _isExtended(filt):
+		return filt.exclusive == CANAddress.Extended or filt.can_id > CAN_SFF_MASK
+
+class MultiCANPort(CANPort):
+	"""CANPort receiving from several interfaces through one socket.
+
+	The socket is bound to all CAN interfaces (ifindex 0), so a protocol
+	listening on several buses costs a single event loop registration.
+	Received frames carry their interface in `CANFrame.ifname`; frames are
+	written to `frame.ifname`, or to the first interface if it is None.
+	Kernel filters apply to every interface alike.
+	"""
+
+	def __init__(self, ifnames, proto, loop=None):
+		ifnames = list(ifnames)
+		super(MultiCANPort, self).__init__(",".join(ifnames), proto, loop)
+		self.ifnames = ifnames
+		self.interfaces = frozenset(ifnames)
+
+	def write(self, frame):
+		if self.socket is None:
+			raise OSError(errno.ENETDOWN, "{} is not connected".format(self.ifname))
+		ifname = frame.ifname or self.ifnames[0]
+		if ifname not in self.interfaces:
+			raise ValueError("{} is not one of {}".format(ifname, self.ifname))
+		self.socket.write(frame.data, frame.addr, frame.rtr, ifname=ifname)
+
+	def getHost(self):
+		return (self.ifname, 0)
+
+	def _bindSocket(self):
+		skt = SocketCAN()
+		skt.setblocking(False)
+		self._configureSocket(skt)
+		try:
+			skt.bind(None)
+		except socket.error as exc:
+			raise ConnectionRefusedError(self.ifname, 0, exc)
+
+		logging.info(f"CANProtocol starting on {self.ifname}")
+
+		self.socket = skt
+		self.fileno = self.socket.fileno()
+
+class CANPortCollection(object):
+	"""Class for managing CANPort sockets on one or more interfaces"""
+
+	def __init__(self, ifnames):
+		if isinstance(ifnames, str):
+			ifnames = [ifnames]
+		self._ifnames = list(ifnames)
+		if not self._ifnames:
+			raise ValueError("CANPortCollection needs at least one interface")
+		self._ifname = self._ifnames[0]
+		for ifname in self._ifnames:
+			if not SocketCAN.is_up(ifname):
+				raise RuntimeError("CAN Interface {} is not Up".format(ifname))
 		self._socks = []
 		self._started = False
+		self.supervisors = {}
 
 	@property
 	def sockets(self):
 		return self._socks
 
+	@property
+	def interfaces(self):
+		return list(self._ifnames)
+
 	def get_interface(self):
 		return self._ifname
 
-	def add_socket(self, proto):
+	def add_socket(self, proto, ifnames=None):
+		"""Connect a protocol to some or all interfaces of the collection.
+
+		@param proto CANProtocol to connect
+		@param ifnames interface name or list of names, default all of them.
+		  One interface gives a CANPort bound to it, several give a
+		  MultiCANPort sharing one socket.
+		"""
 		if proto.transport is not None:
 			raise AlreadyConnectedError(
 				"Protocol {} Already Connected".format(str(proto))
 			)
 
-		sock = CANPort(self._ifname, proto)
+		if ifnames is None:
+			ifnames = self._ifnames
+		elif isinstance(ifnames, str):
+			ifnames = [ifnames]
+		for ifname in ifnames:
+			if ifname not in self._ifnames:
+				raise ValueError("{} is not part of this collection".format(ifname))
+
+		if len(ifnames) == 1:
+			sock = CANPort(ifnames[0], proto)
+			supervisor = self.supervisors.get(ifnames[0])
+			if supervisor is not None:
+				supervisor.attach(sock)
+		else:
+			sock = MultiCANPort(ifnames, proto)
 		if self._started:
 			sock.startListening()
 		self._socks.append(sock)
+		return sock
 
 	async def remove_socket(self, proto):
 		sock = self._match_socket(proto)
 		if sock is None:
 			return
 		self._socks.remove(sock)
-		await sock.stopListening()
+		if sock.supervisor is not None:
+			sock.supervisor.detach(sock)
+		sock.stopListening()
 
 	async def cleanup_sockets(self):
 		if self._started:
 			for sock in self._socks:
-				await sock.stopListening()
+				sock.stopListening()
+		for sock in self._socks:
+			if sock.supervisor is not None:
+				sock.supervisor.detach(sock)
 		self._socks = []
 
+	def supervise(self, **kwargs):
+		"""Recover the sockets automatically after bus-off or link loss.
+
+		Each interface gets its own RecoverySupervisor for the ports bound to
+		it. MultiCANPorts are not suspended, a socket bound to all interfaces
+		keeps receiving from the others while one of them recovers.
+
+		@param kwargs passed to RecoverySupervisor.
+		@return dict of ifname -> RecoverySupervisor
+		"""
+		for ifname in self._ifnames:
+			if ifname in self.supervisors:
+				continue
+			supervisor = RecoverySupervisor(ifname, **kwargs)
+			for sock in self._socks:
+				if not isinstance(sock, MultiCANPort) and sock.ifname == ifname:
+					supervisor.attach(sock)
+			if self._started:
+				supervisor.start()
+			self.supervisors[ifname] = supervisor
+		return self.supervisors
+
 	def startListening(self):
 		for sock in self._socks:
 			sock.startListening()
+		for supervisor in self.supervisors.values():
+			supervisor.start()
 
 		self._started = True
 
 	def stopListening(self):
+		for supervisor in self.supervisors.values():
+			supervisor.stop()
 		for x in self._socks:
-			x.stopListening
+			x.stopListening()
+		self._started = False
 
 	def _match_socket(self, proto):
 		for sock in self._socks:
 			if sock.protocol == proto:
 				return sock
-		return None
\ No newline at end of file
+		return None
@@ -45,6 +45,12 @@ class CANProtocol(Protocol):
 		"""
 		return []
 
+	def getChangeSubscriptions(self):
+		"""Get a list of ChangeSubscription objects for ids that
+		should only be delivered when their content changes.
+		"""
+		return []
+
 	def startProtocol(self):
 		"""
 		Called when a transport is connected to this protocol.
@@ -69,4 +75,29 @@ class CANProtocol(Protocol):
 		"""
 		Called when an error CAN frame is received.
 		"""
-		pass
\ No newline at end of file
+		pass
+
+	def connectionLost(self, reason):
+		"""
+		Called when the transport lost its interface (bus-off, link down).
+		Writes fail until `connectionResumed` is called.
+
+		@param reason exception or text describing the failure
+		"""
+		pass
+
+	def connectionResumed(self):
+		"""
+		Called when the transport re-created its socket after a
+		`connectionLost`, with the same filters and options.
+		"""
+		pass
+
+	def frameTimeout(self, addr):
+		"""
+		Called when a cyclic frame with a ChangeSubscription timeout
+		stopped arriving.
+
+		@param addr CAN id of the missing frame
+		"""
+		pass
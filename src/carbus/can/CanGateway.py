@@ -0,0 +1,361 @@
+"""Kernel CAN gateway (can-gw) client
+
+File: CanGateway.py
+
+definitions grabbed from: https://github.com/torvalds/linux/blob/master/include/uapi/linux/can/gw.h
+
+Description:
+	Routing rules for the `can-gw` kernel module, so frames are forwarded
+	and rewritten between interfaces without passing through Python. A
+	GatewayRule names the source and destination interfaces, an optional
+	CANFilter, frame modifications (AND/OR/XOR/SET on id, dlc and data) and
+	checksum updates (XOR, CRC8) applied after the modifications. CanGateway
+	installs, lists and removes rules over rtnetlink; listed rules carry the
+	kernel's handled/dropped/deleted counters.
+
+	The module must be loaded (`modprobe can-gw`), e.g. between two vcans:
+
+		gw = CanGateway()
+		gw.add(GatewayRule("vcan0", "vcan1", CANFilter(0x123, 0x7FF),
+			mods=[FrameMod("set", can_id=0x321)]))
+"""
+
+import socket
+import struct
+
+from .Netlink import NLM_F_ACK, NLM_F_DUMP, RtNetlink, U32, nla, parse_attrs
+from .SocketCAN import (
+	CAN_EFF_FLAG,
+	CAN_INV_FILTER,
+	CAN_RTR_FLAG,
+	CANAddress,
+	CANFilter,
+)
+
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+
+#struct rtcanmsg: can_family, gwtype, flags
+RTCANMSG = struct.Struct("=BBH")
+CGW_TYPE_CAN_CAN = 1
+
+CGW_FLAGS_CAN_ECHO = 0x01
+CGW_FLAGS_CAN_SRC_TSTAMP = 0x02
+CGW_FLAGS_CAN_IIF_TX_OK = 0x04
+
+#netlink attributes
+CGW_MOD_AND = 1
+CGW_MOD_OR = 2
+CGW_MOD_XOR = 3
+CGW_MOD_SET = 4
+CGW_CS_XOR = 5
+CGW_CS_CRC8 = 6
+CGW_HANDLED = 7
+CGW_DROPPED = 8
+CGW_SRC_IF = 9
+CGW_DST_IF = 10
+CGW_FILTER = 11
+CGW_DELETED = 12
+CGW_LIM_HOPS = 13
+CGW_MOD_UID = 14
+
+MOD_ATTRS = {"and": CGW_MOD_AND, "or": CGW_MOD_OR, "xor": CGW_MOD_XOR, "set": CGW_MOD_SET}
+MOD_NAMES = dict((v, k) for k, v in MOD_ATTRS.items())
+
+#modtype bits of struct cgw_frame_mod
+CGW_MOD_ID = 0x01
+CGW_MOD_DLC = 0x02
+CGW_MOD_DATA = 0x04
+
+#CRC8 profiles
+CGW_CRC8PRF_UNSPEC = 0
+CGW_CRC8PRF_1U8 = 1
+CGW_CRC8PRF_16U8 = 2
+CGW_CRC8PRF_SFFID_XOR = 3
+
+#packed struct cgw_frame_mod: struct can_frame + modtype
+CGW_FRAME_MOD = struct.Struct("=IB3x8sB")
+#packed struct cgw_csum_xor
+CGW_CSUM_XOR = struct.Struct("=bbbB")
+#packed struct cgw_csum_crc8
+CGW_CSUM_CRC8 = struct.Struct("=bbbBB256sB20s")
+CAN_FILTER = struct.Struct("=II")
+
+class FrameMod(object):
+	"""One modification applied to forwarded frames.
+
+	Args:
+		op: "and", "or", "xor" or "set".
+		can_id: raw can_id operand (including EFF/RTR flags), None leaves
+			the id alone.
+		dlc: dlc operand, None leaves the dlc alone.
+		data: 8 byte data operand, None leaves the data alone.
+	"""
+
+	def __init__(self, op, can_id=None, dlc=None, data=None):
+		if op not in MOD_ATTRS:
+			raise ValueError("Unknown can-gw modification {}".format(op))
+		if data is not None and len(data) > 8:
+			raise ValueError("can-gw data operand too long: {}".format(len(data)))
+		self.op = op
+		self.can_id = can_id
+		self.dlc = dlc
+		self.data = None if data is None else bytes(data)
+
+	@property
+	def modtype(self):
+		return (
+			(CGW_MOD_ID if self.can_id is not None else 0)
+			| (CGW_MOD_DLC if self.dlc is not None else 0)
+			| (CGW_MOD_DATA if self.data is not None else 0)
+		)
+
+	def pack(self):
+		return CGW_FRAME_MOD.pack(self.can_id or 0, self.dlc or 0, self.data or b"", self.modtype)
+
+	@classmethod
+	def unpack(cls, op, payload):
+		canId, dlc, data, modtype = CGW_FRAME_MOD.unpack(payload[:CGW_FRAME_MOD.size])
+		return cls(
+			op,
+			can_id=canId if modtype & CGW_MOD_ID else None,
+			dlc=dlc if modtype & CGW_MOD_DLC else None,
+			data=data if modtype & CGW_MOD_DATA else None,
+		)
+
+	def __eq__(self, other):
+		return isinstance(other, FrameMod) and self.pack() == other.pack() and self.op == other.op
+
+	def __repr__(self):
+		return "FrameMod({},can_id={},dlc={},data={})".format(self.op, self.can_id, self.dlc, self.data)
+
+class XorChecksum(object):
+	"""XOR of data[from_idx..to_idx] stored in data[result_idx].
+
+	Negative indices count from the end of the frame, as in the kernel.
+	"""
+
+	def __init__(self, from_idx, to_idx, result_idx, init=0):
+		self.from_idx = from_idx
+		self.to_idx = to_idx
+		self.result_idx = result_idx
+		self.init = init
+
+	def attr(self):
+		return nla(CGW_CS_XOR, CGW_CSUM_XOR.pack(self.from_idx, self.to_idx, self.result_idx, self.init))
+
+class Crc8Checksum(object):
+	"""CRC8 of data[from_idx..to_idx] stored in data[result_idx].
+
+	Args:
+		poly: CRC8 polynomial used to build the lookup table the kernel
+			needs, ignored if `table` is given.
+		table: 256 byte lookup table.
+		profile: CGW_CRC8PRF_* value mixing a counter or the id into the CRC.
+		profile_data: up to 20 bytes of profile parameters.
+	"""
+
+	def __init__(self, from_idx, to_idx, result_idx, poly=0x1D, init=0, final_xor=0, table=None,
+			profile=CGW_CRC8PRF_UNSPEC, profile_data=b""):
+		self.from_idx = from_idx
+		self.to_idx = to_idx
+		self.result_idx = result_idx
+		self.init = init
+		self.final_xor = final_xor
+		self.table = bytes(table) if table is not None else crc8_table(poly)
+		self.profile = profile
+		self.profile_data = bytes(profile_data)
+
+	def attr(self):
+		return nla(CGW_CS_CRC8, CGW_CSUM_CRC8.pack(
+			self.from_idx, self.to_idx, self.result_idx, self.init, self.final_xor,
+			self.table, self.profile, self.profile_data,
+		))
+
+def crc8_table(poly):
+	table = bytearray(256)
+	for i in range(256):
+		crc = i
+		for _ in range(8):
+			crc = ((crc << 1) ^ poly) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+		table[i] = crc
+	return bytes(table)
+
+def _pack_filter(filt):
+	canId = filt.can_id
+	mask = filt.mask
+	if filt.invert:
+		canId |= CAN_INV_FILTER
+	if filt.exclusive != CANAddress.Both:
+		mask |= CAN_EFF_FLAG | CAN_RTR_FLAG
+		if filt.exclusive == CANAddress.Extended:
+			canId |= CAN_EFF_FLAG
+	return CAN_FILTER.pack(canId, mask)
+
+class GatewayRule(object):
+	"""A can-gw routing rule.
+
+	Args:
+		src: source interface name.
+		dst: destination interface name.
+		filter: CANFilter selecting the forwarded frames, None forwards all.
+		mods: list of FrameMod, applied in the kernel's order AND, OR, XOR, SET.
+		checksums: list of XorChecksum/Crc8Checksum.
+		echo: let frames sent by the gateway be received on the destination
+			by local sockets (CGW_FLAGS_CAN_ECHO).
+		src_tstamp: keep the source timestamp.
+		iif_tx_ok: allow forwarding back out of the source interface.
+		limit_hops: max gateway hops of a frame.
+		uid: optional user id of the rule. remove() compares it instead of
+			the modifications, flags, hop limit, interfaces and filter must
+			still match.
+	"""
+
+	def __init__(self, src, dst, filter=None, mods=(), checksums=(), echo=False, src_tstamp=False,
+			iif_tx_ok=False, limit_hops=None, uid=None):
+		self.src = src
+		self.dst = dst
+		self.filter = filter
+		self.mods = list(mods)
+		self.checksums = list(checksums)
+		self.echo = echo
+		self.src_tstamp = src_tstamp
+		self.iif_tx_ok = iif_tx_ok
+		self.limit_hops = limit_hops
+		self.uid = uid
+		#counters, filled in by CanGateway.list
+		self.handled = None
+		self.dropped = None
+		self.deleted = None
+
+	@property
+	def flags(self):
+		return (
+			(CGW_FLAGS_CAN_ECHO if self.echo else 0)
+			| (CGW_FLAGS_CAN_SRC_TSTAMP if self.src_tstamp else 0)
+			| (CGW_FLAGS_CAN_IIF_TX_OK if self.iif_tx_ok else 0)
+		)
+
+	def pack(self):
+		"""rtcanmsg + attributes describing this rule."""
+		ops = set()
+		attrs = []
+		for mod in self.mods:
+			if mod.op in ops:
+				raise ValueError("can-gw allows one {} modification per rule".format(mod.op))
+			ops.add(mod.op)
+			attrs.append(nla(MOD_ATTRS[mod.op], mod.pack()))
+		for cs in self.checksums:
+			attrs.append(cs.attr())
+		if self.uid is not None:
+			attrs.append(nla(CGW_MOD_UID, U32.pack(self.uid)))
+		attrs.append(nla(CGW_SRC_IF, U32.pack(socket.if_nametoindex(self.src))))
+		attrs.append(nla(CGW_DST_IF, U32.pack(socket.if_nametoindex(self.dst))))
+		if self.filter is not None:
+			attrs.append(nla(CGW_FILTER, _pack_filter(self.filter)))
+		if self.limit_hops is not None:
+			attrs.append(nla(CGW_LIM_HOPS, bytes([self.limit_hops])))
+		return RTCANMSG.pack(socket.AF_CAN, CGW_TYPE_CAN_CAN, self.flags) + b"".join(attrs)
+
+	@classmethod
+	def unpack(cls, body):
+		_family, gwtype, flags = RTCANMSG.unpack_from(body, 0)
+		attrs = parse_attrs(body, RTCANMSG.size)
+
+		def ifname(attr):
+			if attr not in attrs:
+				return None
+			idx = U32.unpack(attrs[attr][:4])[0]
+			try:
+				return socket.if_indextoname(idx)
+			except OSError:
+				return str(idx)
+
+		filt = None
+		if CGW_FILTER in attrs:
+			canId, mask = CAN_FILTER.unpack(attrs[CGW_FILTER][:CAN_FILTER.size])
+			filt = CANFilter(canId & ~(CAN_INV_FILTER | CAN_EFF_FLAG), mask & ~(CAN_EFF_FLAG | CAN_RTR_FLAG),
+				invert=bool(canId & CAN_INV_FILTER))
+			if mask & CAN_EFF_FLAG:
+				filt.exclusive = CANAddress.Extended if canId & CAN_EFF_FLAG else CANAddress.Standard
+		rule = cls(
+			ifname(CGW_SRC_IF),
+			ifname(CGW_DST_IF),
+			filt,
+			mods=[FrameMod.unpack(MOD_NAMES[attr], attrs[attr]) for attr in sorted(MOD_NAMES) if attr in attrs],
+			echo=bool(flags & CGW_FLAGS_CAN_ECHO),
+			src_tstamp=bool(flags & CGW_FLAGS_CAN_SRC_TSTAMP),
+			iif_tx_ok=bool(flags & CGW_FLAGS_CAN_IIF_TX_OK),
+			limit_hops=attrs[CGW_LIM_HOPS][0] if CGW_LIM_HOPS in attrs else None,
+			uid=U32.unpack(attrs[CGW_MOD_UID][:4])[0] if CGW_MOD_UID in attrs else None,
+		)
+		if CGW_CS_XOR in attrs:
+			rule.checksums.append(XorChecksum(*CGW_CSUM_XOR.unpack(attrs[CGW_CS_XOR][:CGW_CSUM_XOR.size])))
+		if CGW_CS_CRC8 in attrs:
+			fromIdx, toIdx, resultIdx, init, finalXor, table, profile, profileData = CGW_CSUM_CRC8.unpack(
+				attrs[CGW_CS_CRC8][:CGW_CSUM_CRC8.size]
+			)
+			rule.checksums.append(Crc8Checksum(fromIdx, toIdx, resultIdx, init=init, final_xor=finalXor,
+				table=table, profile=profile, profile_data=profileData))
+		for name, attr in (("handled", CGW_HANDLED), ("dropped", CGW_DROPPED), ("deleted", CGW_DELETED)):
+			if attr in attrs:
+				setattr(rule, name, U32.unpack(attrs[attr][:4])[0])
+		return rule
+
+	def __repr__(self):
+		return "GatewayRule({}->{},filter={},mods={},uid={},handled={},dropped={})".format(
+			self.src, self.dst, self.filter, self.mods, self.uid, self.handled, self.dropped
+		)
+
+class CanGateway(object):
+	"""Install, list and remove can-gw rules."""
+
+	def __init__(self):
+		self._nl = RtNetlink()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		self._nl.close()
+
+	def add(self, rule):
+		self._nl.request(RTM_NEWROUTE, NLM_F_ACK, rule.pack())
+
+	def remove(self, rule):
+		"""Remove a rule. The kernel always matches on the interfaces, filter,
+		flags and hop limit; then on the uid if either rule has one, otherwise
+		on the modifications and checksums.
+		"""
+		self._nl.request(RTM_DELROUTE, NLM_F_ACK, rule.pack())
+
+	def flush(self):
+		"""Remove every can-gw rule."""
+		self._nl.request(RTM_DELROUTE, NLM_F_ACK, RTCANMSG.pack(socket.AF_CAN, CGW_TYPE_CAN_CAN, 0))
+
+	def list(self):
+		"""Get all installed rules with their counters."""
+		replies = self._nl.request(RTM_GETROUTE, NLM_F_DUMP, RTCANMSG.pack(socket.AF_CAN, 0, 0))
+		#without can-gw loaded the dump falls through to the other route families
+		return [
+			GatewayRule.unpack(body)
+			for msgType, body in replies
+			if msgType == RTM_NEWROUTE and body[0] == socket.AF_CAN
+		]
+
+	def metrics(self):
+		ret = []
+		for rule in self.list():
+			labels = {"src": rule.src, "dst": rule.dst}
+			if rule.uid is not None:
+				labels["uid"] = rule.uid
+			elif rule.filter is not None:
+				labels["filter"] = "0x{:x}/0x{:x}".format(rule.filter.can_id, rule.filter.mask)
+			ret.append(("carbus_cangw_handled_total", labels, rule.handled or 0))
+			ret.append(("carbus_cangw_dropped_total", labels, rule.dropped or 0))
+			ret.append(("carbus_cangw_deleted_total", labels, rule.deleted or 0))
+		return ret
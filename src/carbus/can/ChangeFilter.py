@@ -0,0 +1,138 @@
+"""
+File: ChangeFilter.py
+
+Description:
+	Change-only frame subscriptions. A protocol lists the CAN ids it only
+wants to see when their (masked) payload changes, together with an optional
+timeout for cyclic frames. BcmPort hands the subscriptions to the kernel
+broadcast manager (RX_SETUP), CANPort applies the same rules in userspace for
+raw sockets with a ChangeFilter.
+"""
+
+import asyncio
+
+from .SocketCAN import CAN_EFF_MASK, CAN_SFF_MASK, FRAME_LEN
+from ..tools.TimerService import get_timer_service
+
+class ChangeSubscription(object):
+	"""Deliver frames of one CAN id only when their content changes."""
+
+	def __init__(self, can_id, mask=None, timeout=None, check_dlc=False, ext=False, announce_resume=True):
+		"""ChangeSubscription Constructor
+
+		Args:
+			can_id: CAN id to watch.
+			mask: bytes of per-byte masks, only the masked bits are compared.
+				None compares the whole payload.
+			timeout: seconds without the frame before a timeout is raised,
+				None disables the check.
+			check_dlc: also deliver the frame when only its length changed.
+			ext: can_id is a 29-bit id.
+			announce_resume: deliver the first frame after a timeout even if
+				its content did not change.
+		"""
+		self.can_id = can_id & (CAN_EFF_MASK if ext else CAN_SFF_MASK)
+		if mask is None:
+			mask = b"\xff" * FRAME_LEN
+		if len(mask) > FRAME_LEN:
+			raise ValueError("Mask too large: {} > {}".format(len(mask), FRAME_LEN))
+		self.mask = bytes(mask)
+		self.timeout = timeout
+		self.check_dlc = check_dlc
+		self.ext = ext
+		self.announce_resume = announce_resume
+
+	def __repr__(self):
+		return "ChangeSubscription(can_id=0x{:x},mask={},timeout={},check_dlc={})".format(
+			self.can_id, self.mask.hex(), self.timeout, self.check_dlc
+		)
+
+class _WatchState(object):
+	__slots__ = ("mask", "content", "dlc", "timeout", "lastSeen", "timer", "timedOut", "checkDlc", "resume")
+
+	def __init__(self, sub):
+		self.mask = int.from_bytes(sub.mask.ljust(FRAME_LEN, b"\x00"), "little")
+		self.content = None
+		self.dlc = None
+		self.timeout = sub.timeout
+		self.lastSeen = None
+		self.timer = None
+		self.timedOut = False
+		self.checkDlc = sub.check_dlc
+		self.resume = sub.announce_resume
+
+class ChangeFilter(object):
+	"""Userspace equivalent of BCM RX_SETUP content filtering.
+
+	Frames of ids without a subscription always pass. CANFrame does not
+	carry the EFF flag, so subscriptions are matched on the id value alone.
+	Timeout timers live on the shared TimerService and are not re-armed per
+	frame: a timer that fires early simply re-arms itself for the time
+	remaining since the last frame.
+	"""
+
+	def __init__(self, subscriptions, onTimeout=None, loop=None):
+		self.loop = loop
+		self.onTimeout = onTimeout
+		self.timers = None
+		self._watch = {}
+		for sub in subscriptions:
+			self._watch[sub.can_id] = _WatchState(sub)
+
+	def start(self):
+		if self.loop is None:
+			self.loop = asyncio.get_event_loop()
+		self.timers = get_timer_service(self.loop)
+		now = self.loop.time()
+		for addr, state in self._watch.items():
+			if state.timeout:
+				state.lastSeen = now
+				state.timer = self.timers.call_later(state.timeout, self._check_timeout, addr)
+
+	def stop(self):
+		for state in self._watch.values():
+			if state.timer is not None:
+				state.timer.cancel()
+				state.timer = None
+
+	def accept(self, frame):
+		"""Decide if a frame should be delivered.
+
+		Args:
+			frame: CANFrame that was received.
+
+		Returns:
+			bool
+		"""
+		state = self._watch.get(frame.addr)
+		if state is None:
+			return True
+
+		if state.timeout:
+			state.lastSeen = self.loop.time()
+			if state.timer is None:
+				state.timer = self.timers.call_later(state.timeout, self._check_timeout, frame.addr)
+
+		data = frame.data
+		content = int.from_bytes(data, "little") & state.mask
+		dlc = len(data)
+		changed = content != state.content or (state.checkDlc and dlc != state.dlc)
+		if state.timedOut:
+			state.timedOut = False
+			changed = changed or state.resume
+		state.content = content
+		state.dlc = dlc
+		return changed
+
+	def _check_timeout(self, addr):
+		state = self._watch[addr]
+		remaining = state.lastSeen + state.timeout - self.loop.time()
+		if remaining > 0:
+			self.timers.rearm(state.timer, remaining)
+			return
+		state.timer = None
+		if state.timedOut:
+			return
+		state.timedOut = True
+		if self.onTimeout is not None:
+			self.onTimeout(addr)
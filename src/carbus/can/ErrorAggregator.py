@@ -0,0 +1,207 @@
+"""Error frame aggregation
+
+File: ErrorAggregator.py
+
+Description:
+	ErrorAggregator sits between a CANPort and its protocol's
+	`errorFrameReceived`. It counts error classes per window and coalesces
+	bursts: the first error after a quiet period is delivered right away,
+	errors arriving within `coalesce` seconds after it are merged into one
+	CANErrorSummary delivered at the end of that period. Logging is reduced
+	to one summary line per `log_interval`, so an error storm costs a counter
+	update per frame instead of a formatted log record.
+"""
+
+import asyncio
+import logging
+from collections import namedtuple
+
+from .SocketCAN import CANError
+
+#CANError fields merged over the coalesced errors, plus the burst information
+CANErrorSummary = namedtuple("CANErrorSummary", CANError._fields + ("count", "counts", "first", "last"))
+
+class ErrorAggregator(object):
+	"""Counts, coalesces and rate-limits error frames of one port.
+
+	Args:
+		ifname: interface name used in logs and metrics.
+		deliver: callable receiving each CANErrorSummary, usually the
+			protocol's `errorFrameReceived`.
+		coalesce: seconds over which errors are merged into one event.
+		window: length in seconds of the counting window used for rates.
+		log_interval: minimum seconds between two summary log lines.
+		loop: asyncio event loop.
+	"""
+
+	def __init__(self, ifname, deliver, coalesce=0.1, window=1.0, log_interval=5.0, loop=None):
+		self.ifname = ifname
+		self.deliver = deliver
+		self.coalesce = coalesce
+		self.window = window
+		self.log_interval = log_interval
+		self.loop = loop
+
+		#counts are kept per distinct flag set, one dict update per frame
+		self.totals = {}
+		self.rates = {}
+		self._window = {}
+		self._windowStart = None
+		self._pending = []
+		self._pendingFirst = None
+		self._lastDelivery = None
+		self._handle = None
+		self._logged = {}
+		self._logStart = None
+		self._pendingLast = None
+
+	def add(self, errors, ts=None):
+		"""Account a batch of CANError tuples read together."""
+		if not errors:
+			return
+		if self.loop is None:
+			self.loop = asyncio.get_event_loop()
+		now = self.loop.time()
+		first = self._windowStart is None
+		if first:
+			self._windowStart = now
+			self._logStart = now
+		elif now - self._windowStart >= self.window:
+			self._rollWindow(now)
+
+		window = self._window
+		for err in errors:
+			window[err.flags] = window.get(err.flags, 0) + 1
+		if first:
+			self._logFirst()
+
+		if self._pending:
+			self._pending.extend(errors)
+			self._pendingLast = ts
+			return
+		if self._lastDelivery is None or now - self._lastDelivery >= self.coalesce:
+			#quiet bus: the first error goes out immediately
+			self._lastDelivery = now
+			self._emit(errors[:1], ts, ts)
+			self._maybeLog(now)
+			rest = errors[1:]
+		else:
+			rest = errors
+		if rest:
+			self._pending = list(rest)
+			self._pendingFirst = ts
+			self._pendingLast = ts
+			delay = max(self.coalesce - (now - self._lastDelivery), 0.0)
+			self._handle = self.loop.call_later(delay, self.flush)
+
+	def flush(self):
+		"""Deliver the pending coalesced errors now."""
+		if self._handle is not None:
+			self._handle.cancel()
+			self._handle = None
+		if not self._pending:
+			return
+		pending = self._pending
+		first = self._pendingFirst
+		last = self._pendingLast
+		self._pending = []
+		self._pendingFirst = self._pendingLast = None
+		self._lastDelivery = self.loop.time()
+		self._emit(pending, first, last)
+		self._maybeLog(self._lastDelivery)
+
+	def stop(self):
+		self.flush()
+
+	def counts(self, byClass=True):
+		"""Total error frames per CANErrorClass (or per flag set)."""
+		totals = dict(self.totals)
+		for flags, n in self._window.items():
+			totals[flags] = totals.get(flags, 0) + n
+		if not byClass:
+			return totals
+		return _split(totals)
+
+	def metrics(self):
+		ret = []
+		rates = self.rates
+		if self._windowStart is not None:
+			#no error since the window ended, the rates are stale
+			age = self.loop.time() - self._windowStart
+			if age >= 2 * self.window:
+				rates = {}
+			elif age >= self.window:
+				rates = self._window
+		rates = _split(rates)
+		for cls, n in self.counts().items():
+			labels = {"ifname": self.ifname, "class": cls.name}
+			ret.append(("carbus_can_error_frames_total", labels, n))
+			ret.append(("carbus_can_error_frame_rate", labels, rates.get(cls, 0) / self.window))
+		return ret
+
+	########################
+	# Internal Methods
+	########################
+	def _rollWindow(self, now):
+		for flags, n in self._window.items():
+			self.totals[flags] = self.totals.get(flags, 0) + n
+		#a gap longer than one window means the rate dropped to zero in between
+		self.rates = self._window if now - self._windowStart < 2 * self.window else {}
+		self._window = {}
+		self._windowStart = now
+		self._maybeLog(now)
+
+	def _logFirst(self):
+		"""Log the first batch after startup on its own, the summary lines
+		then count from here.
+		"""
+		self._logged = self.counts(byClass=False)
+		counted = _split(self._logged)
+		summary = " ".join("{}={}".format(cls.name, n) for cls, n in sorted(counted.items()) if n)
+		logging.warning("{}: first error frames: {}".format(self.ifname, summary))
+
+	def _maybeLog(self, now):
+		if self._logStart is None or now - self._logStart < self.log_interval:
+			return
+		current = self.counts(byClass=False)
+		delta = {flags: n - self._logged.get(flags, 0) for flags, n in current.items()}
+		self._logged = current
+		counted = _split(delta)
+		if any(counted.values()):
+			summary = " ".join("{}={}".format(cls.name, n) for cls, n in sorted(counted.items()) if n)
+			logging.warning("{}: {} error frames in {:.1f}s: {}".format(
+				self.ifname, sum(delta.values()), now - self._logStart, summary))
+		self._logStart = now
+
+	def _emit(self, errors, first, last):
+		flags = set()
+		ctlFlags = set()
+		protoType = set()
+		position = protoLoc = transError = None
+		counts = {}
+		for err in errors:
+			flags |= err.flags
+			ctlFlags |= err.ctl_flags
+			protoType |= err.proto_type
+			if err.position is not None:
+				position = err.position
+			if err.proto_loc is not None:
+				protoLoc = err.proto_loc
+			if err.trans_error is not None:
+				transError = err.trans_error
+			counts[err.flags] = counts.get(err.flags, 0) + 1
+		summary = CANErrorSummary(
+			frozenset(flags), position, frozenset(ctlFlags), frozenset(protoType), protoLoc, transError,
+			len(errors), _split(counts), first, last,
+		)
+		try:
+			self.deliver(summary)
+		except Exception as exc:
+			logging.error("{} errorFrameReceived: {}".format(self.ifname, exc))
+
+def _split(byFlags):
+	ret = {}
+	for flags, n in byFlags.items():
+		for cls in flags:
+			ret[cls] = ret.get(cls, 0) + n
+	return ret
@@ -0,0 +1,203 @@
+"""
+File: J1939Port.py
+
+Description:
+	asyncio integration of the kernel J1939 sockets. A J1939Port binds a
+J1939Socket for a J1939Protocol and hands it every reassembled PGN, the same
+way CANPort does for raw frames.
+"""
+
+import asyncio
+import logging
+import traceback
+from asyncio import Transport
+
+from .CANProtocol import CANProtocol
+from .J1939Socket import (
+	J1939_MAX_UNICAST_ADDR,
+	J1939_NO_ADDR,
+	J1939_NO_NAME,
+	J1939_PGN_ADDRESS_CLAIMED,
+	J1939_PGN_REQUEST,
+	J1939_TP_MAX,
+	J1939Socket,
+	pgn_filter,
+)
+from .SocketCAN import socket
+
+ADDRESS_CLAIM_DELAY = 0.25 #seconds a claim has to stand before the address may be used
+
+class J1939ClaimError(RuntimeError):
+	"""Our address claim lost against a higher priority NAME."""
+	pass
+
+class J1939Protocol(CANProtocol):
+	"""J1939 Protocol Interface"""
+
+	def getJ1939Filters(self):
+		"""Get a list of J1939Filter structures applied before we bind."""
+		return []
+
+	async def pgnReceived(self, data, pgn, addr, name):
+		"""
+		Called with every complete PGN.
+
+		@param data payload, already reassembled by the kernel
+		@param pgn parameter group number
+		@param addr source address of the sender
+		@param name NAME of the sender if it claimed one, else 0
+		"""
+		pass
+
+class J1939Port(Transport):
+	maxFrameSize = J1939_TP_MAX
+
+	def __init__(self, ifname, proto, name=J1939_NO_NAME, addr=J1939_NO_ADDR,
+			promisc=False, max_size=J1939_TP_MAX, loop=None):
+		"""Create a new J1939 port object
+		@param ifname name of the CAN interface, such as `can0`
+		@param proto object implementing the J1939Protocol interface
+		@param name 64-bit NAME to claim, J1939_NO_NAME for a static address
+		@param addr source address to claim or use, 0..253
+		@param promisc receive traffic addressed to other nodes as well
+		@param max_size largest PGN payload accepted
+		"""
+		super().__init__()
+
+		self.ifname = ifname
+		self.protocol = proto
+		self.name = name
+		self.addr = addr
+		self.promisc = promisc
+		self.max_size = max_size
+
+		self.socket = None
+		self.fileno = None
+		self.loop = loop
+		self.claimed = False
+		self.lost = False
+		self._claiming = None
+
+	def getHandle(self):
+		return self.socket
+
+	def startListening(self):
+		if self.loop is None:
+			self.loop = asyncio.get_event_loop()
+		self._bindSocket()
+		self.protocol.makeConnection(self)
+		self.loop.add_reader(self.fileno, self.doRead)
+
+	def stopListening(self):
+		if self.socket:
+			self.loop.remove_reader(self.fileno)
+
+	async def connectionLost(self, reason=None):
+		await self.protocol.doStop()
+		self.socket.close()
+		self.socket = None
+		self.fileno = None
+
+	async def claimAddress(self, addr=None):
+		"""
+		Claim an address for our NAME and wait until it can be used.
+
+		Address Claimed messages for the same address seen meanwhile are
+		compared to our NAME: a lower one wins, we send Cannot Claim Address
+		and raise J1939ClaimError. A higher one gets our claim again.
+
+		@param addr source address to claim, defaults to the port's address
+		"""
+		if addr is not None:
+			self.addr = addr
+		if self.addr > J1939_MAX_UNICAST_ADDR:
+			raise ValueError("{} claimAddress: no source address to claim (0x{:02X})".format(self.ifname, self.addr))
+		self.claimed = False
+		self.lost = False
+		self.socket.claim_address(self.addr)
+		self._claiming = self.loop.create_future()
+		try:
+			await asyncio.wait_for(self._claiming, ADDRESS_CLAIM_DELAY)
+		except asyncio.TimeoutError:
+			self.claimed = True
+		finally:
+			self._claiming = None
+
+	def doRead(self):
+		try:
+			msg = self.socket.recv()
+		except Exception as exc:
+			logging.error("{} Read: {}".format(self.ifname, exc))
+			logging.debug(traceback.format_exc())
+			return
+
+		try:
+			if msg.pgn == J1939_PGN_REQUEST and self._isClaimRequest(msg.data):
+				if self.lost:
+					self.socket.cannot_claim()
+				elif self.claimed or self._claiming is not None:
+					self.socket.claim_address(self.addr)
+			elif msg.pgn == J1939_PGN_ADDRESS_CLAIMED:
+				self._addressClaimed(msg)
+		except Exception as exc:
+			logging.error("{} Address Claim: {}".format(self.ifname, exc))
+		try:
+			asyncio.create_task(self.protocol.pgnReceived(msg.data, msg.pgn, msg.addr, msg.name))
+		except Exception as exc:
+			logging.error("{} pgnReceived: {}".format(self.ifname, exc))
+			logging.debug(traceback.format_exc())
+
+	def write(self, data, pgn, addr=J1939_NO_ADDR):
+		"""Send a PGN to `addr`, J1939_NO_ADDR broadcasts it (BAM above 8 bytes)."""
+		self.socket.send(data, pgn, addr)
+
+	def getHost(self):
+		"""Returns the interface name and index"""
+		return (self.ifname, self.socket.ifindex)
+
+	def _isClaimRequest(self, data):
+		if self.name == J1939_NO_NAME or len(data) < 3:
+			return False
+		return int.from_bytes(data[:3], "little") == J1939_PGN_ADDRESS_CLAIMED
+
+	def _addressClaimed(self, msg):
+		"""Another node claimed an address, resolve a conflict with ours."""
+		if not (self.claimed or self._claiming is not None) or msg.addr != self.addr or len(msg.data) < 8:
+			return
+		name = int.from_bytes(msg.data[:8], "little")
+		if name == self.name:
+			return
+		if name > self.name:
+			#we have priority, defend the address
+			self.socket.claim_address(self.addr)
+			return
+		self.claimed = False
+		self.lost = True
+		exc = J1939ClaimError("{} address 0x{:02X} lost to NAME 0x{:016X}".format(self.ifname, self.addr, name))
+		logging.error(str(exc))
+		if self._claiming is not None and not self._claiming.done():
+			self._claiming.set_exception(exc)
+		self.socket.cannot_claim()
+
+	def _bindSocket(self):
+		skt = J1939Socket(self.max_size)
+		skt.setblocking(False)
+		filters = self.protocol.getJ1939Filters()
+		if len(filters) > 0:
+			if self.name != J1939_NO_NAME:
+				#claims of other nodes must reach us to resolve conflicts
+				filters = filters + [pgn_filter(J1939_PGN_ADDRESS_CLAIMED)]
+			skt.set_filters(filters)
+		if self.promisc:
+			skt.set_promisc(True)
+		skt.set_broadcast(True)
+
+		try:
+			skt.bind(self.ifname, self.name, self.addr)
+		except socket.error as exc:
+			raise ConnectionRefusedError(self.ifname, 0, exc)
+
+		logging.info(f"J1939Protocol starting on {self.ifname}")
+
+		self.socket = skt
+		self.fileno = self.socket.fileno()
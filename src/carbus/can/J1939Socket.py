@@ -0,0 +1,227 @@
+"""Contains python J1939 socket implementation
+
+File: J1939Socket.py
+
+python wrapper for: https://www.kernel.org/doc/html/latest/networking/j1939.html
+
+definitions for the J1939 sockets can be grabbed from: https://github.com/linux-can/can-utils/blob/master/include/linux/can/j1939.h
+
+Description:
+	J1939 sockets are addressed by PGN and source/destination address instead
+	of raw CAN ids. The kernel does the transport protocol work (TP and ETP,
+	including BAM broadcasts) so a 1785 byte PGN arrives with a single read,
+	and it tracks address claims of the bound NAME.
+"""
+
+import socket
+from collections import namedtuple
+from ctypes import (
+	Structure,
+	byref,
+	c_int,
+	c_uint8,
+	c_uint32,
+	c_uint64,
+	create_string_buffer,
+	sizeof,
+)
+
+from .SocketCAN import CANBase, SockAddrCan, libc
+
+SOL_CAN_J1939 = socket.SOL_CAN_BASE + socket.CAN_J1939
+
+#socket options
+SO_J1939_FILTER = 1
+SO_J1939_PROMISC = 2
+SO_J1939_SEND_PRIO = 3
+SO_J1939_ERRQUEUE = 4
+
+J1939_MAX_UNICAST_ADDR = 0xFD
+J1939_IDLE_ADDR = 0xFE
+J1939_NO_ADDR = 0xFF #broadcast address when sending
+J1939_NO_NAME = 0
+J1939_NO_PGN = 0x40000
+J1939_PGN_MAX = 0x3FFFF
+J1939_PGN_PDU1_MAX = 0x3FF00
+
+J1939_PGN_REQUEST = 0x0EA00
+J1939_PGN_ADDRESS_CLAIMED = 0x0EE00
+J1939_PGN_ADDRESS_COMMANDED = 0x0FED8
+
+J1939_TP_MAX = 1785 #largest payload of the TP/BAM transport
+J1939_ETP_MAX = 117440505 #largest payload of the extended transport
+
+J1939_FILTER_MAX = 512
+MSG_TRUNC = 0x20
+
+class J1939Filter(Structure):
+	"""Based off of the j1939_filter struct in linux/can/j1939.h:
+
+	struct j1939_filter {
+		name_t name;
+		name_t name_mask;
+		pgn_t pgn;
+		pgn_t pgn_mask;
+		__u8 addr;
+		__u8 addr_mask;
+	};
+	"""
+	_fields_ = [
+		("name", c_uint64),
+		("name_mask", c_uint64),
+		("pgn", c_uint32),
+		("pgn_mask", c_uint32),
+		("addr", c_uint8),
+		("addr_mask", c_uint8),
+	]
+
+J1939Message = namedtuple("J1939Message", ("data", "pgn", "addr", "name"))
+
+class J1939Socket(CANBase):
+	"""Kernel J1939 socket.
+
+	Most methods will raise an exception on error.
+	"""
+
+	def __init__(self, max_size=J1939_TP_MAX):
+		"""J1939Socket Constructor
+
+		Args:
+			max_size: largest PGN payload that `recv` accepts. Use
+				J1939_ETP_MAX sized buffers only when ETP is expected.
+		"""
+		CANBase.__init__(self, socket.PF_CAN, socket.SOCK_DGRAM, socket.CAN_J1939)
+		self.ifindex = None
+		self.name = J1939_NO_NAME
+		self.addr = J1939_NO_ADDR
+		self.pgn = J1939_NO_PGN
+		self._rxBuf = create_string_buffer(max_size)
+
+	def bind(self, ifname, name=J1939_NO_NAME, addr=J1939_NO_ADDR, pgn=J1939_NO_PGN):
+		"""Bind to a CAN interface with our NAME and/or source address.
+
+		Args:
+			name: 64-bit J1939 NAME, the kernel handles address claiming
+				for sockets bound with a NAME.
+			addr: static source address or J1939_NO_ADDR.
+			pgn: only receive this PGN, J1939_NO_PGN receives all.
+		"""
+		self._bind(self._get_ifindex(ifname), name, addr, pgn)
+
+	def send(self, data, pgn, addr=J1939_NO_ADDR, name=J1939_NO_NAME):
+		"""Send a PGN. Payloads above 8 bytes are segmented by the kernel.
+
+		Args:
+			data: payload bytes.
+			pgn: parameter group number.
+			addr: destination address, J1939_NO_ADDR for a broadcast.
+			name: destination NAME instead of an address.
+		"""
+		sockAddr = self._sock_addr(self.ifindex, name, pgn, addr)
+		ret = libc.sendto(self.fileno(), data, len(data), 0, byref(sockAddr), sizeof(SockAddrCan))
+		if ret != len(data):
+			msg = "Invalid Write Count: {} != {}".format(ret, len(data))
+			raise RuntimeError(msg)
+
+	def recv(self):
+		"""Read one complete (reassembled) PGN.
+
+		Returns:
+			J1939Message with the source address and NAME of the sender.
+		"""
+		sockAddr = SockAddrCan()
+		addrLen = c_uint32(sizeof(sockAddr))
+		size = sizeof(self._rxBuf)
+		ret = libc.recvfrom(self.fileno(), self._rxBuf, size, MSG_TRUNC, byref(sockAddr), byref(addrLen))
+		if ret > size:
+			raise RuntimeError("J1939 message truncated: {} > {}".format(ret, size))
+		j1939 = sockAddr.can_addr.j1939
+		return J1939Message(self._rxBuf.raw[:ret], j1939.pgn, j1939.addr, j1939.name)
+
+	def claim_address(self, addr=None):
+		"""Broadcast the Address Claimed PGN for our bound NAME.
+
+		The kernel tracks the claim, it is usable 250ms after this call if no
+		other node with a higher priority NAME contests it.
+
+		Args:
+			addr: source address to claim, the socket is bound to it first.
+				Defaults to the bound address.
+		"""
+		if self.name == J1939_NO_NAME:
+			raise ValueError("Address claiming requires a NAME")
+		if addr is None:
+			addr = self.addr
+		if addr > J1939_MAX_UNICAST_ADDR:
+			raise ValueError("Address claiming requires a source address up to 0x{:02X}, not 0x{:02X}".format(
+				J1939_MAX_UNICAST_ADDR, addr))
+		if addr != self.addr:
+			self._bind(self.ifindex, self.name, addr, self.pgn)
+		self.set_broadcast(True)
+		self.send(self.name.to_bytes(8, "little"), J1939_PGN_ADDRESS_CLAIMED, J1939_NO_ADDR)
+
+	def cannot_claim(self):
+		"""Broadcast Cannot Claim Address: the Address Claimed PGN sent from
+		the null address (254) after our claim was lost.
+		"""
+		if self.name == J1939_NO_NAME:
+			raise ValueError("Address claiming requires a NAME")
+		if self.addr != J1939_IDLE_ADDR:
+			self._bind(self.ifindex, self.name, J1939_IDLE_ADDR, self.pgn)
+		self.set_broadcast(True)
+		self.send(self.name.to_bytes(8, "little"), J1939_PGN_ADDRESS_CLAIMED, J1939_NO_ADDR)
+
+	def set_broadcast(self, enable):
+		self.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1 if enable else 0)
+
+	def set_promisc(self, enable):
+		"""Receive all J1939 traffic, not only what is addressed to us."""
+		val = c_int(1 if enable else 0)
+		libc.setsockopt(self.fileno(), SOL_CAN_J1939, SO_J1939_PROMISC, byref(val), sizeof(val))
+
+	def set_priority(self, prio):
+		"""Set the priority (0 highest .. 7 lowest) of the frames we send."""
+		val = c_int(prio)
+		libc.setsockopt(self.fileno(), SOL_CAN_J1939, SO_J1939_SEND_PRIO, byref(val), sizeof(val))
+
+	def set_filters(self, filters):
+		"""Set the receive filters.
+
+		Args:
+			filters: list of J1939Filter structures.
+		"""
+		if len(filters) > J1939_FILTER_MAX:
+			raise ValueError(
+				"J1939[{}]: Too Many Filters: {} > {}".format(
+					self.fileno(), len(filters), J1939_FILTER_MAX
+				)
+			)
+		filtType = J1939Filter * len(filters)
+		jfilters = filtType(*filters)
+		libc.setsockopt(self.fileno(), SOL_CAN_J1939, SO_J1939_FILTER, byref(jfilters), sizeof(jfilters))
+
+	def _bind(self, ifindex, name, addr, pgn):
+		sockAddr = self._sock_addr(ifindex, name, pgn, addr)
+		libc.bind(self.fileno(), byref(sockAddr), sizeof(SockAddrCan))
+		self.ifindex = ifindex
+		self.name = name
+		self.addr = addr
+		self.pgn = pgn
+
+	@staticmethod
+	def _sock_addr(ifindex, name, pgn, addr):
+		sockAddr = SockAddrCan(socket.AF_CAN, ifindex or 0)
+		sockAddr.can_addr.j1939.name = name
+		sockAddr.can_addr.j1939.pgn = pgn
+		sockAddr.can_addr.j1939.addr = addr
+		return sockAddr
+
+def pgn_filter(pgn, addr=None):
+	"""Build a J1939Filter that matches a PGN and optionally a source address."""
+	filt = J1939Filter()
+	filt.pgn = pgn
+	filt.pgn_mask = J1939_PGN_MAX
+	if addr is not None:
+		filt.addr = addr
+		filt.addr_mask = 0xFF
+	return filt
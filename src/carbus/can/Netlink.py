@@ -0,0 +1,539 @@
+"""rtnetlink client for CAN network interfaces
+
+File: Netlink.py
+
+definitions for the CAN netlink attributes can be grabbed from: https://github.com/torvalds/linux/blob/master/include/uapi/linux/can/netlink.h
+
+Description:
+	This file talks NETLINK_ROUTE directly so that querying and configuring
+	CAN interfaces does not fork `ip`. RtNetlink queries link state and sets
+	bit timing, restart-ms and controller modes, creates and deletes vcan
+	devices. LinkMonitor subscribes to RTMGRP_LINK and reports link changes
+	from the event loop.
+"""
+
+import asyncio
+import errno
+import logging
+import os
+import socket
+import struct
+from collections import namedtuple
+from enum import IntEnum
+
+#netlink message types and flags from netlink.h / rtnetlink.h
+NLMSG_NOOP = 1
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x01
+NLM_F_MULTI = 0x02
+NLM_F_ACK = 0x04
+NLM_F_DUMP = 0x300
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+
+RTMGRP_LINK = 0x1
+
+IFF_UP = 0x1
+IFF_RUNNING = 0x40
+IFF_LOWER_UP = 0x10000
+
+#link attributes
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_STATS = 7
+IFLA_OPERSTATE = 16
+IFLA_LINKINFO = 18
+IFLA_STATS64 = 23
+
+IFLA_INFO_KIND = 1
+IFLA_INFO_DATA = 2
+IFLA_INFO_XSTATS = 3
+
+NLA_F_NESTED = 0x8000
+NLA_TYPE_MASK = 0x3FFF
+
+IF_OPER_STATES = ("unknown", "notpresent", "down", "lowerlayerdown", "testing", "dormant", "up")
+
+NLMSGHDR = struct.Struct("=IHHII")
+IFINFOMSG = struct.Struct("=BxHiII")
+RTATTR = struct.Struct("=HH")
+NLMSGERR = struct.Struct("=i")
+
+class IflaCan(IntEnum):
+	"""IFLA_CAN_* attributes nested in IFLA_INFO_DATA."""
+	BITTIMING = 1
+	BITTIMING_CONST = 2
+	CLOCK = 3
+	STATE = 4
+	CTRLMODE = 5
+	RESTART_MS = 6
+	RESTART = 7
+	BERR_COUNTER = 8
+	DATA_BITTIMING = 9
+	DATA_BITTIMING_CONST = 10
+
+class CANState(IntEnum):
+	"""CAN controller states from can/netlink.h"""
+	ERROR_ACTIVE = 0
+	ERROR_WARNING = 1
+	ERROR_PASSIVE = 2
+	BUS_OFF = 3
+	STOPPED = 4
+	SLEEPING = 5
+
+#controller modes, see CAN_CTRLMODE_*
+CAN_CTRLMODE_LOOPBACK = 0x01
+CAN_CTRLMODE_LISTENONLY = 0x02
+CAN_CTRLMODE_3_SAMPLES = 0x04
+CAN_CTRLMODE_ONE_SHOT = 0x08
+CAN_CTRLMODE_BERR_REPORTING = 0x10
+CAN_CTRLMODE_FD = 0x20
+CAN_CTRLMODE_PRESUME_ACK = 0x40
+CAN_CTRLMODE_FD_NON_ISO = 0x80
+
+CTRLMODE_NAMES = {
+	"loopback": CAN_CTRLMODE_LOOPBACK,
+	"listen_only": CAN_CTRLMODE_LISTENONLY,
+	"triple_sampling": CAN_CTRLMODE_3_SAMPLES,
+	"one_shot": CAN_CTRLMODE_ONE_SHOT,
+	"berr_reporting": CAN_CTRLMODE_BERR_REPORTING,
+	"fd": CAN_CTRLMODE_FD,
+	"presume_ack": CAN_CTRLMODE_PRESUME_ACK,
+	"fd_non_iso": CAN_CTRLMODE_FD_NON_ISO,
+}
+
+#struct can_bittiming: bitrate, sample_point, tq, prop_seg, phase_seg1, phase_seg2, sjw, brp
+CAN_BITTIMING = struct.Struct("=8I")
+CAN_CTRLMODE = struct.Struct("=II")
+#struct can_berr_counter: txerr, rxerr
+CAN_BERR_COUNTER = struct.Struct("=HH")
+U32 = struct.Struct("=I")
+
+def nla(atype, payload):
+	"""Pack a netlink attribute, padded to 4 bytes."""
+	length = RTATTR.size + len(payload)
+	return RTATTR.pack(length, atype) + payload + b"\0" * (-length & 3)
+
+def nla_nested(atype, *attrs):
+	return nla(atype | NLA_F_NESTED, b"".join(attrs))
+
+def parse_attrs(buf, offset=0, end=None):
+	"""Parse a run of netlink attributes.
+
+	Returns:
+		dict of attribute type -> payload bytes
+	"""
+	attrs = {}
+	end = len(buf) if end is None else end
+	while offset + RTATTR.size <= end:
+		length, atype = RTATTR.unpack_from(buf, offset)
+		if length < RTATTR.size:
+			break
+		attrs[atype & NLA_TYPE_MASK] = bytes(buf[offset + RTATTR.size:offset + length])
+		offset += (length + 3) & ~3
+	return attrs
+
+def _cstr(data):
+	return data.split(b"\0", 1)[0].decode()
+
+CanBerrCounter = namedtuple("CanBerrCounter", "txerr rxerr")
+
+#struct can_device_stats, the IFLA_INFO_XSTATS payload of CAN links
+CanDeviceStats = namedtuple(
+	"CanDeviceStats", "bus_error error_warning error_passive bus_off arbitration_lost restarts"
+)
+CAN_DEVICE_STATS = struct.Struct("=6I")
+
+#leading fields of struct rtnl_link_stats64, the ones every kernel reports
+LinkStats64 = namedtuple(
+	"LinkStats64",
+	"rx_packets tx_packets rx_bytes tx_bytes rx_errors tx_errors rx_dropped tx_dropped "
+	"multicast collisions rx_length_errors rx_over_errors rx_crc_errors rx_frame_errors "
+	"rx_fifo_errors rx_missed_errors tx_aborted_errors tx_carrier_errors tx_fifo_errors "
+	"tx_heartbeat_errors tx_window_errors rx_compressed tx_compressed",
+)
+LINK_STATS64 = struct.Struct("=23Q")
+
+class LinkInfo(object):
+	"""Decoded RTM_NEWLINK message.
+
+	Raw attributes are kept in `attrs`, `info` (IFLA_LINKINFO) and `data`
+	(IFLA_INFO_DATA) for values not decoded here.
+	"""
+
+	def __init__(self, msgType, index, flags, attrs):
+		self.msgType = msgType
+		self.index = index
+		self.flags = flags
+		self.attrs = attrs
+		self.name = _cstr(attrs[IFLA_IFNAME]) if IFLA_IFNAME in attrs else None
+		self.info = parse_attrs(attrs.get(IFLA_LINKINFO, b""))
+		self.data = parse_attrs(self.info.get(IFLA_INFO_DATA, b""))
+		self.kind = _cstr(self.info[IFLA_INFO_KIND]) if IFLA_INFO_KIND in self.info else None
+
+	@classmethod
+	def from_message(cls, msgType, buf):
+		_family, _type, index, flags, _change = IFINFOMSG.unpack_from(buf, 0)
+		return cls(msgType, index, flags, parse_attrs(buf, IFINFOMSG.size))
+
+	@property
+	def deleted(self):
+		return self.msgType == RTM_DELLINK
+
+	@property
+	def up(self):
+		return bool(self.flags & IFF_UP)
+
+	@property
+	def running(self):
+		return bool(self.flags & IFF_RUNNING)
+
+	@property
+	def operstate(self):
+		if IFLA_OPERSTATE not in self.attrs:
+			return None
+		state = self.attrs[IFLA_OPERSTATE][0]
+		return IF_OPER_STATES[state] if state < len(IF_OPER_STATES) else str(state)
+
+	@property
+	def mtu(self):
+		return U32.unpack(self.attrs[IFLA_MTU][:4])[0] if IFLA_MTU in self.attrs else None
+
+	@property
+	def state(self):
+		"""CANState of the controller, None for non-CAN links."""
+		if IflaCan.STATE not in self.data:
+			return None
+		return CANState(U32.unpack(self.data[IflaCan.STATE][:4])[0])
+
+	def _bittiming(self, attr):
+		if attr not in self.data:
+			return None
+		return CAN_BITTIMING.unpack(self.data[attr][:CAN_BITTIMING.size])
+
+	@property
+	def bitrate(self):
+		bt = self._bittiming(IflaCan.BITTIMING)
+		return bt[0] if bt else None
+
+	@property
+	def sample_point(self):
+		bt = self._bittiming(IflaCan.BITTIMING)
+		return bt[1] / 1000.0 if bt else None
+
+	@property
+	def data_bitrate(self):
+		bt = self._bittiming(IflaCan.DATA_BITTIMING)
+		return bt[0] if bt else None
+
+	@property
+	def data_sample_point(self):
+		bt = self._bittiming(IflaCan.DATA_BITTIMING)
+		return bt[1] / 1000.0 if bt else None
+
+	@property
+	def restart_ms(self):
+		if IflaCan.RESTART_MS not in self.data:
+			return None
+		return U32.unpack(self.data[IflaCan.RESTART_MS][:4])[0]
+
+	@property
+	def ctrlmode(self):
+		if IflaCan.CTRLMODE not in self.data:
+			return 0
+		return CAN_CTRLMODE.unpack(self.data[IflaCan.CTRLMODE][:CAN_CTRLMODE.size])[1]
+
+	@property
+	def listen_only(self):
+		return bool(self.ctrlmode & CAN_CTRLMODE_LISTENONLY)
+
+	@property
+	def berr_counter(self):
+		"""CanBerrCounter, None if the driver does not report it."""
+		if IflaCan.BERR_COUNTER not in self.data:
+			return None
+		return CanBerrCounter(*CAN_BERR_COUNTER.unpack(self.data[IflaCan.BERR_COUNTER][:CAN_BERR_COUNTER.size]))
+
+	@property
+	def device_stats(self):
+		"""CanDeviceStats from IFLA_INFO_XSTATS, None for non-CAN links."""
+		xstats = self.info.get(IFLA_INFO_XSTATS)
+		if xstats is None or len(xstats) < CAN_DEVICE_STATS.size:
+			return None
+		return CanDeviceStats(*CAN_DEVICE_STATS.unpack(xstats[:CAN_DEVICE_STATS.size]))
+
+	@property
+	def stats64(self):
+		stats = self.attrs.get(IFLA_STATS64)
+		if stats is None or len(stats) < LINK_STATS64.size:
+			return None
+		return LinkStats64(*LINK_STATS64.unpack(stats[:LINK_STATS64.size]))
+
+	def __repr__(self):
+		return "LinkInfo(name={},index={},kind={},up={},state={},bitrate={})".format(
+			self.name, self.index, self.kind, self.up, self.state, self.bitrate
+		)
+
+class RtNetlink(socket.socket):
+	"""NETLINK_ROUTE socket for querying and configuring links.
+
+	Args:
+		groups: multicast groups to join, e.g. RTMGRP_LINK.
+	"""
+
+	def __init__(self, groups=0):
+		socket.socket.__init__(self, socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+		self.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+		self.bind((0, groups))
+		self._seq = 0
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	########################
+	# Low Level Messaging
+	########################
+	def request(self, msgType, flags, payload):
+		"""Send a request and collect its replies.
+
+		Args:
+			msgType: RTM_* message type.
+			flags: NLM_F_* flags, NLM_F_REQUEST is added.
+			payload: message body following the nlmsghdr.
+
+		Returns:
+			list of (msgType, body) tuples of the replies.
+
+		Raises:
+			OSError with the errno returned by the kernel.
+		"""
+		self._seq = (self._seq + 1) & 0xFFFFFFFF
+		seq = self._seq
+		self.send(NLMSGHDR.pack(NLMSGHDR.size + len(payload), msgType, flags | NLM_F_REQUEST, seq, 0) + payload)
+
+		replies = []
+		while True:
+			buf = self.recv(1 << 16)
+			offset = 0
+			while offset + NLMSGHDR.size <= len(buf):
+				length, rtype, rflags, rseq, _pid = NLMSGHDR.unpack_from(buf, offset)
+				if length < NLMSGHDR.size:
+					break
+				body = buf[offset + NLMSGHDR.size:offset + length]
+				offset += (length + 3) & ~3
+				if rseq != seq:
+					#stale reply or a multicast event, not ours
+					continue
+				if rtype == NLMSG_ERROR:
+					err = -NLMSGERR.unpack_from(body, 0)[0]
+					if err:
+						raise OSError(err, "{}: {}".format(os.strerror(err), msgType))
+					return replies
+				if rtype == NLMSG_DONE:
+					return replies
+				replies.append((rtype, body))
+				if not rflags & NLM_F_MULTI and not flags & NLM_F_ACK:
+					return replies
+
+	def _link_request(self, msgType, flags, index=0, ifflags=0, change=0, attrs=b""):
+		return self.request(msgType, flags, IFINFOMSG.pack(socket.AF_UNSPEC, 0, index, ifflags, change) + attrs)
+
+	########################
+	# Queries
+	########################
+	def get_link(self, ifname):
+		"""Get the LinkInfo of one interface.
+
+		Raises:
+			OSError(ENODEV) if there is no such interface.
+		"""
+		replies = self._link_request(RTM_GETLINK, 0, attrs=nla(IFLA_IFNAME, ifname.encode() + b"\0"))
+		for msgType, body in replies:
+			if msgType == RTM_NEWLINK:
+				return LinkInfo.from_message(msgType, body)
+		raise OSError(errno.ENODEV, "No such interface {}".format(ifname))
+
+	def list_links(self, kind=None):
+		"""Dump all links, optionally only those of one kind ("can", "vcan")."""
+		links = [
+			LinkInfo.from_message(msgType, body)
+			for msgType, body in self._link_request(RTM_GETLINK, NLM_F_DUMP)
+			if msgType == RTM_NEWLINK
+		]
+		if kind is not None:
+			links = [link for link in links if link.kind == kind]
+		return links
+
+	def is_up(self, ifname):
+		try:
+			return self.get_link(ifname).up
+		except OSError:
+			return False
+
+	########################
+	# Configuration
+	########################
+	def _index(self, ifname):
+		return socket.if_nametoindex(ifname)
+
+	def set_up(self, ifname):
+		self._link_request(RTM_NEWLINK, NLM_F_ACK, self._index(ifname), IFF_UP, IFF_UP)
+
+	def set_down(self, ifname):
+		self._link_request(RTM_NEWLINK, NLM_F_ACK, self._index(ifname), 0, IFF_UP)
+
+	def set_can(self, ifname, bitrate=None, sample_point=None, restart_ms=None,
+			data_bitrate=None, data_sample_point=None, **modes):
+		"""Change CAN settings of a link. Bit timing changes require the link to be down.
+
+		Args:
+			ifname: interface name like `can0`.
+			bitrate: nominal bitrate in bit/s.
+			sample_point: sample point as a fraction, e.g. 0.875.
+			restart_ms: automatic bus-off restart delay, 0 disables it.
+			data_bitrate: CAN FD data phase bitrate.
+			data_sample_point: CAN FD data phase sample point.
+			modes: controller modes by name (see CTRLMODE_NAMES) set to
+				True/False, e.g. listen_only=True, fd=True.
+		"""
+		data = []
+		if bitrate is not None:
+			sp = int(round(sample_point * 1000)) if sample_point else 0
+			data.append(nla(IflaCan.BITTIMING, CAN_BITTIMING.pack(bitrate, sp, 0, 0, 0, 0, 0, 0)))
+		if data_bitrate is not None:
+			sp = int(round(data_sample_point * 1000)) if data_sample_point else 0
+			data.append(nla(IflaCan.DATA_BITTIMING, CAN_BITTIMING.pack(data_bitrate, sp, 0, 0, 0, 0, 0, 0)))
+		if restart_ms is not None:
+			data.append(nla(IflaCan.RESTART_MS, U32.pack(restart_ms)))
+		mask = flags = 0
+		for name, enabled in modes.items():
+			if enabled is None:
+				continue
+			if name not in CTRLMODE_NAMES:
+				raise ValueError("Unknown CAN controller mode {}".format(name))
+			mask |= CTRLMODE_NAMES[name]
+			if enabled:
+				flags |= CTRLMODE_NAMES[name]
+		if mask:
+			data.append(nla(IflaCan.CTRLMODE, CAN_CTRLMODE.pack(mask, flags)))
+		if not data:
+			return
+		linkinfo = nla_nested(IFLA_LINKINFO, nla(IFLA_INFO_KIND, b"can"), nla_nested(IFLA_INFO_DATA, *data))
+		self._link_request(RTM_NEWLINK, NLM_F_ACK, self._index(ifname), attrs=linkinfo)
+
+	def restart(self, ifname):
+		"""Manually restart a controller that is bus-off."""
+		data = nla(IflaCan.RESTART, U32.pack(1))
+		linkinfo = nla_nested(IFLA_LINKINFO, nla(IFLA_INFO_KIND, b"can"), nla_nested(IFLA_INFO_DATA, data))
+		self._link_request(RTM_NEWLINK, NLM_F_ACK, self._index(ifname), attrs=linkinfo)
+
+	def configure(self, ifname, up=True, **settings):
+		"""Take the link down, apply `set_can` settings and bring it back up.
+
+		vcan links have no CAN attributes, only their up state is changed.
+		"""
+		link = self.get_link(ifname)
+		if link.kind == "can" and any(v is not None for v in settings.values()):
+			if link.up:
+				self.set_down(ifname)
+			self.set_can(ifname, **settings)
+		if up:
+			self.set_up(ifname)
+		elif link.up:
+			self.set_down(ifname)
+
+	def add_vcan(self, ifname, up=True):
+		"""Create a vcan device. An existing vcan device of that name is reused."""
+		linkinfo = nla_nested(IFLA_LINKINFO, nla(IFLA_INFO_KIND, b"vcan"))
+		try:
+			self._link_request(
+				RTM_NEWLINK,
+				NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL,
+				attrs=nla(IFLA_IFNAME, ifname.encode() + b"\0") + linkinfo,
+			)
+		except OSError as e:
+			if e.errno != errno.EEXIST or self.get_link(ifname).kind != "vcan":
+				raise
+		if up:
+			self.set_up(ifname)
+
+	def delete_link(self, ifname):
+		self._link_request(RTM_DELLINK, NLM_F_ACK, self._index(ifname))
+
+def link_is_up(ifname):
+	"""Check if a link is UP without spawning `ip`."""
+	with RtNetlink() as nl:
+		return nl.is_up(ifname)
+
+class LinkMonitor(object):
+	"""Reports link changes (up/down, CAN state, new/removed links).
+
+	Args:
+		callback: called with a LinkInfo for every RTM_NEWLINK/RTM_DELLINK.
+		ifnames: optional collection of interface names to report.
+		loop: asyncio event loop.
+	"""
+
+	def __init__(self, callback, ifnames=None, loop=None):
+		self.callback = callback
+		self.ifnames = set(ifnames) if ifnames else None
+		self.loop = loop
+		self.socket = None
+
+	def start(self):
+		if self.socket is not None:
+			return
+		if self.loop is None:
+			self.loop = asyncio.get_event_loop()
+		self.socket = RtNetlink(RTMGRP_LINK)
+		self.socket.setblocking(False)
+		self.loop.add_reader(self.socket.fileno(), self._read)
+
+	def stop(self):
+		if self.socket is None:
+			return
+		self.loop.remove_reader(self.socket.fileno())
+		self.socket.close()
+		self.socket = None
+
+	def read_events(self):
+		"""Drain pending link events from the socket."""
+		events = []
+		while True:
+			try:
+				buf = self.socket.recv(1 << 16)
+			except BlockingIOError:
+				return events
+			except OSError as e:
+				if e.errno == errno.ENOBUFS:
+					#events were lost, callers should re-query the links they care about
+					logging.warning("Netlink link monitor overrun")
+					continue
+				raise
+			offset = 0
+			while offset + NLMSGHDR.size <= len(buf):
+				length, msgType, _flags, _seq, _pid = NLMSGHDR.unpack_from(buf, offset)
+				if length < NLMSGHDR.size:
+					break
+				if msgType in (RTM_NEWLINK, RTM_DELLINK):
+					link = LinkInfo.from_message(msgType, buf[offset + NLMSGHDR.size:offset + length])
+					if self.ifnames is None or link.name in self.ifnames:
+						events.append(link)
+				offset += (length + 3) & ~3
+
+	def _read(self):
+		for link in self.read_events():
+			try:
+				self.callback(link)
+			except Exception as exc:
+				logging.error("{} link callback failed: {}".format(link.name, exc))
@@ -0,0 +1,264 @@
+"""Automatic recovery of CAN ports after bus-off and link loss
+
+File: RecoverySupervisor.py
+
+Description:
+	RecoverySupervisor watches one interface through link events and the
+	ports attached to it. Link state comes from a probe: NetlinkProbe for
+	kernel interfaces, the VirtualBus itself for VirtualCANPorts. When the link goes down, loses carrier or
+	the controller goes bus-off, every port is suspended (its socket closed,
+	`connectionLost` called on the protocol). The supervisor then restarts
+	the controller (or brings the link back up) and polls the link every
+	`poll_interval` until it is usable again, at which point every port
+	re-creates its socket with the same filters, error mask and loopback
+	options and the protocols get `connectionResumed`.
+
+	The time from detection to resumption of every recovery is kept in
+	`recoveries` and exported through `metrics()`.
+"""
+
+import asyncio
+import collections
+import logging
+import traceback
+
+from .Netlink import CANState, LinkMonitor, RtNetlink
+
+UNUSABLE_STATES = frozenset([CANState.BUS_OFF, CANState.STOPPED, CANState.SLEEPING])
+
+class NetlinkProbe(object):
+	"""Link state and restarts of a kernel interface through rtnetlink.
+
+	A probe answers `getLink()` with an object having the `deleted`, `up`,
+	`running`, `state` and `kind` fields of LinkInfo, restarts the link with
+	`restartLink(link)` and reports changes through `monitor(callback)`.
+	"""
+
+	def __init__(self, ifname, loop=None):
+		self.ifname = ifname
+		self.loop = loop
+		self._nl = None
+
+	def getLink(self):
+		if self._nl is None:
+			self._nl = RtNetlink()
+		return self._nl.get_link(self.ifname)
+
+	def restartLink(self, link):
+		if self._nl is None:
+			self._nl = RtNetlink()
+		if not link.up:
+			self._nl.set_up(self.ifname)
+		elif link.kind == "can" and link.state in UNUSABLE_STATES:
+			self._nl.restart(self.ifname)
+		elif link.kind == "can" and not link.running:
+			#carrier stuck off, cycle the link
+			self._nl.set_down(self.ifname)
+			self._nl.set_up(self.ifname)
+
+	def monitor(self, callback):
+		monitor = LinkMonitor(callback, [self.ifname], self.loop)
+		monitor.start()
+		return monitor
+
+	def close(self):
+		if self._nl is not None:
+			self._nl.close()
+			self._nl = None
+
+class RecoverySupervisor(object):
+	"""Suspends and resumes the ports of one interface.
+
+	Args:
+		ifname: interface name like `can0`.
+		restart: restart the controller / bring the link up ourselves. With
+			False the supervisor only waits for somebody else to do it
+			(e.g. the kernel with restart-ms).
+		restart_delay: seconds to wait before a manual restart, gives the
+			kernel's own restart-ms the first chance.
+		poll_interval: seconds between link checks while recovering.
+		max_interval: upper bound of the poll interval backoff.
+		probe: link probe, see NetlinkProbe. None takes the one of the first
+			attached port that has one, NetlinkProbe otherwise.
+		loop: asyncio event loop.
+	"""
+
+	def __init__(self, ifname, restart=True, restart_delay=0.05, poll_interval=0.02, max_interval=1.0,
+			probe=None, loop=None):
+		self.ifname = ifname
+		self.restart = restart
+		self.restart_delay = restart_delay
+		self.poll_interval = poll_interval
+		self.max_interval = max_interval
+		self.loop = loop
+		self.ports = []
+		self.lostAt = None
+		self.lostReason = None
+		self.recoveries = collections.deque(maxlen=100)
+		self.failures = 0
+		self.probe = probe
+		self._monitor = None
+		self._handle = None
+		self._interval = poll_interval
+		self._restartAt = None
+
+	@property
+	def lost(self):
+		return self.lostAt is not None
+
+	def attach(self, port):
+		port.supervisor = self
+		if self.probe is None and self._monitor is None:
+			self.probe = port.linkProbe()
+		if port not in self.ports:
+			self.ports.append(port)
+
+	def detach(self, port):
+		if port in self.ports:
+			self.ports.remove(port)
+		port.supervisor = None
+
+	def start(self):
+		if self._monitor is not None:
+			return
+		if self.loop is None:
+			self.loop = asyncio.get_event_loop()
+		if self.probe is None:
+			self.probe = NetlinkProbe(self.ifname, self.loop)
+		self._monitor = self.probe.monitor(self.linkChanged)
+
+	def stop(self):
+		if self._monitor is not None:
+			self._monitor.stop()
+			self._monitor = None
+		self._cancel()
+		if isinstance(self.probe, NetlinkProbe):
+			self.probe.close()
+
+	########################
+	# Events
+	########################
+	def linkChanged(self, link):
+		"""Handle a LinkInfo from the probe, events or our own polls."""
+		if link.deleted or not link.up or not link.running or link.state in UNUSABLE_STATES:
+			reason = "{} {}".format(
+				self.ifname,
+				"removed" if link.deleted else "down" if not link.up else
+				link.state.name if link.state in UNUSABLE_STATES else "no carrier",
+			)
+			self.linkLost(reason)
+		elif self.lost:
+			self._resume()
+
+	def portFailed(self, port, exc):
+		"""Called by a port whose socket reported the interface gone."""
+		logging.warning("{} socket failed: {}".format(self.ifname, exc))
+		self.linkLost(exc)
+
+	def busOff(self, port):
+		"""Called by a port that received a bus-off error frame."""
+		self.linkLost("{} bus-off".format(self.ifname))
+
+	def linkLost(self, reason):
+		if self.lost:
+			return
+		if self.loop is None:
+			self.loop = asyncio.get_event_loop()
+		self.lostAt = self.loop.time()
+		self.lostReason = reason
+		self._restartAt = None
+		self._interval = self.poll_interval
+		logging.warning("{}: connection lost ({}), recovering".format(self.ifname, reason))
+		for port in list(self.ports):
+			try:
+				port.suspend(reason)
+			except Exception as exc:
+				logging.error("{} suspend: {}".format(self.ifname, exc))
+				logging.debug(traceback.format_exc())
+		self._schedule(self.poll_interval)
+
+	def metrics(self):
+		labels = {"ifname": self.ifname}
+		ret = [
+			("carbus_can_link_lost", labels, int(self.lost)),
+			("carbus_can_recoveries_total", labels, len(self.recoveries)),
+			("carbus_can_recovery_failures_total", labels, self.failures),
+		]
+		if self.recoveries:
+			ret.append(("carbus_can_last_recovery_seconds", labels, self.recoveries[-1]))
+			ret.append(("carbus_can_max_recovery_seconds", labels, max(self.recoveries)))
+		return ret
+
+	########################
+	# Internal Methods
+	########################
+	def _getLink(self):
+		if self.probe is None:
+			self.probe = NetlinkProbe(self.ifname, self.loop)
+		return self.probe.getLink()
+
+	def _restartLink(self, link):
+		self.probe.restartLink(link)
+
+	def _schedule(self, delay):
+		self._cancel()
+		self._handle = self.loop.call_later(delay, self._check)
+
+	def _cancel(self):
+		if self._handle is not None:
+			self._handle.cancel()
+			self._handle = None
+
+	def _check(self):
+		self._handle = None
+		if not self.lost:
+			return
+		try:
+			link = self._getLink()
+		except OSError as exc:
+			logging.debug("{} link query: {}".format(self.ifname, exc))
+			link = None
+
+		self._interval = min(self._interval * 1.5, self.max_interval)
+		delay = self._interval
+		if link is not None:
+			self.linkChanged(link)
+			if not self.lost:
+				return
+			now = self.loop.time()
+			#a restart that did not take is repeated once the backoff has grown past it
+			due = self._restartAt is None or now - self._restartAt > self._interval * 4
+			wait = self.restart_delay - (now - self.lostAt)
+			if self.restart and due and wait <= 0:
+				self._restartAt = now
+				try:
+					self._restartLink(link)
+				except OSError as exc:
+					logging.error("{} restart: {}".format(self.ifname, exc))
+					self.failures += 1
+			elif self.restart and self._restartAt is None:
+				#do not let the backoff postpone the first restart
+				delay = min(delay, wait)
+
+		self._schedule(delay)
+
+	def _resume(self):
+		failed = False
+		for port in list(self.ports):
+			try:
+				port.resume()
+			except Exception as exc:
+				logging.error("{} resume: {}".format(self.ifname, exc))
+				logging.debug(traceback.format_exc())
+				failed = True
+		if failed:
+			self.failures += 1
+			self._schedule(self._interval)
+			return
+
+		elapsed = self.loop.time() - self.lostAt
+		self.recoveries.append(elapsed)
+		logging.warning("{}: recovered in {:.0f} ms".format(self.ifname, elapsed * 1000))
+		self.lostAt = None
+		self.lostReason = None
+		self._cancel()
@@ -11,11 +11,13 @@ Description:
 """
 
 import array
+import errno
 import operator
 import os
 import socket
-import subprocess as sp
+import struct
 from .IfReq import IfReq, SIOCGIFINDEX, SIOCGSTAMP
+from .Netlink import link_is_up
 from collections import namedtuple
 
 from ctypes import (#a Python library for interfacing with C code
@@ -29,6 +31,7 @@ from ctypes import (#a Python library for interfacing with C code
 	c_int,
 	c_long,
 	c_short,
+	c_size_t,
 	c_uint8,
 	c_uint16,
 	c_uint32,
@@ -36,13 +39,19 @@ from ctypes import (#a Python library for interfacing with C code
 	c_ulong,
 	c_ushort,
 	c_void_p,
+	addressof,
+	create_string_buffer,
+	memmove,
+	memset,
 	pointer,#This function is used to create a pointer object that points to a given object. It is similar to byref but returns a pointer object instead of a pointer value.
+	string_at,
 	sizeof,#This function returns the size in bytes of a given object or type. It can be used to determine the memory size of C-compatible structures or types.
 )
 
 from ctypes.util import find_library
 from enum import Enum, IntEnum
 from functools import reduce
+from itertools import repeat
 
 
 #particular protocols of the protocol family PF_CAN defined in can.h
@@ -103,6 +112,46 @@ class TimeVal(Structure):
 		("tv_usec", c_long),
 	]
 
+class IoVec(Structure):
+	_fields_ = [
+		("iov_base", c_void_p),
+		("iov_len", c_size_t),
+	]
+
+class MsgHdr(Structure):
+	_fields_ = [
+		("msg_name", c_void_p),
+		("msg_namelen", c_uint32),
+		("msg_iov", POINTER(IoVec)),
+		("msg_iovlen", c_size_t),
+		("msg_control", c_void_p),
+		("msg_controllen", c_size_t),
+		("msg_flags", c_int),
+	]
+
+class MMsgHdr(Structure):
+	_fields_ = [
+		("msg_hdr", MsgHdr),
+		("msg_len", c_uint32),
+	]
+
+class CMsgHdr(Structure):
+	_fields_ = [
+		("cmsg_len", c_size_t),
+		("cmsg_level", c_int),
+		("cmsg_type", c_int),
+	]
+
+SO_TIMESTAMP = 29 #SOL_SOCKET option, adds a struct timeval cmsg to every message
+MSG_DONTWAIT = 0x40
+#CMSG_SPACE(sizeof(struct timeval))
+TS_CMSG_SPACE = sizeof(CMsgHdr) + sizeof(TimeVal)
+#raw layouts of a can_frame and of a SO_TIMESTAMP cmsg for bulk unpacking
+FRAME_STRUCT = struct.Struct("=IB3x8s")
+TS_CMSG_STRUCT = struct.Struct("=Qiiqq")
+#can_ifindex of a struct sockaddr_can filled in by recvmmsg
+SOCKADDR_IFINDEX_STRUCT = struct.Struct("=4xi{}x".format(sizeof(SockAddrCan) - 8))
+
 # See "Linux/can.h"
 FRAME_LEN = 8 #length of data sent out in CAN message
 CAN_EFF_FLAG = 0x80000000 #(CAN extended farme format flag) used to indicate a 29-bit ID rather than an 11-bit ID
@@ -278,6 +327,30 @@ class CANTransceiverStatus(Enum):
 
 	UnknownError = 0x100  # out of range of 8-bit value
 
+########################
+# Error Decode Tables
+########################
+# One lookup per error byte instead of scanning the enums for every frame.
+CAN_ERR_CLASS_BITS = 9
+
+ERR_CLASS_TABLE = tuple(
+	frozenset(x for x in CANErrorClass if x.value & mask) for mask in range(1 << CAN_ERR_CLASS_BITS)
+)
+CTRL_STATUS_TABLE = tuple(
+	frozenset(x for x in CANControllerStatus if x.value & val) for val in range(256)
+)
+PROTO_TYPE_TABLE = tuple(
+	frozenset(x for x in CANProtoStatusType if x.value & val) for val in range(256)
+)
+
+def _transceiver_status(val):
+	try:
+		return CANTransceiverStatus(val)
+	except ValueError:
+		return CANTransceiverStatus.UnknownError
+
+TRANSCEIVER_TABLE = tuple(_transceiver_status(val) for val in range(256))
+
 ################################
 # Libc Interface Definitions
 ################################
@@ -304,9 +377,10 @@ def errcheck(ret, func, args):
 	if ret == -1:
 		e = get_errno_loc()[0]
 		raise OSError(
+			e,
 			"CAN: func={} errno={} errstr={} args={}".format(
 				func.__name__, e, os.strerror(e), args
-			)
+			),
 		)
 	return ret
 
@@ -318,9 +392,13 @@ addErrCheckMethods = [
 	libc.write,
 	libc.bind,
 	libc.connect,
+	libc.sendto,
+	libc.recvfrom,
 	libc.getsockopt,
 	libc.setsockopt,
 	libc.ioctl,
+	libc.recvmmsg,
+	libc.sendmmsg,
 ]
 for func in addErrCheckMethods:
 	func.errcheck = errcheck
@@ -341,11 +419,13 @@ libc.setsockopt.argtypes = [
 ]
 
 class CANFrame(object):
-	def __init__(self, data, addr, rtr, ts=None):
+	def __init__(self, data, addr, rtr, ts=None, ifname=None):
 		self.data = data
 		self.addr = addr
 		self.rtr = rtr
 		self.ts = ts
+		#interface the frame was received on, or should be sent on
+		self.ifname = ifname
 	
 	def __eq__(self, other):
 		tests = (
@@ -366,6 +446,34 @@ CANError = namedtuple(
 	("flags", "position", "ctl_flags", "proto_type", "proto_loc", "trans_error"),
 )
 
+_NO_FLAGS = frozenset()
+
+def decode_error(can_id, data):
+	"""Decode an error frame with the precomputed tables.
+
+	The class bits in the id select which data bytes carry information,
+	see `linux/can/error.h`.
+
+	Args:
+		can_id: can_id of the error frame, including CAN_ERR_FLAG.
+		data: the 8 data bytes of the frame.
+
+	Returns:
+		CANError tuple.
+	"""
+	mask = can_id & CAN_ERR_MASK
+	flags = ERR_CLASS_TABLE[mask & ((1 << CAN_ERR_CLASS_BITS) - 1)]
+	position = data[LOSTARB_OFFSET] if mask & CANErrorClass.LostArbitration else None
+	ctlFlags = CTRL_STATUS_TABLE[data[CONTROLLER_STAT_OFFSET]] if mask & CANErrorClass.ControllerError else _NO_FLAGS
+	if mask & CANErrorClass.ProtocolViolation:
+		protoType = PROTO_TYPE_TABLE[data[PROTO_TYPE_OFFSET]]
+		protoLoc = data[PROTO_LOC_OFFSET]
+	else:
+		protoType = _NO_FLAGS
+		protoLoc = None
+	transError = TRANSCEIVER_TABLE[data[TRANSCEIVER_OFFSET]] if mask & CANErrorClass.TransceiverStatus else None
+	return CANError(flags, position, ctlFlags, protoType, protoLoc, transError)
+
 class CANAddress(Enum):
 	Standard = 1
 	Extended = 2
@@ -445,11 +553,9 @@ class CANInterfaceUtils(object):
 		Returns:
 			bool
 		"""
-		cmd = "ip link show {} | grep -c UP".format(ifname)
 		try:
-			ret = sp.check_output(cmd, shell=True)
-			return int(ret) > 0
-		except:
+			return link_is_up(ifname)
+		except OSError:
 			return False
 
 	@staticmethod
@@ -494,21 +600,41 @@ class SocketCAN(CANBase, CANInterfaceUtils):
 	def __init__(self):
 		CANBase.__init__(self, socket.PF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
 		self.ifindex = None
+		self.ifname = None
+		self._ifnames = {}
+		self._batch = None
+		self._txBatch = None
 
 	def bind(self, ifname):
 		"""Bind this CAN socket to a particular CAN interface by name.
 
-		Example names would be `can0` or `vcan1`.
+		Example names would be `can0` or `vcan1`. `None` binds to all CAN
+		interfaces (ifindex 0); read_batch then tags every frame with the
+		interface it came from and writes need an explicit `ifname`.
 		"""
-		ifindex = self._get_ifindex(ifname)
+		ifindex = 0 if ifname is None else self._get_ifindex(ifname)
 		addr = SockAddrCan(socket.AF_CAN, ifindex)
 
 		fd = self.fileno()
 		numBytes = sizeof(SockAddrCan)
 		libc.bind(fd, byref(addr), numBytes)
 		self.ifindex = ifindex
+		self.ifname = ifname
+		#a batch allocated before binding has no source addresses
+		self._batch = None
+
+	def interface_name(self, ifindex):
+		"""Cached ifindex -> ifname lookup for frames read on an unbound socket."""
+		name = self._ifnames.get(ifindex)
+		if name is None:
+			try:
+				name = socket.if_indextoname(ifindex)
+			except OSError:
+				name = str(ifindex)
+			self._ifnames[ifindex] = name
+		return name
 
-	def write(self, data, addr, rtr=False, ext=False):
+	def write(self, data, addr, rtr=False, ext=False, ifname=None):
 		"""Write one CAN data frame on this CAN interface socket.
 
 		Args:
@@ -517,6 +643,8 @@ class SocketCAN(CANBase, CANInterfaceUtils):
 			addr: CAN Node address that this data is destined for.
 			rtr: set the remote transmission request bit.
 			ext: use the extended address space.
+			ifname: interface to send on, required if the socket was
+				bound to all interfaces.
 		"""
 		if addr is None:
 			raise ValueError("Invalid Address: {}".format(addr))
@@ -526,11 +654,55 @@ class SocketCAN(CANBase, CANInterfaceUtils):
 
 		fd = self.fileno()
 		numBytes = sizeof(frame)
-		ret = libc.write(fd, byref(frame), numBytes)
+		if ifname is not None and ifname != self.ifname:
+			dest = SockAddrCan(socket.AF_CAN, socket.if_nametoindex(ifname))
+			ret = libc.sendto(fd, byref(frame), numBytes, 0, byref(dest), sizeof(dest))
+		else:
+			ret = libc.write(fd, byref(frame), numBytes)
 		if ret != numBytes:
 			msg = "Invalid Write Count: {} != {}".format(ret, numBytes)
 			raise RuntimeError(msg)
 
+	def write_batch(self, frames, ext=False):
+		"""Write several CAN frames with a single sendmmsg call.
+
+		Args:
+			frames: list of CANFrame objects.
+			ext: use the extended address space for all frames.
+
+		Returns:
+			number of frames the kernel accepted, which is less than
+			len(frames) when the interface TX queue fills up.
+		"""
+		count = len(frames)
+		if count == 0:
+			return 0
+		txBatch = self._txBatch
+		if txBatch is None or txBatch[0] < count:
+			txBatch = self._alloc_tx_batch(max(count, 64))
+		_, cframes, msgs, _ = txBatch
+
+		for i, frame in enumerate(frames):
+			cframes[i].load(frame.data, frame.addr, frame.rtr, ext)
+		try:
+			return libc.sendmmsg(self.fileno(), msgs, count, MSG_DONTWAIT)
+		except OSError as exc:
+			if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+				return 0
+			raise
+
+	def _alloc_tx_batch(self, size):
+		cframes = (CanFrame * size)()
+		iovs = (IoVec * size)()
+		msgs = (MMsgHdr * size)()
+		for i in range(size):
+			iovs[i].iov_base = addressof(cframes[i])
+			iovs[i].iov_len = sizeof(CanFrame)
+			msgs[i].msg_hdr.msg_iov = pointer(iovs[i])
+			msgs[i].msg_hdr.msg_iovlen = 1
+		self._txBatch = (size, cframes, msgs, iovs)
+		return self._txBatch
+
 	def read(self):
 		"""Read one CAN frame from the socket.
 
@@ -556,7 +728,81 @@ class SocketCAN(CANBase, CANInterfaceUtils):
 
 		rtr = (frame.can_id & CAN_RTR_FLAG) > 0
 		buf = array.array("B", frame.data[: frame.len]).tobytes()
-		return CANFrame(buf, addr, rtr, self.get_timestamp())
+		return CANFrame(buf, addr, rtr, self.get_timestamp(), self.ifname)
+
+	def read_batch(self, max_frames=64):
+		"""Read up to `max_frames` queued CAN frames with a single recvmmsg call.
+
+		Each frame carries its own kernel receive timestamp. The socket should
+		be non-blocking, an empty list is returned when nothing is queued.
+
+		Returns:
+			list of CANFrame objects, error frames are returned as CANError.
+		"""
+		batch = self._batch
+		if batch is None or batch[0] < max_frames:
+			batch = self._alloc_batch(max_frames)
+		_, frames, ctrl, msgs, template, _, names = batch
+
+		#the kernel rewrites msg_controllen/msg_len, restore the whole vector at once
+		memmove(msgs, template, len(template))
+		memset(ctrl, 0, TS_CMSG_SPACE * max_frames)
+		try:
+			count = libc.recvmmsg(self.fileno(), msgs, max_frames, MSG_DONTWAIT, None)
+		except OSError as exc:
+			if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+				return []
+			raise
+
+		#unpack the raw buffers in one go instead of going through ctypes fields
+		frameBuf = string_at(frames, FRAME_STRUCT.size * count)
+		ctrlBuf = string_at(ctrl, TS_CMSG_SPACE * count)
+		if names is not None:
+			ifname = self.interface_name
+			sources = [
+				ifname(idx) for (idx,) in SOCKADDR_IFINDEX_STRUCT.iter_unpack(string_at(names, sizeof(SockAddrCan) * count))
+			]
+		else:
+			sources = repeat(self.ifname)
+		ret = []
+		append = ret.append
+		for (canId, length, data), (_, level, kind, sec, usec), source in zip(
+			FRAME_STRUCT.iter_unpack(frameBuf), TS_CMSG_STRUCT.iter_unpack(ctrlBuf), sources
+		):
+			if canId & CAN_ERR_FLAG:
+				append(decode_error(canId, data))
+			else:
+				ts = sec + usec / 1000000.0 if kind == SO_TIMESTAMP and level == socket.SOL_SOCKET else None
+				if canId & CAN_EFF_FLAG:
+					addr = canId & CAN_EFF_MASK
+				else:
+					addr = canId & CAN_SFF_MASK
+				append(CANFrame(data[:length], addr, (canId & CAN_RTR_FLAG) > 0, ts, source))
+		return ret
+
+	def _alloc_batch(self, size):
+		"""Preallocate the frame, iovec and cmsg buffers used by read_batch."""
+		self.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMP, 1)
+		frames = (CanFrame * size)()
+		iovs = (IoVec * size)()
+		ctrl = create_string_buffer(TS_CMSG_SPACE * size)
+		msgs = (MMsgHdr * size)()
+		#the source address is only needed to tell interfaces apart on an unbound socket
+		names = (SockAddrCan * size)() if self.ifindex == 0 else None
+		for i in range(size):
+			iovs[i].iov_base = addressof(frames[i])
+			iovs[i].iov_len = sizeof(CanFrame)
+			hdr = msgs[i].msg_hdr
+			hdr.msg_iov = pointer(iovs[i])
+			hdr.msg_iovlen = 1
+			hdr.msg_control = addressof(ctrl) + i * TS_CMSG_SPACE
+			hdr.msg_controllen = TS_CMSG_SPACE
+			if names is not None:
+				hdr.msg_name = addressof(names[i])
+				hdr.msg_namelen = sizeof(SockAddrCan)
+		#iovs is kept referenced for as long as msgs points into it
+		self._batch = (size, frames, ctrl, msgs, string_at(msgs, sizeof(msgs)), iovs, names)
+		return self._batch
 
 	def get_timestamp(self):
 		"""Must be called directly after calling the read of a frame.
@@ -772,35 +1018,4 @@ class SocketCAN(CANBase, CANInterfaceUtils):
 		Returns:
 			CANError tuple with error information extracted.
 		"""
-		mask = frame.can_id & CAN_ERR_MASK
-		flags = set([x for x in CANErrorClass if (x.value & mask) > 0])
-
-		position = None
-		ctlFlags = set([])
-		protoType = set([])
-		protoLoc = None
-		transError = None
-		if CANErrorClass.LostArbitration in flags:
-			position = int(frame.data[LOSTARB_OFFSET])
-
-		elif CANErrorClass.ControllerError in flags:
-			ctlVal = frame.data[CONTROLLER_STAT_OFFSET]
-			ctlFlags = set([x for x in CANControllerStatus if (x.value & ctlVal)])
-
-		elif CANErrorClass.ProtocolViolation in flags:
-			typeVal = int(frame.data[PROTO_TYPE_OFFSET])
-			protoType = set([x for x in CANProtoStatusType if (x.value & typeVal)])
-			try:
-				protoLoc = frame.data[PROTO_LOC_OFFSET]
-			except Exception:
-				protoLoc = CANProtoStatusLoc.Unknown
-
-		elif CANErrorClass.TransceiverStatus in flags:
-			transVal = frame.data[TRANSCEIVER_OFFSET]
-			try:
-				transError = CANTransceiverStatus(transVal)
-			except Exception:
-				transError = CANTransceiverStatus.Unknown
-
-		ret = CANError(flags, position, ctlFlags, protoType, protoLoc, transError)
-		return ret
\ No newline at end of file
+		return decode_error(frame.can_id, bytes(frame.data))
@@ -0,0 +1,351 @@
+"""
+File: VirtualBus.py
+
+Description:
+	In-process CAN bus for simulation and tests. VirtualSocket implements the
+SocketCAN calls that CANPort uses (reads, writes, filters, error mask,
+loopback and receive-own) on top of an in-memory VirtualBus, and
+VirtualCANPort plugs it into a protocol without any kernel interface. Frames
+are delivered immediately, or, when a bitrate is configured, one at a time in
+arbitration order with their real on-wire duration.
+
+	The bus also simulates the link of a kernel interface: it can be taken
+down or put in bus-off, and it answers the same getLink/restartLink/monitor
+calls as NetlinkProbe, so a RecoverySupervisor recovers VirtualCANPorts the
+same way it recovers real ones.
+"""
+
+import asyncio
+import errno
+import heapq
+import time
+from collections import deque, namedtuple
+
+from .CANPort import CANPort
+from .SocketCAN import (
+	CAN_SFF_MASK,
+	CANAddress,
+	CANError,
+	CANErrorClass,
+	CANFrame,
+	CANFilter,
+)
+from .Netlink import CANState
+from ..tools.BusLoad import frame_bit_length
+
+#link state of a VirtualBus, has the LinkInfo fields RecoverySupervisor uses
+VirtualLink = namedtuple("VirtualLink", "name index kind deleted up running state")
+
+UNUSABLE_STATES = frozenset([CANState.BUS_OFF, CANState.STOPPED, CANState.SLEEPING])
+
+class VirtualSocket(object):
+	"""In-memory stand-in for SocketCAN attached to a VirtualBus."""
+
+	def __init__(self, bus):
+		self.bus = bus
+		self.ifindex = bus.ifindex
+		self.filters = None
+		self.errorMask = set()
+		self.loopback = True
+		self.receiveOwn = False
+		self._rx = deque()
+		self._reader = None
+		self._loop = None
+		self._scheduled = False
+		self._lastTs = None
+
+	def fileno(self):
+		return None
+
+	def close(self):
+		self.bus.detach(self)
+
+	def setblocking(self, flag):
+		pass
+
+	def bind(self, ifname=None):
+		self.bus.attach(self)
+
+	########################
+	# SocketCAN Interface
+	########################
+	def write(self, data, addr, rtr=False, ext=False, ifname=None):
+		if addr is None:
+			raise ValueError("Invalid Address: {}".format(addr))
+		self.bus.checkUsable()
+		self.bus.transmit(self, CANFrame(bytes(data), addr, rtr), ext)
+
+	def write_batch(self, frames, ext=False):
+		self.bus.checkUsable()
+		for frame in frames:
+			self.bus.transmit(self, CANFrame(frame.data, frame.addr, frame.rtr), ext)
+		return len(frames)
+
+	def read(self):
+		if not self._rx:
+			raise BlockingIOError("VirtualSocket: no frame queued")
+		frame = self._rx.popleft()
+		self._lastTs = getattr(frame, "ts", None)
+		return frame
+
+	def read_batch(self, max_frames=64):
+		rx = self._rx
+		count = min(max_frames, len(rx))
+		ret = [rx.popleft() for _ in range(count)]
+		if ret:
+			self._lastTs = getattr(ret[-1], "ts", None)
+		return ret
+
+	def get_timestamp(self):
+		return self._lastTs
+
+	def set_can_filters(self, filters):
+		self.filters = list(filters)
+
+	def get_can_filters(self):
+		return list(self.filters) if self.filters is not None else [CANFilter(0, 0)]
+
+	def set_error_mask(self, flags=frozenset(CANErrorClass)):
+		self.errorMask = set(flags)
+
+	def get_error_mask(self):
+		return set(self.errorMask)
+
+	def set_loopback(self, enable):
+		self.loopback = enable
+
+	def get_loopback(self):
+		return self.loopback
+
+	def set_receive_own(self, enable):
+		self.receiveOwn = enable
+
+	def get_receive_own(self):
+		return self.receiveOwn
+
+	########################
+	# Bus Side
+	########################
+	def setReader(self, callback, loop=None):
+		"""Register the callback that drains the queue, like loop.add_reader."""
+		self._reader = callback
+		self._loop = loop
+		if callback is not None and self._rx:
+			self._wake()
+
+	def matches(self, frame, ext):
+		if self.filters is None:
+			return True
+		for filt in self.filters:
+			if filt.exclusive == CANAddress.Standard and ext:
+				continue
+			if filt.exclusive == CANAddress.Extended and not ext:
+				continue
+			hit = (frame.addr & filt.mask) == (filt.can_id & filt.mask)
+			if hit != filt.invert:
+				return True
+		return False
+
+	def enqueue(self, item):
+		self._rx.append(item)
+		if self._reader is not None and not self._scheduled:
+			self._wake()
+
+	def _wake(self):
+		self._scheduled = True
+		(self._loop or asyncio.get_event_loop()).call_soon(self._drain)
+
+	def _drain(self):
+		self._scheduled = False
+		if self._reader is not None and self._rx:
+			self._reader()
+			if self._rx:
+				self._wake()
+
+class VirtualBus(object):
+	"""In-memory CAN bus connecting VirtualSockets.
+
+	Args:
+		name: interface name reported by the ports on this bus.
+		bitrate: None delivers frames immediately. With a bitrate every frame
+			occupies the bus for its stuffed bit length and pending frames
+			are sent lowest id first, like CAN arbitration.
+		clock: callable returning the timestamp put on frames.
+		loop: event loop used for the timed delivery.
+		restart_time: seconds a controller restart takes before the link
+			is usable again.
+	"""
+	_nextIndex = 1
+
+	def __init__(self, name="vbus0", bitrate=None, clock=time.time, loop=None, restart_time=0.01):
+		self.name = name
+		self.bitrate = bitrate
+		self.clock = clock
+		self.loop = loop
+		self.ifindex = VirtualBus._nextIndex
+		VirtualBus._nextIndex += 1
+		self.sockets = []
+		self.framesSent = 0
+		self._pending = []
+		self._seq = 0
+		self._busy = False
+		self.up = True
+		self.state = CANState.ERROR_ACTIVE
+		self.restart_time = restart_time
+		self.restarts = 0
+		self._linkListeners = []
+		self._restarting = None
+
+	def attach(self, sock):
+		if sock not in self.sockets:
+			self.sockets.append(sock)
+
+	def detach(self, sock):
+		if sock in self.sockets:
+			self.sockets.remove(sock)
+
+	def transmit(self, sender, frame, ext=False):
+		"""Put a frame on the bus on behalf of `sender` (None for the bus itself)."""
+		ext = ext or frame.addr > CAN_SFF_MASK
+		if self.bitrate is None:
+			self._deliver(sender, frame, ext)
+			return
+		key = (frame.addr >> 18, 1, frame.addr & 0x3FFFF, frame.rtr) if ext else (frame.addr, 0, 0, frame.rtr)
+		heapq.heappush(self._pending, (key, self._seq, sender, frame, ext))
+		self._seq += 1
+		if not self._busy:
+			self._arbitrate()
+
+	def inject_error(self, flags, position=None, ctl_flags=frozenset(), proto_type=frozenset(),
+			proto_loc=None, trans_error=None):
+		"""Deliver an error frame to every socket whose error mask allows it.
+
+		Args:
+			flags: set of CANErrorClass values.
+		"""
+		err = CANError(frozenset(flags), position, frozenset(ctl_flags), frozenset(proto_type), proto_loc, trans_error)
+		for sock in list(self.sockets):
+			if sock.errorMask & err.flags:
+				sock.enqueue(err)
+
+	########################
+	# Link Simulation
+	########################
+	@property
+	def usable(self):
+		return self.up and self.state not in UNUSABLE_STATES
+
+	def checkUsable(self):
+		"""Raise the OSError a kernel socket gives on a failed interface."""
+		if not self.up:
+			raise OSError(errno.ENETDOWN, "{} is down".format(self.name))
+		if self.state in UNUSABLE_STATES:
+			raise OSError(errno.ENETDOWN, "{} is {}".format(self.name, self.state.name))
+
+	def bus_off(self):
+		"""Put the controller in bus-off and send the bus-off error frame."""
+		self.state = CANState.BUS_OFF
+		self.inject_error({CANErrorClass.BusOff})
+		self._linkChanged()
+
+	def set_link(self, up):
+		"""Take the link down or bring it up like `ip link set`."""
+		self.up = up
+		if not up and self._restarting is not None:
+			self._restarting.cancel()
+			self._restarting = None
+		self._linkChanged()
+
+	def getLink(self):
+		return VirtualLink(self.name, self.ifindex, "can", False, self.up, self.up, self.state)
+
+	def restartLink(self, link=None):
+		"""Bring the link up or restart the controller after `restart_time`."""
+		if not self.up:
+			self.set_link(True)
+		elif self.state in UNUSABLE_STATES and self._restarting is None:
+			loop = self.loop or asyncio.get_event_loop()
+			self._restarting = loop.call_later(self.restart_time, self._restarted)
+
+	def monitor(self, callback):
+		"""Call `callback(link)` on every link change, like LinkMonitor.
+
+		Returns:
+			object whose `stop()` removes the callback.
+		"""
+		return _LinkListener(self, callback)
+
+	########################
+	# Internal Methods
+	########################
+	def _restarted(self):
+		self._restarting = None
+		self.restarts += 1
+		self.state = CANState.ERROR_ACTIVE
+		self._linkChanged()
+
+	def _linkChanged(self):
+		link = self.getLink()
+		for callback in list(self._linkListeners):
+			callback(link)
+
+	def _arbitrate(self):
+		if not self._pending:
+			self._busy = False
+			return
+		self._busy = True
+		_, _, sender, frame, ext = heapq.heappop(self._pending)
+		duration = frame_bit_length(frame.addr, frame.data, ext, frame.rtr) / self.bitrate
+		loop = self.loop or asyncio.get_event_loop()
+		loop.call_later(duration, self._complete, sender, frame, ext)
+
+	def _complete(self, sender, frame, ext):
+		self._deliver(sender, frame, ext)
+		self._arbitrate()
+
+	def _deliver(self, sender, frame, ext):
+		ts = self.clock()
+		self.framesSent += 1
+		for sock in self.sockets:
+			if sock is sender:
+				if not sock.receiveOwn:
+					continue
+			elif sender is not None and not sender.loopback:
+				continue
+			if sock.matches(frame, ext):
+				sock.enqueue(CANFrame(frame.data, frame.addr, frame.rtr, ts, self.name))
+
+class _LinkListener(object):
+
+	def __init__(self, bus, callback):
+		self.bus = bus
+		self.callback = callback
+		bus._linkListeners.append(callback)
+
+	def stop(self):
+		if self.callback in self.bus._linkListeners:
+			self.bus._linkListeners.remove(self.callback)
+
+class VirtualCANPort(CANPort):
+	"""CANPort running on a VirtualBus instead of a kernel interface."""
+
+	def __init__(self, bus, proto, loop=None):
+		super(VirtualCANPort, self).__init__(bus.name, proto, loop)
+		self.bus = bus
+
+	def linkProbe(self):
+		return self.bus
+
+	def _bindSocket(self):
+		skt = VirtualSocket(self.bus)
+		self._configureSocket(skt)
+		skt.bind(self.ifname)
+
+		self.socket = skt
+		self.fileno = None
+
+	def _startReading(self):
+		self.socket.setReader(self.doRead, self.loop)
+
+	def _stopReading(self):
+		self.socket.setReader(None)
@@ -35,15 +35,16 @@ Two types of service are defined
 		the request to change a specific protocol has completed (successfully or not).
 """
 
+import errno
 import logging
 import struct
 import asyncio
-import struct
 from collections import deque, namedtuple
 from enum import Enum
 from ..can.CANProtocol import CANProtocol
-from ..can.SocketCAN import CANFilter, CANFrame
+from ..can.SocketCAN import CANFilter, CANFrame, FRAME_LEN
 from ..tools.bitmask import BM
+from ..tools.TimerService import get_timer_service
 
 #####################################################
 ### Service Data Unit Definitions ###
@@ -251,6 +252,7 @@ class N_Result(Enum):
 	N_UNEXP_PDU = 0x07
 	N_WFT_OVRN = 0x08
 	N_ERROR = 0x09
+	N_BUFFER_OVFLW = 0x0A
 
 class Result_ChangeParameter(Enum):
 	"""
@@ -336,6 +338,15 @@ N_PDU = namedtuple("N_PDU", ["n_ai", "n_pci", "n_data"])
 N_PCITYPE_MASK = 0xF0
 LEN_MASK = 0x0F
 LENGTH_OFFSET = 0
+SN_MASK = 0x0F
+
+#payload sizes for classical CAN with normal addressing
+SF_DL_MAX = 7
+FF_DL_MAX = 0xFFF #largest length that fits the 12 bit FF_DL, above this the escape sequence is used
+FF_DATA_LEN = 6
+FF_ESC_DATA_LEN = 2
+CF_DATA_LEN = 7
+N_WFT_MAX = 10 #number of FC.WAIT frames we accept in a row before giving up
 
 class N_PCItype(Enum):
 	SF_N_PDU = 0x00
@@ -343,9 +354,54 @@ class N_PCItype(Enum):
 	CF_N_PDU = 0x20
 	FC_N_PDU = 0x30
 
+class FlowStatus(Enum):
+	"""FlowStatus (FS) values carried in the low nibble of a FC N_PCI"""
+	ContinueToSend = 0x00
+	Wait = 0x01
+	Overflow = 0x02
+
+def decode_st_min(st_min):
+	"""Convert a SeparationTime (STmin) byte into seconds.
+
+	0x00-0x7F are milliseconds, 0xF1-0xF9 are 100-900 microseconds. Reserved
+	values shall be interpreted as the longest valid value, 127ms.
+	"""
+	if st_min <= 0x7F:
+		return st_min / 1000.0
+	if 0xF1 <= st_min <= 0xF9:
+		return (st_min - 0xF0) / 10000.0
+	return 0x7F / 1000.0
+
+class N_USDataError(RuntimeError):
+	"""Raised when an N_USData.request does not complete with N_OK"""
+	def __init__(self, result, msg=None):
+		super(N_USDataError, self).__init__(msg or result.name)
+		self.result = result
+
 class DoCANProtocol(CANProtocol):
+	"""ISO 15765-2 transport over a CANPort.
+
+	Segmented messages are sent with `send` (N_USData.request) and completed
+	messages are handed to `messageReceived` (N_USData.indication), which by
+	default queues them for `recv`. Only classical CAN with normal addressing
+	is supported.
+	"""
 
-	def __init__(self, node_id=None, n_ai_type=N_TAtype.N_TAtypeFunctionalCAN, min_period=None, timeout=5.0):
+	def __init__(self, node_id=None, n_ai_type=N_TAtype.N_TAtypeFunctionalCAN, min_period=None, timeout=5.0,
+			tx_id=None, rx_id=None, block_size=0, st_min=0, padding=None, max_rx_size=4095):
+		"""DoCANProtocol Constructor
+
+		Args:
+			tx_id: CAN id used for frames we send (requests and flow control).
+			rx_id: CAN id of the frames we accept, None accepts every frame.
+			block_size: BS value we advertise in our FlowControl frames, 0
+				lets the sender stream the whole message without waiting.
+			st_min: STmin value we advertise in our FlowControl frames.
+			padding: optional byte value used to pad frames to 8 bytes.
+			max_rx_size: largest FF_DL we accept, longer messages are refused
+				with a FlowControl Overflow before any buffer is allocated.
+				None accepts up to the 4 GiB FF_DL escape allows.
+		"""
 		CANProtocol.__init__(self)
 		if min_period:
 			assert min_period > 0.0, "Invalid MinPeriod: must be positive"
@@ -355,48 +411,332 @@ class DoCANProtocol(CANProtocol):
 		self._data = None
 		self._waitDone = None
 		self.n_ai_type=n_ai_type
-		if self.n_ai_type != N_TAtype.N_TAtypeFunctionalCAN:
+		if self.n_ai_type not in (N_TAtype.N_TAtypePhysicalCAN, N_TAtype.N_TAtypeFunctionalCAN):
 			raise Exception(f"Address type not supported: {self.n_ai_type}")
+		self._defTO = timeout
+
+		self.tx_id = tx_id
+		self.rx_id = rx_id
+		self.block_size = block_size
+		self.st_min = st_min
+		self.padding = padding
+		self.max_rx_size = max_rx_size
+
+		#network layer timing parameters (seconds)
+		self.N_As = 1.0
+		self.N_Bs = 1.0
+		self.N_Cr = 1.0
+
+		#shared timer wheel, the N_Cr timer is re-armed on every consecutive frame
+		self._timers = None
+
+		#reception state for a segmented message
+		self._rx_buf = None
+		self._rx_pos = 0
+		self._rx_sn = 0
+		self._rx_block = 0
+		self._rx_timer = None
+
+		#transmission state
+		self._tx_lock = None
+		self._fc_waiter = None
+		self._pending_fc = None
+
+		self._rx_queue = None
 
 	def set_default_timeout(self, timeout):
 		assert timeout > 0.0, "Invalid Timeout - must be positive"
 		self._defTO = timeout  # seconds
+
+	def getFilters(self):
+		if self.rx_id is None:
+			return []
+		return [CANFilter(self.rx_id, CANFilter.SFF_MASK)]
 	
 	########################
 	# CANProtocol Interface
 	########################
 	def startProtocol(self):
-		#self.state_machine = await self.create()
-		#await self.state_machine.enter_state(self.States.idle)
-		pass
-		
+		logging.info(f"{self.name} Waiting for frames.")
 	
 	async def stopProtocol(self):
-		await self.state_machine.trigger_event(self.state_machine.stop)
+		self._abort_reception()
+		if self._fc_waiter is not None and not self._fc_waiter.done():
+			self._fc_waiter.cancel()
 
 	async def frameReceived(self, frame):
-		print(frame)
+		if self.rx_id is not None and frame.addr != self.rx_id:
+			return
+		self.n_pduReceived(frame)
 
 	########################
-	# State Machine
-	########################	
-	@asyncio.coroutine
-	def idle(self):
-		logging.info(f"{self.name} Waiting for frames.")
-	
-	@asyncio.coroutine
-	def frame_recieved(self, frame):
-		pci_type, length = self._get_pci_type(frame)
-		#NOTE CANFD can have the payload be greater than 8 bytes but I assume we're using classic CAN
-		if pci_type == N_PCItype.SF_N_PDU & length <= 8:
-			self.process_single_frame(frame)
-		elif pci_type != N_PCItype.SF_N_PDU:
-		#@TODO implement logic for other N_PCItypes
-			logging.warning(f"N_PCItype not implemented {pci_type}")
-			pass	
+	# N_USData Services
+	########################
+	async def send(self, data):
+		"""N_USData.request - send a message, segmenting it if necessary.
+
+		Returns once the last frame has been handed to the socket.
+
+		Raises:
+			N_USDataError if the receiver rejects or stops responding to the
+			transfer.
+		"""
+		async with self._get_tx_lock():
+			length = len(data)
+			if length <= SF_DL_MAX:
+				await self._send_frame(bytes([length]) + data)
+				return
+
+			if length <= FF_DL_MAX:
+				pci = bytes([N_PCItype.FF_N_PDU.value | (length >> 8), length & 0xFF])
+				pos = FF_DATA_LEN
+			else:
+				pci = bytes([N_PCItype.FF_N_PDU.value, 0x00]) + struct.pack(">I", length)
+				pos = FF_ESC_DATA_LEN
+
+			view = memoryview(data)
+			self._pending_fc = None
+			await self._send_frame(pci + view[:pos])
+
+			sn = 1
+			while pos < length:
+				bs, st_min = await self._wait_flow_control()
+				sep = decode_st_min(st_min)
+				count = 0
+				while pos < length and (bs == 0 or count < bs):
+					if count and sep:
+						await asyncio.sleep(sep)
+					await self._send_frame(bytes([N_PCItype.CF_N_PDU.value | sn]) + view[pos:pos + CF_DATA_LEN])
+					pos += CF_DATA_LEN
+					sn = (sn + 1) & SN_MASK
+					count += 1
+
+	async def recv(self, timeout=None):
+		"""Wait for the next message delivered by N_USData.indication.
+
+		Raises:
+			asyncio.TimeoutError if nothing arrives within `timeout` seconds.
+		"""
+		if timeout is None:
+			timeout = self._defTO
+		queue = self._get_rx_queue()
+		if not queue.empty():
+			return queue.get_nowait()
+		#P2 waits of UDS clients run through here, keep them on the timer wheel
+		getter = asyncio.ensure_future(queue.get())
+		expired = []
+		timer = self._get_timers().call_later(timeout, self._recv_timeout, getter, expired)
+		try:
+			return await getter
+		except asyncio.CancelledError:
+			if expired:
+				raise asyncio.TimeoutError()
+			raise
+		finally:
+			timer.cancel()
+
+	def messageReceived(self, data):
+		"""N_USData.indication - called with every completed message.
+
+		The default implementation queues the message for `recv`.
+		"""
+		self._get_rx_queue().put_nowait(data)
+
+	def messageError(self, result):
+		"""N_USData.indication with a result other than N_OK."""
+		logging.warning(f"{self.name} reception failed: {result.name}")
+
+	def firstFrameReceived(self, length):
+		"""N_USData_FF.indication - a segmented message of `length` bytes started."""
+		pass
+
+	########################
+	# N_PDU Handling
+	########################
+	def n_pduReceived(self, frame):
+		data = frame.data
+		if not data:
+			return
+		pci_type = data[LENGTH_OFFSET] & N_PCITYPE_MASK
+		if pci_type == N_PCItype.CF_N_PDU.value:
+			self._on_consecutive_frame(data)
+		elif pci_type == N_PCItype.FC_N_PDU.value:
+			self._on_flow_control(data)
+		elif pci_type == N_PCItype.SF_N_PDU.value:
+			self._on_single_frame(frame)
+		elif pci_type == N_PCItype.FF_N_PDU.value:
+			self._on_first_frame(data)
 		else:
-			logging.warning(f"Data length too large for N_PCItype {length}")
+			logging.debug(f"{self.name} ignoring N_PCItype {pci_type:#x}")
 
+	def _on_single_frame(self, frame):
+		data = frame.data
+		length = data[LENGTH_OFFSET] & LEN_MASK
+		#NOTE CANFD can have the payload be greater than 8 bytes but I assume we're using classic CAN
+		if length == 0 or length > len(data) - 1:
+			logging.warning(f"{self.name} invalid SF_DL {length}")
+			return
+		if self._rx_buf is not None:
+			self._abort_reception(N_Result.N_UNEXP_PDU)
+		self.process_single_frame(frame)
+		self.messageReceived(bytes(data[1:1 + length]))
+
+	def _on_first_frame(self, data):
+		if len(data) < 8:
+			return
+		length = ((data[0] & LEN_MASK) << 8) | data[1]
+		start = 2
+		if length == 0:
+			length = struct.unpack_from(">I", data, 2)[0]
+			start = 6
+		if length <= SF_DL_MAX:
+			logging.warning(f"{self.name} invalid FF_DL {length}")
+			return
+		if self._rx_buf is not None:
+			self._abort_reception(N_Result.N_UNEXP_PDU)
+		if self.max_rx_size is not None and length > self.max_rx_size:
+			logging.warning(f"{self.name} FF_DL {length} exceeds {self.max_rx_size}, overflow")
+			self._send_flow_control(FlowStatus.Overflow)
+			return
+
+		self._rx_buf = bytearray(length)
+		chunk = data[start:]
+		self._rx_buf[:len(chunk)] = chunk
+		self._rx_pos = len(chunk)
+		self._rx_sn = 1
+		self._rx_block = 0
+		self.firstFrameReceived(length)
+		self._send_flow_control(FlowStatus.ContinueToSend)
+		self._arm_rx_timer()
+
+	def _on_consecutive_frame(self, data):
+		if self._rx_buf is None:
+			return
+		sn = data[0] & SN_MASK
+		if sn != self._rx_sn:
+			self._abort_reception(N_Result.N_WRONG_SN)
+			return
+
+		buf = self._rx_buf
+		pos = self._rx_pos
+		end = min(len(buf), pos + len(data) - 1)
+		buf[pos:end] = data[1:1 + end - pos]
+		self._rx_pos = end
+		self._rx_sn = (sn + 1) & SN_MASK
+
+		if end == len(buf):
+			self._cancel_rx_timer()
+			self._rx_buf = None
+			self.messageReceived(bytes(buf))
+			return
+
+		self._rx_block += 1
+		if self.block_size and self._rx_block >= self.block_size:
+			self._rx_block = 0
+			self._send_flow_control(FlowStatus.ContinueToSend)
+		self._arm_rx_timer()
+
+	def _on_flow_control(self, data):
+		if len(data) < 3:
+			return
+		fc = (data[0] & LEN_MASK, data[1], data[2])
+		waiter = self._fc_waiter
+		if waiter is not None and not waiter.done():
+			waiter.set_result(fc)
+		else:
+			self._pending_fc = fc
+
+	async def _wait_flow_control(self):
+		waits = 0
+		while True:
+			fc = self._pending_fc
+			self._pending_fc = None
+			if fc is None:
+				waiter = self._fc_waiter = asyncio.get_event_loop().create_future()
+				timer = self._get_timers().call_later(self.N_Bs, self._fc_timeout, waiter)
+				try:
+					fc = await waiter
+				finally:
+					timer.cancel()
+					self._fc_waiter = None
+
+			fs, bs, st_min = fc
+			if fs == FlowStatus.ContinueToSend.value:
+				return bs, st_min
+			if fs == FlowStatus.Wait.value:
+				waits += 1
+				if waits > N_WFT_MAX:
+					raise N_USDataError(N_Result.N_WFT_OVRN)
+				continue
+			if fs == FlowStatus.Overflow.value:
+				raise N_USDataError(N_Result.N_BUFFER_OVFLW)
+			raise N_USDataError(N_Result.N_INVALID_FS)
+
+	def _recv_timeout(self, getter, expired):
+		if not getter.done():
+			expired.append(True)
+			getter.cancel()
+
+	def _fc_timeout(self, waiter):
+		if not waiter.done():
+			waiter.set_exception(N_USDataError(N_Result.N_TIMEOUT_Bs))
+
+	def _send_flow_control(self, status):
+		self._write(bytes([N_PCItype.FC_N_PDU.value | status.value, self.block_size, self.st_min]))
+
+	def _abort_reception(self, result=None):
+		self._cancel_rx_timer()
+		if self._rx_buf is None:
+			return
+		self._rx_buf = None
+		if result is not None:
+			self.messageError(result)
+
+	def _arm_rx_timer(self):
+		if self._rx_timer is None:
+			self._rx_timer = self._get_timers().call_later(self.N_Cr, self._abort_reception, N_Result.N_TIMEOUT_Cr)
+		else:
+			#the same timer is moved for every frame of a message
+			self._timers.rearm(self._rx_timer, self.N_Cr)
+
+	def _cancel_rx_timer(self):
+		if self._rx_timer is not None:
+			self._rx_timer.cancel()
+
+	def _write(self, payload):
+		if self.padding is not None and len(payload) < FRAME_LEN:
+			payload = payload + bytes([self.padding]) * (FRAME_LEN - len(payload))
+		self.transport.write(CANFrame(payload, self.tx_id, False))
+
+	async def _send_frame(self, payload):
+		"""Write one frame, backing off while the interface TX queue is full."""
+		loop = asyncio.get_event_loop()
+		deadline = loop.time() + self.N_As
+		while True:
+			try:
+				self._write(payload)
+				return
+			except OSError as exc:
+				if exc.errno not in (errno.ENOBUFS, errno.EAGAIN):
+					raise
+				if loop.time() > deadline:
+					raise N_USDataError(N_Result.N_TIMEOUT_A)
+				await asyncio.sleep(0.001)
+
+	def _get_timers(self):
+		if self._timers is None:
+			self._timers = get_timer_service()
+		return self._timers
+
+	def _get_tx_lock(self):
+		if self._tx_lock is None:
+			self._tx_lock = asyncio.Lock()
+		return self._tx_lock
+
+	def _get_rx_queue(self):
+		if self._rx_queue is None:
+			self._rx_queue = asyncio.Queue()
+		return self._rx_queue
 		
 	########################
 	# Internal Methods
@@ -0,0 +1,321 @@
+"""Simulated ECUs for OBD-II and UDS testing.
+
+File: ECUSimulator.py
+
+Description:
+	ECUSimulator is a DoCANProtocol that answers diagnostic requests from an
+	ECUModel: OBD-II mode 01 PIDs and mode 09 info types, and the UDS services
+	UDSClient uses (session control, tester present, ReadDataByIdentifier,
+	ReadMemoryByAddress and RequestUpload/TransferData/RequestTransferExit).
+	Its ISO-TP side uses the BS/STmin given to the constructor, and an
+	ECUFaults instance can delay responses, answer with NRC 0x78 first,
+	corrupt ConsecutiveFrame sequence numbers or drop FlowControl frames.
+
+	The simulators run on a vcan interface through CANPort or in process on
+	a VirtualBus, see `start_ecus`.
+"""
+
+import asyncio
+import logging
+import random
+import struct
+
+from ..can.SocketCAN import CANFilter
+from ..obd2.DoCANProtocol import DoCANProtocol, N_PCItype, N_TAtype
+from ..uds.UDSClient import (
+	NEGATIVE_RESPONSE,
+	NRC,
+	POSITIVE_RESPONSE_OFFSET,
+	SUPPRESS_POS_RSP,
+	UDSService,
+)
+
+OBD_FUNCTIONAL_ID = 0x7DF
+OBD_REQUEST_BASE = 0x7E0
+OBD_RESPONSE_OFFSET = 0x08
+OBD_SHOW_CURRENT_DATA = 0x01
+OBD_VEHICLE_INFO = 0x09
+MAX_UPLOAD_BLOCK = 0x402
+
+class ECUModel(object):
+	"""Data served by a simulated ECU.
+
+	Values are bytes or callables returning bytes, evaluated per request.
+
+	Args:
+		pids: dict of mode 01 PID -> data bytes.
+		infotypes: dict of mode 09 info type -> data bytes.
+		dids: dict of UDS DID -> record bytes.
+		memory: bytes readable with ReadMemoryByAddress and RequestUpload.
+		memory_base: address of the first byte of `memory`.
+		p2: P2server (seconds) reported on session changes.
+		p2_star: P2*server (seconds) reported on session changes.
+	"""
+
+	def __init__(self, pids=None, infotypes=None, dids=None, memory=b"", memory_base=0, p2=0.05, p2_star=5.0):
+		self.pids = dict(pids or {})
+		self.infotypes = dict(infotypes or {})
+		self.dids = dict(dids or {})
+		self.memory = memory
+		self.memory_base = memory_base
+		self.p2 = p2
+		self.p2_star = p2_star
+
+	@staticmethod
+	def value(val):
+		return val() if callable(val) else val
+
+	def supported_pids(self, base):
+		"""Mode 01 support bitmap for PIDs base+1 .. base+0x20."""
+		bits = 0
+		for pid in self.pids:
+			if base < pid <= base + 0x20:
+				bits |= 1 << (0x20 - (pid - base))
+		#announce the next range if anything above it is supported
+		if any(pid > base + 0x20 for pid in self.pids):
+			bits |= 1
+		return struct.pack(">I", bits)
+
+	def read_memory(self, address, size):
+		start = address - self.memory_base
+		if start < 0 or size <= 0 or start + size > len(self.memory):
+			return None
+		return self.memory[start:start + size]
+
+class ECUFaults(object):
+	"""Fault injection settings.
+
+	Args:
+		response_delay: seconds between a request and its response.
+		response_pending: number of NRC 0x78 sent before each UDS response.
+		pending_interval: seconds between the NRC 0x78 responses.
+		wrong_sn: probability of corrupting the SN of a ConsecutiveFrame.
+		drop_fc: probability of not sending a FlowControl frame.
+		seed: seed for the random faults.
+	"""
+
+	def __init__(self, response_delay=0.0, response_pending=0, pending_interval=0.01,
+			wrong_sn=0.0, drop_fc=0.0, seed=None):
+		self.response_delay = response_delay
+		self.response_pending = response_pending
+		self.pending_interval = pending_interval
+		self.wrong_sn = wrong_sn
+		self.drop_fc = drop_fc
+		self.rng = random.Random(seed)
+
+class ECUSimulator(DoCANProtocol):
+	"""Diagnostic responder for one simulated ECU.
+
+	Args:
+		index: node number, the ECU listens on 0x7E0+index and answers on
+			0x7E8+index unless `rx_id`/`tx_id` are given.
+		model: ECUModel with the data to serve.
+		faults: optional ECUFaults.
+		functional: also answer OBD requests on 0x7DF.
+	"""
+
+	def __init__(self, index=0, model=None, faults=None, rx_id=None, tx_id=None, functional=True,
+			block_size=0, st_min=0, padding=None):
+		rx_id = OBD_REQUEST_BASE + index if rx_id is None else rx_id
+		tx_id = rx_id + OBD_RESPONSE_OFFSET if tx_id is None else tx_id
+		super(ECUSimulator, self).__init__(
+			node_id=index,
+			n_ai_type=N_TAtype.N_TAtypePhysicalCAN,
+			tx_id=tx_id,
+			rx_id=rx_id,
+			block_size=block_size,
+			st_min=st_min,
+			padding=padding,
+		)
+		self.name = "ecu.{}.sim".format(index)
+		self.model = model or ECUModel()
+		self.faults = faults or ECUFaults()
+		self.functional = functional
+		self.requests = 0
+		self._upload = None
+		self._tasks = set()
+
+	def getFilters(self):
+		filters = [CANFilter(self.rx_id, CANFilter.SFF_MASK)]
+		if self.functional:
+			filters.append(CANFilter(OBD_FUNCTIONAL_ID, CANFilter.SFF_MASK))
+		return filters
+
+	async def frameReceived(self, frame):
+		if frame.addr == self.rx_id or (self.functional and frame.addr == OBD_FUNCTIONAL_ID):
+			self.n_pduReceived(frame)
+
+	async def stopProtocol(self):
+		for task in list(self._tasks):
+			task.cancel()
+		await super(ECUSimulator, self).stopProtocol()
+
+	def messageReceived(self, data):
+		self.requests += 1
+		task = asyncio.ensure_future(self._respond(bytes(data)))
+		self._tasks.add(task)
+		task.add_done_callback(self._tasks.discard)
+
+	########################
+	# Fault Injection
+	########################
+	def _send_flow_control(self, status):
+		if self.faults.drop_fc and self.faults.rng.random() < self.faults.drop_fc:
+			return
+		super(ECUSimulator, self)._send_flow_control(status)
+
+	async def _send_frame(self, payload):
+		if (
+			self.faults.wrong_sn
+			and payload[0] & 0xF0 == N_PCItype.CF_N_PDU.value
+			and self.faults.rng.random() < self.faults.wrong_sn
+		):
+			payload = bytes([payload[0] ^ 0x01]) + payload[1:]
+		await super(ECUSimulator, self)._send_frame(payload)
+
+	########################
+	# Request Handling
+	########################
+	async def _respond(self, req):
+		try:
+			if self.faults.response_delay:
+				await asyncio.sleep(self.faults.response_delay)
+			sid = req[0]
+			if sid in (OBD_SHOW_CURRENT_DATA, OBD_VEHICLE_INFO):
+				rsp = self._obd(req)
+			else:
+				for _ in range(self.faults.response_pending):
+					await self.send(bytes([NEGATIVE_RESPONSE, sid, NRC.RequestCorrectlyReceivedResponsePending]))
+					await asyncio.sleep(self.faults.pending_interval)
+				rsp = self._uds(req)
+			if rsp is not None:
+				await self.send(rsp)
+		except asyncio.CancelledError:
+			raise
+		except Exception as exc:
+			logging.warning("{} request {} failed: {}".format(self.name, req.hex(), exc))
+
+	def _obd(self, req):
+		if req[0] == OBD_SHOW_CURRENT_DATA:
+			rsp = bytearray([OBD_SHOW_CURRENT_DATA + POSITIVE_RESPONSE_OFFSET])
+			for pid in req[1:7]:
+				if pid % 0x20 == 0:
+					data = self.model.supported_pids(pid)
+				elif pid in self.model.pids:
+					data = ECUModel.value(self.model.pids[pid])
+				else:
+					continue
+				rsp.append(pid)
+				rsp += data
+			#OBD responders stay silent when nothing requested is supported
+			return bytes(rsp) if len(rsp) > 1 else None
+
+		if len(req) < 2:
+			return None
+		info = req[1]
+		if info == 0x00:
+			bits = 0
+			for key in self.model.infotypes:
+				if 0 < key <= 0x20:
+					bits |= 1 << (0x20 - key)
+			data = struct.pack(">I", bits)
+		elif info in self.model.infotypes:
+			data = bytes([0x01]) + ECUModel.value(self.model.infotypes[info])
+		else:
+			return None
+		return bytes([OBD_VEHICLE_INFO + POSITIVE_RESPONSE_OFFSET, info]) + data
+
+	def _negative(self, sid, code):
+		return bytes([NEGATIVE_RESPONSE, sid, code])
+
+	def _uds(self, req):
+		sid = req[0]
+		positive = sid + POSITIVE_RESPONSE_OFFSET
+		if sid == UDSService.DiagnosticSessionControl:
+			if len(req) != 2:
+				return self._negative(sid, NRC.IncorrectMessageLengthOrInvalidFormat)
+			timing = struct.pack(">HH", int(self.model.p2 * 1000), int(self.model.p2_star * 100))
+			return bytes([positive, req[1] & 0x7F]) + timing
+
+		if sid == UDSService.TesterPresent:
+			if len(req) == 2 and req[1] & SUPPRESS_POS_RSP:
+				return None
+			return bytes([positive, 0x00])
+
+		if sid == UDSService.ReadDataByIdentifier:
+			if len(req) < 3 or len(req) % 2 != 1:
+				return self._negative(sid, NRC.IncorrectMessageLengthOrInvalidFormat)
+			rsp = bytearray([positive])
+			for pos in range(1, len(req), 2):
+				did = struct.unpack_from(">H", req, pos)[0]
+				if did not in self.model.dids:
+					return self._negative(sid, NRC.RequestOutOfRange)
+				rsp += req[pos:pos + 2] + ECUModel.value(self.model.dids[did])
+			return bytes(rsp)
+
+		if sid in (UDSService.ReadMemoryByAddress, UDSService.RequestUpload):
+			offset = 1 if sid == UDSService.ReadMemoryByAddress else 2
+			if len(req) <= offset:
+				return self._negative(sid, NRC.IncorrectMessageLengthOrInvalidFormat)
+			alfid = req[offset]
+			addrLen = alfid & 0x0F
+			sizeLen = alfid >> 4
+			if len(req) != offset + 1 + addrLen + sizeLen:
+				return self._negative(sid, NRC.IncorrectMessageLengthOrInvalidFormat)
+			address = int.from_bytes(req[offset + 1:offset + 1 + addrLen], "big")
+			size = int.from_bytes(req[offset + 1 + addrLen:], "big")
+			data = self.model.read_memory(address, size)
+			if data is None:
+				return self._negative(sid, NRC.RequestOutOfRange)
+			if sid == UDSService.ReadMemoryByAddress:
+				return bytes([positive]) + data
+			self._upload = [data, 0, 1]
+			return bytes([positive, 0x20]) + struct.pack(">H", MAX_UPLOAD_BLOCK)
+
+		if sid == UDSService.TransferData:
+			if self._upload is None:
+				return self._negative(sid, NRC.RequestSequenceError)
+			data, pos, counter = self._upload
+			if len(req) != 2:
+				return self._negative(sid, NRC.IncorrectMessageLengthOrInvalidFormat)
+			if req[1] == (counter - 1) & 0xFF and pos > 0:
+				#repeated request, send the previous block again
+				chunk = MAX_UPLOAD_BLOCK - 2
+				prev = pos - chunk if pos % chunk == 0 else pos - pos % chunk
+				return bytes([positive, req[1]]) + data[prev:pos]
+			if req[1] != counter:
+				return self._negative(sid, NRC.WrongBlockSequenceCounter)
+			block = data[pos:pos + MAX_UPLOAD_BLOCK - 2]
+			self._upload = [data, pos + len(block), (counter + 1) & 0xFF]
+			return bytes([positive, req[1]]) + block
+
+		if sid == UDSService.RequestTransferExit:
+			if self._upload is None:
+				return self._negative(sid, NRC.RequestSequenceError)
+			self._upload = None
+			return bytes([positive])
+
+		return self._negative(sid, NRC.ServiceNotSupported)
+
+def start_ecus(target, ecus, loop=None):
+	"""Connect simulators to a bus.
+
+	Args:
+		target: VirtualBus instance or the name of a CAN interface.
+		ecus: list of ECUSimulator objects.
+
+	Returns:
+		list of the started ports.
+	"""
+	from ..can.CANPort import CANPort
+	from ..can.VirtualBus import VirtualBus, VirtualCANPort
+
+	ports = []
+	for ecu in ecus:
+		if isinstance(target, VirtualBus):
+			port = VirtualCANPort(target, ecu, loop)
+		else:
+			port = CANPort(target, ecu, loop)
+		port.startListening()
+		ports.append(port)
+	return ports
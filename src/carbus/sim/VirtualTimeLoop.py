@@ -0,0 +1,93 @@
+"""Virtual time asyncio event loop.
+
+File: VirtualTimeLoop.py
+
+Description:
+	An asyncio event loop whose clock only moves when every task is idle.
+	Whenever the loop would block waiting for its next timer it jumps the
+	clock to that timer instead, so protocol timeouts, cyclic traffic and
+	hours of simulated driving run as fast as the callbacks execute, and in
+	the same order every time.
+
+	Real file descriptors still work: they are polled without blocking
+	before the clock is advanced, and the loop only blocks for real when
+	there is no timer left at all.
+
+Example:
+	loop = VirtualTimeLoop()
+	bus = VirtualBus(clock=loop.clock, loop=loop)
+	loop.run_until_complete(scenario(bus))
+"""
+
+import asyncio
+import selectors
+import time
+
+class _VirtualSelector(object):
+	"""Selector wrapper that turns blocking selects into clock jumps."""
+
+	def __init__(self, selector, loop):
+		self._selector = selector
+		self._loop = loop
+
+	def select(self, timeout=None):
+		events = self._selector.select(0)
+		if events or timeout == 0:
+			return events
+		if timeout is None:
+			#nothing scheduled, only real I/O can wake us up
+			return self._selector.select(None)
+		self._loop.advance(timeout)
+		return []
+
+	def __getattr__(self, name):
+		return getattr(self._selector, name)
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+	"""SelectorEventLoop running on a simulated clock.
+
+	Args:
+		start: initial value of `time()` (monotonic seconds).
+		epoch: wall clock time that corresponds to `start`, used by `clock`
+			for frame timestamps. Defaults to the real time at creation.
+	"""
+
+	def __init__(self, start=0.0, epoch=None):
+		self._virtualTime = start
+		self._start = start
+		self._epoch = time.time() if epoch is None else epoch
+		super(VirtualTimeLoop, self).__init__(_VirtualSelector(selectors.DefaultSelector(), self))
+
+	def time(self):
+		return self._virtualTime
+
+	def clock(self):
+		"""Simulated wall clock, a drop-in replacement for `time.time`."""
+		return self._epoch + (self._virtualTime - self._start)
+
+	def advance(self, seconds):
+		"""Move the clock forward. Timers that become due run on the next iteration."""
+		if seconds > 0:
+			self._virtualTime += seconds
+
+	@property
+	def elapsed(self):
+		"""Simulated seconds since the loop was created."""
+		return self._virtualTime - self._start
+
+def run_simulation(main, start=0.0, epoch=None):
+	"""Run a coroutine to completion on a fresh VirtualTimeLoop.
+
+	Args:
+		main: coroutine function called with the loop as its only argument.
+
+	Returns:
+		the coroutine result.
+	"""
+	loop = VirtualTimeLoop(start, epoch)
+	asyncio.set_event_loop(loop)
+	try:
+		return loop.run_until_complete(main(loop))
+	finally:
+		asyncio.set_event_loop(None)
+		loop.close()
@@ -0,0 +1,257 @@
+"""Bus load calculation.
+
+File: BusLoad.py
+
+Description:
+	Computes the exact number of bits a frame occupies on the wire, stuff
+	bits included, and aggregates the bus utilization over sliding windows.
+	BusLoad is a CANPort stage, frames we send can be added with `account`.
+	BusLoadBudget lets a transmitter throttle itself to a target load.
+
+	Stuffing is applied from SOF to the end of the CRC sequence: after five
+	consecutive bits of the same level a complementary bit is inserted, and
+	the stuff bit itself takes part in the following run. The fixed-form tail
+	(CRC delimiter, ACK slot and delimiter, EOF and intermission) is never
+	stuffed. CAN FD frames use a different CRC and fixed stuff bits and are
+	not handled yet.
+"""
+
+import array
+import asyncio
+import time
+from collections import deque
+
+CRC15_POLY = 0x4599
+#CRC delimiter + ACK slot + ACK delimiter + EOF + intermission
+FRAME_TAIL_BITS = 1 + 1 + 1 + 7 + 3
+
+def crc15(bits):
+	"""CRC-15/CAN over a sequence of 0/1 values."""
+	crc = 0
+	for bit in bits:
+		nxt = bit ^ ((crc >> 14) & 1)
+		crc = (crc << 1) & 0x7FFF
+		if nxt:
+			crc ^= CRC15_POLY
+	return crc
+
+def _append_bits(bits, value, width):
+	for i in range(width - 1, -1, -1):
+		bits.append((value >> i) & 1)
+
+def frame_bits(addr, data, ext=False, rtr=False, dlc=None):
+	"""Build the unstuffed bit sequence from SOF to the end of the CRC.
+
+	Args:
+		addr: CAN id.
+		data: payload bytes (ignored for the data field of remote frames).
+		ext: 29-bit id.
+		rtr: remote transmission request.
+		dlc: DLC to encode, defaults to len(data).
+	"""
+	if dlc is None:
+		dlc = len(data)
+	bits = [0] #SOF
+	if ext:
+		_append_bits(bits, addr >> 18, 11)
+		bits.append(1) #SRR
+		bits.append(1) #IDE
+		_append_bits(bits, addr & 0x3FFFF, 18)
+		bits.append(1 if rtr else 0)
+		bits.extend((0, 0)) #r1, r0
+	else:
+		_append_bits(bits, addr, 11)
+		bits.append(1 if rtr else 0)
+		bits.extend((0, 0)) #IDE, r0
+	_append_bits(bits, dlc, 4)
+	if not rtr:
+		for byte in data:
+			_append_bits(bits, byte, 8)
+	_append_bits(bits, crc15(bits), 15)
+	return bits
+
+def stuff_bit_count(bits):
+	"""Count the stuff bits a transmitter inserts into `bits`."""
+	count = 0
+	run = 0
+	level = None
+	for bit in bits:
+		if bit == level:
+			run += 1
+		else:
+			level = bit
+			run = 1
+		if run == 5:
+			count += 1
+			#the stuff bit has the opposite level and starts a new run
+			level = 1 - bit
+			run = 1
+	return count
+
+def frame_bit_length(addr, data, ext=False, rtr=False):
+	"""Exact on-wire length of a classical CAN frame in bits.
+
+	Includes stuff bits and the 3 bit intermission, so back-to-back frames
+	can be summed directly.
+	"""
+	bits = frame_bits(addr, data, ext, rtr)
+	return len(bits) + stuff_bit_count(bits) + FRAME_TAIL_BITS
+
+def worst_case_bit_length(dlc, ext=False):
+	"""Upper bound of a frame length with maximum stuffing."""
+	stuffable = (54 if ext else 34) + 8 * dlc
+	return stuffable + (stuffable - 1) // 4 + FRAME_TAIL_BITS
+
+class FrameLengthCache(object):
+	"""Memoized `frame_bit_length` keyed on the raw frame content.
+
+	Periodic traffic repeats the same payloads, so most lookups hit.
+	"""
+
+	def __init__(self, size=65536):
+		self.size = size
+		self._cache = {}
+
+	def length(self, addr, data, ext=False, rtr=False):
+		key = (addr, data, ext, rtr)
+		bits = self._cache.get(key)
+		if bits is None:
+			if len(self._cache) >= self.size:
+				self._cache.clear()
+			bits = frame_bit_length(addr, data, ext, rtr)
+			self._cache[key] = bits
+		return bits
+
+class BusLoad(object):
+	"""Sliding window bus utilization stage.
+
+	Time is split into `resolution` sized buckets kept in a ring, the load of
+	any window up to `window` seconds long is the bit sum of the most recent
+	buckets divided by the bit time.
+	"""
+
+	def __init__(self, bitrate=500000, window=1.0, resolution=0.01):
+		"""BusLoad Constructor
+
+		Args:
+			bitrate: nominal bitrate of the bus in bit/s.
+			window: longest window in seconds that can be queried.
+			resolution: bucket width in seconds.
+		"""
+		self.bitrate = bitrate
+		self.resolution = resolution
+		self.nbuckets = max(1, int(round(window / resolution)))
+		self._lengths = FrameLengthCache()
+		self.reset()
+
+	def reset(self):
+		self._bits = array.array("Q", bytes(8 * self.nbuckets))
+		self._bucket = None
+		self.totalBits = 0
+		self.totalFrames = 0
+
+	def process(self, frames):
+		"""Account a batch of received CANFrame objects."""
+		length = self._lengths.length
+		bits = self._bits
+		res = self.resolution
+		n = self.nbuckets
+		ext = 0x7FF
+		now = None
+		total = 0
+		for frame in frames:
+			ts = frame.ts
+			if ts is None:
+				if now is None:
+					now = time.time()
+				ts = now
+			b = length(frame.addr, frame.data, frame.addr > ext, frame.rtr)
+			bucket = int(ts / res)
+			if bucket != self._bucket:
+				self._advance(bucket)
+			bits[bucket % n] += b
+			total += b
+		self.totalBits += total
+		self.totalFrames += len(frames)
+
+	def account(self, frame, ext=False):
+		"""Account a frame we transmitted."""
+		b = self._lengths.length(frame.addr, frame.data, ext, frame.rtr)
+		bucket = int((frame.ts or time.time()) / self.resolution)
+		if bucket != self._bucket:
+			self._advance(bucket)
+		self._bits[bucket % self.nbuckets] += b
+		self.totalBits += b
+		self.totalFrames += 1
+		return b
+
+	def load(self, window=None, now=None):
+		"""Bus utilization over the last `window` seconds.
+
+		Returns:
+			float, 1.0 is a saturated bus.
+		"""
+		if window is None:
+			window = self.nbuckets * self.resolution
+		count = min(self.nbuckets, max(1, int(round(window / self.resolution))))
+		if now is not None:
+			self._advance(int(now / self.resolution))
+		if self._bucket is None:
+			return 0.0
+		total = 0
+		for i in range(count):
+			total += self._bits[(self._bucket - i) % self.nbuckets]
+		return total / (self.bitrate * count * self.resolution)
+
+	def metrics(self):
+		return [
+			("carbus_bus_load", {}, self.load()),
+			("carbus_bus_bits_total", {}, self.totalBits),
+			("carbus_bus_frames_total", {}, self.totalFrames),
+		]
+
+	def _advance(self, bucket):
+		"""Move the ring forward, clearing the buckets we skipped."""
+		if self._bucket is None:
+			self._bucket = bucket
+			return
+		if bucket <= self._bucket:
+			return
+		n = self.nbuckets
+		for i in range(self._bucket + 1, min(bucket, self._bucket + n) + 1):
+			self._bits[i % n] = 0
+		self._bucket = bucket
+
+class BusLoadBudget(object):
+	"""Throttle for transmitters that must stay under a bus load target.
+
+	Pollers call `await budget.acquire(frame)` before each transmission. It
+	returns at once while the measured load plus our own recent traffic is
+	under `target`, otherwise it waits for the window to drain.
+	"""
+
+	def __init__(self, busload, target=0.5, window=0.1):
+		self.busload = busload
+		self.target = target
+		self.window = window
+		self._sent = deque()
+		self._sentBits = 0
+
+	async def acquire(self, frame, ext=False):
+		bits = self.busload._lengths.length(frame.addr, frame.data, ext, frame.rtr)
+		limit = self.target * self.busload.bitrate * self.window
+		while True:
+			now = time.time()
+			self._expire(now)
+			used = self.busload.load(self.window, now) * self.busload.bitrate * self.window
+			if used + self._sentBits + bits <= limit or not self._sent:
+				break
+			await asyncio.sleep(max(self.busload.resolution, self._sent[0][0] + self.window - now))
+		self._sent.append((now, bits))
+		self._sentBits += bits
+		return bits
+
+	def _expire(self, now):
+		sent = self._sent
+		while sent and sent[0][0] + self.window <= now:
+			self._sentBits -= sent.popleft()[1]
@@ -0,0 +1,124 @@
+"""candump log files
+
+File: CaptureLog.py
+
+Description:
+	Reads and writes the `candump -l` log format used by can-utils:
+
+		(1436509052.249713) can0 123#DEADBEEF
+		(1436509052.250112) can1 18FEF100#R
+
+	Ids with more than 3 hex digits are extended ids. Error frames in a log
+	are skipped when reading.
+"""
+
+import io
+
+from ..can.SocketCAN import CAN_EFF_MASK, CAN_ERR_FLAG, CAN_SFF_MASK, CANFrame
+
+def parse_line(line):
+	"""Parse one log line.
+
+	Returns:
+		CANFrame or None for blank, error frame and unparsable lines.
+	"""
+	parts = line.split()
+	if len(parts) != 3 or not parts[0].startswith("("):
+		return None
+	try:
+		ts = float(parts[0][1:-1])
+		canId, _, payload = parts[2].partition("#")
+		addr = int(canId, 16)
+	except ValueError:
+		return None
+	if addr & CAN_ERR_FLAG:
+		return None
+	ext = len(canId) > 3
+	addr &= CAN_EFF_MASK if ext else CAN_SFF_MASK
+	if payload.startswith("R"):
+		return CANFrame(b"", addr, True, ts, parts[1])
+	try:
+		data = bytes.fromhex(payload)
+	except ValueError:
+		return None
+	return CANFrame(data, addr, False, ts, parts[1])
+
+def format_frame(frame, ifname=None):
+	ifname = frame.ifname or ifname or "can0"
+	if frame.addr > CAN_SFF_MASK:
+		canId = "{:08X}".format(frame.addr)
+	else:
+		canId = "{:03X}".format(frame.addr)
+	payload = "R" if frame.rtr else bytes(frame.data).hex().upper()
+	return "({:.6f}) {} {}#{}\n".format(frame.ts or 0.0, ifname, canId, payload)
+
+class CaptureReader(object):
+	"""Iterate the frames of a candump log in file order.
+
+	Args:
+		source: path or text file object.
+		ifnames: optional collection of interfaces to keep.
+		ifname: replaces the interface name of every frame, handy to
+			tell two captures of the same interface apart when merging.
+	"""
+
+	def __init__(self, source, ifnames=None, ifname=None):
+		self.source = source
+		self.ifnames = set(ifnames) if ifnames else None
+		self.ifname = ifname
+
+	def __iter__(self):
+		if isinstance(self.source, (str, bytes)):
+			with io.open(self.source, "r") as f:
+				for frame in self._frames(f):
+					yield frame
+		else:
+			for frame in self._frames(self.source):
+				yield frame
+
+	def _frames(self, lines):
+		for line in lines:
+			frame = parse_line(line)
+			if frame is None:
+				continue
+			if self.ifnames is not None and frame.ifname not in self.ifnames:
+				continue
+			if self.ifname is not None:
+				frame.ifname = self.ifname
+			yield frame
+
+class CaptureWriter(object):
+	"""Append frames to a candump log.
+
+	Can be used as a CANPort stage (`process`) to record everything a port
+	receives.
+
+	Args:
+		dest: path or text file object.
+		ifname: interface name for frames without one.
+	"""
+
+	def __init__(self, dest, ifname=None):
+		self.ifname = ifname
+		if isinstance(dest, (str, bytes)):
+			self.file = io.open(dest, "a")
+			self._owned = True
+		else:
+			self.file = dest
+			self._owned = False
+
+	def write(self, frame):
+		self.file.write(format_frame(frame, self.ifname))
+
+	def process(self, frames):
+		ifname = self.ifname
+		self.file.write("".join(format_frame(frame, ifname) for frame in frames))
+
+	def flush(self):
+		self.file.flush()
+
+	def close(self):
+		if self._owned:
+			self.file.close()
+		else:
+			self.file.flush()
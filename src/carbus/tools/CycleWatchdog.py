@@ -0,0 +1,198 @@
+"""Cycle time watchdog
+
+File: CycleWatchdog.py
+
+Description:
+	CycleWatchdog is a CANPort stage watching periodic frames. The expected
+	period of an id is either configured or learned from its first frames.
+	When a frame is more than `tolerance` periods late, `onTimeout` is called;
+	when the id shows up again `onRecovered` is called.
+
+	All deadlines live on the timer wheel of a TimerService. A frame only
+	stores its arrival time; the id's timer is not moved per frame. When a
+	timer expires it checks the last arrival and re-arms for the remaining
+	time if the frame was seen in the meantime (the same trick ChangeFilter
+	uses), so the cost per frame is constant and independent of the number
+	of monitored ids.
+"""
+
+import asyncio
+import logging
+
+from .TimerService import TimerService, get_timer_service
+
+class _CycleState(object):
+	__slots__ = ("can_id", "period", "limit", "lastSeen", "timer", "missing", "lostAt", "learned", "first", "timeouts")
+
+	def __init__(self, can_id, period=None):
+		self.can_id = can_id
+		self.period = period
+		self.limit = None
+		self.lastSeen = None
+		self.timer = None
+		self.missing = False
+		self.lostAt = None
+		#intervals measured while learning
+		self.learned = 0
+		self.first = None
+		self.timeouts = 0
+
+class CycleWatchdog(object):
+	"""Per id cycle time supervision.
+
+	Args:
+		periods: dict of can_id -> expected period in seconds.
+		tolerance: fraction of the period a frame may be late, a frame is
+			missing after `period * (1 + tolerance)`.
+		learn: learn the period of ids not in `periods`.
+		learn_frames: intervals averaged to learn a period.
+		onTimeout: callable(can_id, age) when an id goes missing.
+		onRecovered: callable(can_id, outage) when it comes back.
+		resolution: tick of a private timer wheel, None uses the shared
+			TimerService of the loop.
+		loop: asyncio event loop.
+	"""
+
+	def __init__(self, periods=None, tolerance=0.5, learn=False, learn_frames=10, onTimeout=None,
+			onRecovered=None, resolution=None, loop=None):
+		self.tolerance = tolerance
+		self.learn = learn
+		self.learn_frames = learn_frames
+		self.onTimeout = onTimeout
+		self.onRecovered = onRecovered
+		self.resolution = resolution
+		self.loop = loop
+		self.timers = None
+		self._states = {}
+		self.timeouts = 0
+		self.recoveries = 0
+		for can_id, period in (periods or {}).items():
+			self.expect(can_id, period)
+
+	def expect(self, can_id, period):
+		"""Watch `can_id` with a fixed period."""
+		state = self._states.get(can_id)
+		if state is None:
+			state = self._states[can_id] = _CycleState(can_id)
+		state.period = period
+		state.limit = period * (1.0 + self.tolerance)
+		if self.timers is not None:
+			self._arm(state, self.loop.time())
+
+	def forget(self, can_id):
+		state = self._states.pop(can_id, None)
+		if state is not None and state.timer is not None:
+			state.timer.cancel()
+
+	def start(self):
+		if self.loop is None:
+			self.loop = asyncio.get_event_loop()
+		now = self.loop.time()
+		if self.resolution is None:
+			self.timers = get_timer_service(self.loop)
+		else:
+			self.timers = TimerService(self.resolution, self.loop)
+		for state in self._states.values():
+			if state.limit is not None:
+				#the first frame is expected within one limit of starting
+				state.lastSeen = now
+				self._arm(state, now)
+
+	def stop(self):
+		for state in self._states.values():
+			if state.timer is not None:
+				state.timer.cancel()
+				state.timer = None
+		if self.timers is not None and self.resolution is not None:
+			self.timers.close()
+		self.timers = None
+
+	def period(self, can_id):
+		state = self._states.get(can_id)
+		return None if state is None else state.period
+
+	@property
+	def missing(self):
+		return [state.can_id for state in self._states.values() if state.missing]
+
+	########################
+	# Stage Interface
+	########################
+	def process(self, frames):
+		if self.timers is None:
+			return
+		now = self.loop.time()
+		states = self._states
+		for frame in frames:
+			state = states.get(frame.addr)
+			if state is None:
+				if not self.learn:
+					continue
+				state = states[frame.addr] = _CycleState(frame.addr)
+			if state.limit is None:
+				self._learn(state, now)
+			elif state.missing:
+				self._recovered(state, now)
+			state.lastSeen = now
+
+	def metrics(self):
+		ret = [
+			("carbus_cycle_monitored_ids", {}, sum(1 for state in self._states.values() if state.limit is not None)),
+			("carbus_cycle_missing_ids", {}, sum(1 for state in self._states.values() if state.missing)),
+			("carbus_cycle_timeouts_total", {}, self.timeouts),
+			("carbus_cycle_recoveries_total", {}, self.recoveries),
+		]
+		for state in self._states.values():
+			if state.timeouts:
+				ret.append(("carbus_cycle_id_timeouts_total", {"can_id": "0x{:x}".format(state.can_id)}, state.timeouts))
+		return ret
+
+	########################
+	# Internal Methods
+	########################
+	def _learn(self, state, now):
+		if state.first is None:
+			state.first = now
+			return
+		state.learned += 1
+		if state.learned < self.learn_frames:
+			return
+		state.period = (now - state.first) / state.learned
+		state.limit = state.period * (1.0 + self.tolerance)
+		logging.debug("CycleWatchdog: 0x{:x} period {:.4f}s".format(state.can_id, state.period))
+		self._arm(state, now)
+
+	def _arm(self, state, now):
+		when = (state.lastSeen if state.lastSeen is not None else now) + state.limit
+		if state.timer is None:
+			state.timer = self.timers.schedule(when, self._expired, state)
+		else:
+			state.timer.reschedule(when)
+
+	def _expired(self, state):
+		now = self.loop.time()
+		deadline = state.lastSeen + state.limit
+		if deadline > now:
+			#seen since the timer was armed
+			state.timer.reschedule(deadline)
+			return
+		state.missing = True
+		state.lostAt = state.lastSeen
+		state.timeouts += 1
+		self.timeouts += 1
+		if self.onTimeout is not None:
+			try:
+				self.onTimeout(state.can_id, now - state.lastSeen)
+			except Exception as exc:
+				logging.error("CycleWatchdog onTimeout: {}".format(exc))
+
+	def _recovered(self, state, now):
+		state.missing = False
+		self.recoveries += 1
+		state.lastSeen = now
+		self._arm(state, now)
+		if self.onRecovered is not None:
+			try:
+				self.onRecovered(state.can_id, now - state.lostAt)
+			except Exception as exc:
+				logging.error("CycleWatchdog onRecovered: {}".format(exc))
@@ -0,0 +1,224 @@
+"""Always-on flight recorder.
+
+File: FlightRecorder.py
+
+Description:
+	FlightRecorder is a CANPort stage that keeps the most recent frames of
+	every interface it is attached to in a preallocated ring of parallel
+	arrays (timestamp, id, dlc, interface, 8 data bytes), so recording a
+	frame writes into existing storage instead of allocating objects.
+
+	`trigger()` marks a moment of interest. Once the post window has passed
+	the ring is copied (one slice per column) and the frames between
+	`trigger - pre` and `trigger + post` are written to a candump log from
+	a worker thread, so ingestion never stops. `errorStorm` and the
+	predicate engine can call `trigger` as well.
+"""
+
+import array
+import asyncio
+import logging
+import os
+import time
+
+from ..can.SocketCAN import CAN_EFF_FLAG, CAN_RTR_FLAG, CAN_SFF_MASK, CANFrame
+from .CaptureLog import format_frame
+
+class FlightRecorder(object):
+	"""Ring buffer stage with trigger based dumps.
+
+	Args:
+		capacity: number of frames kept (M).
+		pre: seconds before a trigger to dump (at most N seconds of
+			history are useful, older frames are skipped).
+		post: seconds after a trigger to wait for and dump.
+		directory: where dump files are written.
+		prefix: dump file name prefix.
+		storm_threshold: error frames in one CANErrorSummary that make
+			`errorStorm` fire a trigger.
+		onDump: optional callable(path, reason) called after a dump.
+		loop: asyncio event loop.
+	"""
+
+	def __init__(self, capacity=100000, pre=10.0, post=2.0, directory=".", prefix="flight",
+			storm_threshold=50, onDump=None, loop=None):
+		self.capacity = capacity
+		self.pre = pre
+		self.post = post
+		self.directory = directory
+		self.prefix = prefix
+		self.storm_threshold = storm_threshold
+		self.onDump = onDump
+		self.loop = loop
+
+		self._ts = array.array("d", [0.0]) * capacity
+		self._ids = array.array("I", [0]) * capacity
+		self._dlc = bytearray(capacity)
+		self._iface = bytearray(capacity)
+		self._data = bytearray(8 * capacity)
+		self._ifnames = []
+		self._ifindex = {}
+		self._head = 0
+		self.count = 0
+		self.triggers = 0
+		self.dumps = 0
+		self._pending = None
+		self._handle = None
+
+	########################
+	# Stage Interface
+	########################
+	def process(self, frames):
+		cap = self.capacity
+		head = self._head
+		ts = self._ts
+		ids = self._ids
+		dlc = self._dlc
+		iface = self._iface
+		data = self._data
+		ifindex = self._ifindex
+		for frame in frames:
+			name = frame.ifname
+			idx = ifindex.get(name)
+			if idx is None:
+				idx = self._addInterface(name)
+			canId = frame.addr
+			if canId > CAN_SFF_MASK:
+				canId |= CAN_EFF_FLAG
+			if frame.rtr:
+				canId |= CAN_RTR_FLAG
+			payload = frame.data
+			n = len(payload)
+			ts[head] = frame.ts or 0.0
+			ids[head] = canId
+			dlc[head] = n
+			iface[head] = idx
+			pos = head * 8
+			data[pos:pos + n] = payload
+			head += 1
+			if head == cap:
+				head = 0
+		self.count += len(frames)
+		self._head = head
+
+	def record(self, frame):
+		self.process((frame,))
+
+	########################
+	# Triggers
+	########################
+	def trigger(self, reason="api", ts=None, pre=None, post=None):
+		"""Dump the frames around `ts` (default now) once `post` has passed.
+
+		A trigger inside the post window of a pending dump only extends
+		that dump, a later one writes the pending dump right away and
+		starts a new one.
+
+		Returns:
+			True if a new dump was scheduled.
+		"""
+		self.triggers += 1
+		now = time.time()
+		ts = now if ts is None else ts
+		pre = self.pre if pre is None else pre
+		post = self.post if post is None else post
+		if self._pending is not None:
+			start, end, reasons, first = self._pending
+			if ts <= end:
+				self._pending = (min(start, ts - pre), max(end, ts + post), reasons + [reason], first)
+				if ts + post > end:
+					#the window grew, dump at its new end
+					self._handle.cancel()
+					self._handle = self.loop.call_later(max(ts + post - now, 0.0), self._dump)
+				return False
+			#past the pending window, it does not wait for the new one
+			self._handle.cancel()
+			self._dump()
+		if self.loop is None:
+			self.loop = asyncio.get_event_loop()
+		self._pending = (ts - pre, ts + post, [reason], ts)
+		self._handle = self.loop.call_later(max(ts + post - now, 0.0), self._dump)
+		return True
+
+	def errorStorm(self, summary):
+		"""Pass CANErrorSummary events here, bursts of `storm_threshold`
+		error frames or more fire a trigger.
+		"""
+		if summary.count >= self.storm_threshold:
+			self.trigger("errors", summary.first)
+
+	def frames(self, start=None, end=None):
+		"""Copy the recorded frames, oldest first, as CANFrames."""
+		return list(self._iterFrames(self._snapshot(), start, end))
+
+	def metrics(self):
+		return [
+			("carbus_recorder_frames_total", {}, self.count),
+			("carbus_recorder_triggers_total", {}, self.triggers),
+			("carbus_recorder_dumps_total", {}, self.dumps),
+		]
+
+	########################
+	# Internal Methods
+	########################
+	def _addInterface(self, name):
+		if len(self._ifnames) >= 256:
+			raise ValueError("FlightRecorder supports at most 256 interfaces")
+		idx = len(self._ifnames)
+		self._ifnames.append(name)
+		self._ifindex[name] = idx
+		return idx
+
+	def _snapshot(self):
+		"""Copy the ring in one slice per column, oldest entry first."""
+		head = self._head
+		if self.count < self.capacity:
+			cols = [col[:head] for col in (self._ts, self._ids, self._dlc, self._iface)]
+			data = bytes(self._data[:head * 8])
+		else:
+			cols = [col[head:] + col[:head] for col in (self._ts, self._ids, self._dlc, self._iface)]
+			data = bytes(self._data[head * 8:] + self._data[:head * 8])
+		return cols, data, list(self._ifnames)
+
+	def _iterFrames(self, snapshot, start, end):
+		(ts, ids, dlc, iface), data, ifnames = snapshot
+		for i in range(len(ts)):
+			t = ts[i]
+			if (start is not None and t < start) or (end is not None and t > end):
+				continue
+			canId = ids[i]
+			n = dlc[i]
+			yield CANFrame(
+				data[i * 8:i * 8 + n],
+				canId & ~(CAN_EFF_FLAG | CAN_RTR_FLAG),
+				bool(canId & CAN_RTR_FLAG),
+				t,
+				ifnames[iface[i]],
+			)
+
+	def _dump(self):
+		if self._pending is None:
+			return
+		start, end, reasons, first = self._pending
+		self._pending = None
+		self._handle = None
+		snapshot = self._snapshot()
+		reason = "+".join(sorted(set(reasons)))
+		name = "{}-{}-{}.log".format(self.prefix, time.strftime("%Y%m%d-%H%M%S", time.localtime(first)), reason)
+		path = os.path.join(self.directory, name)
+		future = self.loop.run_in_executor(None, self._write, path, snapshot, start, end)
+		future.add_done_callback(lambda fut: self._dumped(fut, path, reason))
+
+	def _write(self, path, snapshot, start, end):
+		with open(path, "w") as f:
+			f.writelines(format_frame(frame) for frame in self._iterFrames(snapshot, start, end))
+
+	def _dumped(self, future, path, reason):
+		exc = future.exception()
+		if exc is not None:
+			logging.error("Flight recorder dump {} failed: {}".format(path, exc))
+			return
+		self.dumps += 1
+		logging.info("Flight recorder dump ({}): {}".format(reason, path))
+		if self.onDump is not None:
+			self.onDump(path, reason)
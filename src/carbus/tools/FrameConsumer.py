@@ -73,6 +73,9 @@ class FrameConsumer(DoCANProtocol):
 	def getFilters(self):
 		return [CANFilter(cob, self._mask) for cob in self._cobIds]
 
+	async def frameReceived(self, frame):
+		self.process_single_frame(frame)
+
 	def process_single_frame(self, frame):
 		self.cur_raw_frame = frame
 		frame = self.transform(frame)	
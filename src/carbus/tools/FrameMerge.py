@@ -0,0 +1,235 @@
+"""Timestamp ordered merge of several frame streams.
+
+File: FrameMerge.py
+
+Description:
+	Frames from different sockets or captures arrive interleaved and not in
+	kernel timestamp order. Both merges here keep a heap of at most a
+	reorder window worth of frames and release them in timestamp order:
+
+	- FrameMerge merges live streams. Each CANPort gets a stage from
+	  `source()`; a frame is released once it is `window` seconds old, so the
+	  added latency is bounded by the window.
+	- merge_streams merges iterables such as CaptureReaders lazily. A frame
+	  is released once every stream has advanced `window` seconds past it.
+
+	A frame that shows up after a later frame was already released is late.
+	Late frames are counted and, unless dropped, passed on immediately.
+"""
+
+import asyncio
+import heapq
+import time
+
+class MergeStats(object):
+	"""Counters of a merge."""
+
+	def __init__(self):
+		self.frames = 0
+		self.late = 0
+		self.dropped = 0
+		#largest amount a released frame was older than the newest frame seen
+		self.max_reorder = 0.0
+
+	def metrics(self, labels=None):
+		labels = labels or {}
+		return [
+			("carbus_merge_frames_total", labels, self.frames),
+			("carbus_merge_late_frames_total", labels, self.late),
+			("carbus_merge_dropped_frames_total", labels, self.dropped),
+			("carbus_merge_max_reorder_seconds", labels, self.max_reorder),
+		]
+
+class _MergeSource(object):
+	"""CANPort stage feeding one stream into a FrameMerge."""
+
+	def __init__(self, merge, name):
+		self.merge = merge
+		self.name = name
+
+	def process(self, frames):
+		self.merge.push(frames, self.name)
+
+class FrameMerge(object):
+	"""Live k-way merge with a bounded reorder window.
+
+	Args:
+		output: callable receiving each list of released frames in
+			timestamp order.
+		window: reorder window / added latency in seconds.
+		dropLate: drop late frames instead of passing them on.
+		clock: time source matching the frame timestamps.
+		loop: asyncio event loop.
+	"""
+
+	def __init__(self, output, window=0.02, dropLate=False, clock=time.time, loop=None):
+		self.output = output
+		self.window = window
+		self.dropLate = dropLate
+		self.clock = clock
+		self.loop = loop
+		self.stats = MergeStats()
+		self._heap = []
+		self._seq = 0
+		self._released = None
+		self._newest = None
+		self._handle = None
+
+	def source(self, name=None):
+		"""Create a stage for `CANPort.addStage` that feeds this merge."""
+		return _MergeSource(self, name)
+
+	@property
+	def buffered(self):
+		return len(self._heap)
+
+	def push(self, frames, name=None):
+		"""Add frames from one stream, releasing everything that is due."""
+		if not frames:
+			return
+		now = self.clock()
+		heap = self._heap
+		late = None
+		for frame in frames:
+			ts = frame.ts
+			if ts is None:
+				ts = frame.ts = now
+			if self._newest is None or ts > self._newest:
+				self._newest = ts
+			if self._released is not None and ts < self._released:
+				self.stats.late += 1
+				if self.dropLate:
+					self.stats.dropped += 1
+				else:
+					if late is None:
+						late = []
+					late.append(frame)
+				continue
+			heapq.heappush(heap, (ts, self._seq, frame))
+			self._seq += 1
+		if late is not None:
+			self.stats.frames += len(late)
+			self.output(late)
+		self._release(now)
+
+	def flush(self):
+		"""Release every buffered frame regardless of the window."""
+		self._cancel()
+		self._release(None)
+
+	def stop(self):
+		self.flush()
+
+	def metrics(self):
+		ret = self.stats.metrics()
+		ret.append(("carbus_merge_buffered_frames", {}, len(self._heap)))
+		return ret
+
+	########################
+	# Internal Methods
+	########################
+	def _release(self, now):
+		heap = self._heap
+		cutoff = None if now is None else now - self.window
+		out = []
+		while heap and (cutoff is None or heap[0][0] <= cutoff):
+			ts, _, frame = heapq.heappop(heap)
+			out.append(frame)
+		if out:
+			self._released = out[-1].ts
+			reorder = self._newest - out[0].ts
+			if reorder > self.stats.max_reorder:
+				self.stats.max_reorder = reorder
+			self.stats.frames += len(out)
+			self.output(out)
+		if heap:
+			self._schedule(heap[0][0] + self.window - (now if now is not None else self.clock()))
+		else:
+			self._cancel()
+
+	def _schedule(self, delay):
+		if self._handle is not None:
+			return
+		if self.loop is None:
+			self.loop = asyncio.get_event_loop()
+		self._handle = self.loop.call_later(max(delay, 0.0), self._timer)
+
+	def _timer(self):
+		self._handle = None
+		self._release(self.clock())
+
+	def _cancel(self):
+		if self._handle is not None:
+			self._handle.cancel()
+			self._handle = None
+
+def merge_streams(sources, window=0.0, dropLate=False, stats=None):
+	"""Merge iterables of frames into one timestamp ordered stream.
+
+	Only about `window` seconds of frames per stream are buffered. With
+	window 0 the inputs must each be in timestamp order; a larger window
+	tolerates streams that are locally out of order by up to that much.
+
+	Args:
+		sources: iterables of CANFrames, e.g. CaptureReaders.
+		window: reorder window in seconds.
+		dropLate: drop late frames instead of yielding them.
+		stats: optional MergeStats to update.
+
+	Yields:
+		CANFrame objects in timestamp order.
+	"""
+	stats = stats if stats is not None else MergeStats()
+	iters = [iter(src) for src in sources]
+	#frontier of every stream: (newest timestamp seen, index), streams are pulled lowest first
+	frontier = []
+	heap = []
+	seq = 0
+	released = None
+	newest = None
+
+	def pull(idx):
+		for frame in iters[idx]:
+			if frame.ts is not None:
+				return frame
+		return None
+
+	for idx in range(len(iters)):
+		frame = pull(idx)
+		if frame is not None:
+			if newest is None or frame.ts > newest:
+				newest = frame.ts
+			heapq.heappush(heap, (frame.ts, seq, frame))
+			seq += 1
+			heapq.heappush(frontier, (frame.ts, idx))
+
+	while frontier or heap:
+		if frontier:
+			high, idx = heapq.heappop(frontier)
+			frame = pull(idx)
+			if frame is not None:
+				ts = frame.ts
+				if newest is None or ts > newest:
+					newest = ts
+				if released is not None and ts < released:
+					stats.late += 1
+					if dropLate:
+						stats.dropped += 1
+					else:
+						stats.frames += 1
+						yield frame
+				else:
+					heapq.heappush(heap, (ts, seq, frame))
+					seq += 1
+				heapq.heappush(frontier, (max(high, ts), idx))
+			watermark = frontier[0][0] - window if frontier else None
+		else:
+			watermark = None
+
+		while heap and (watermark is None or heap[0][0] <= watermark):
+			ts, _, frame = heapq.heappop(heap)
+			released = ts
+			if newest is not None and newest - ts > stats.max_reorder:
+				stats.max_reorder = newest - ts
+			stats.frames += 1
+			yield frame
@@ -0,0 +1,172 @@
+"""Receive path latency instrumentation.
+
+File: Latency.py
+
+Description:
+	Opt-in recording of where the time between the kernel receiving a frame
+	and a protocol finishing with it is spent. CANPort stamps every frame at
+	the following points:
+
+		kernel: kernel RX timestamp (frame.ts)
+		read: read_batch returned
+		dispatch: the frameReceived task was created
+		start/end: the protocol callback started/finished
+
+	and LatencyRecorder folds the differences into fixed-size log-linear
+	(HDR style) histograms, one set per interface and protocol.
+"""
+
+import array
+import logging
+import time
+
+#stage names, in receive path order
+KERNEL_TO_READ = "kernel_to_read"
+READ_TO_DISPATCH = "read_to_dispatch"
+DISPATCH_TO_START = "dispatch_to_start"
+CALLBACK = "callback"
+TOTAL = "total"
+STAGES = (KERNEL_TO_READ, READ_TO_DISPATCH, DISPATCH_TO_START, CALLBACK, TOTAL)
+
+class LatencyHistogram(object):
+	"""Log-linear histogram of microsecond values with bounded relative error.
+
+	Values below 2**sub_bits are counted exactly, above that every power of
+	two is split into 2**(sub_bits-1) buckets, so the relative error stays
+	below 2**-(sub_bits-1). The counts live in one preallocated array.
+	"""
+
+	def __init__(self, sub_bits=5, max_bits=32):
+		self.sub_bits = sub_bits
+		self.max_bits = max_bits
+		self._sub = 1 << sub_bits
+		self._half = self._sub >> 1
+		self._counts = array.array("Q", bytes(8 * (self._sub + (max_bits - sub_bits) * self._half)))
+		self._maxValue = (1 << max_bits) - 1
+		self.reset()
+
+	def reset(self):
+		for i in range(len(self._counts)):
+			self._counts[i] = 0
+		self.count = 0
+		self.total = 0
+		self.min = None
+		self.max = 0
+
+	def record(self, value):
+		"""Record a value in microseconds, negative values are clamped to 0."""
+		v = int(value)
+		if v < 0:
+			v = 0
+		elif v > self._maxValue:
+			v = self._maxValue
+		if v < self._sub:
+			idx = v
+		else:
+			shift = v.bit_length() - self.sub_bits
+			idx = self._sub + (shift - 1) * self._half + ((v >> shift) - self._half)
+		self._counts[idx] += 1
+		self.count += 1
+		self.total += v
+		if v > self.max:
+			self.max = v
+		if self.min is None or v < self.min:
+			self.min = v
+
+	def value_at(self, idx):
+		"""Highest value that falls into bucket `idx`."""
+		if idx < self._sub:
+			return idx
+		shift = (idx - self._sub) // self._half + 1
+		mant = (idx - self._sub) % self._half + self._half
+		return ((mant + 1) << shift) - 1
+
+	def percentile(self, p):
+		"""Value at percentile `p` (0-100), in microseconds."""
+		if not self.count:
+			return None
+		target = max(1, int(round(self.count * p / 100.0)))
+		seen = 0
+		for idx, c in enumerate(self._counts):
+			seen += c
+			if seen >= target:
+				return min(self.value_at(idx), self.max)
+		return self.max
+
+	def mean(self):
+		return self.total / self.count if self.count else None
+
+class LatencyRecorder(object):
+	"""Latency histograms for the receive path of a set of CANPorts.
+
+	Args:
+		slow_callback: callback duration in seconds above which a warning
+			is logged and the slow counter incremented.
+	"""
+	QUANTILES = (50.0, 90.0, 99.0, 99.9)
+
+	def __init__(self, slow_callback=0.01, sub_bits=5):
+		self.slow_callback = slow_callback
+		self.sub_bits = sub_bits
+		self._hists = {}
+		self._slow = {}
+
+	def histogram(self, ifname, protocol, stage):
+		key = (ifname, protocol, stage)
+		hist = self._hists.get(key)
+		if hist is None:
+			hist = LatencyHistogram(self.sub_bits)
+			self._hists[key] = hist
+		return hist
+
+	def histograms(self):
+		"""dict of (ifname, protocol, stage) -> LatencyHistogram"""
+		return dict(self._hists)
+
+	def slow_callbacks(self):
+		"""dict of (ifname, protocol) -> number of slow callbacks"""
+		return dict(self._slow)
+
+	def reset(self):
+		self._hists = {}
+		self._slow = {}
+
+	async def track(self, ifname, protocol, coro, kernelTs, readTs, dispatchTs):
+		"""Run a frameReceived coroutine and record its timestamps.
+
+		All timestamps are `time.time()` values so they compare with the
+		kernel timestamp.
+		"""
+		start = time.time()
+		try:
+			return await coro
+		finally:
+			end = time.time()
+			name = type(protocol).__name__
+			hist = self.histogram
+			if kernelTs is not None:
+				hist(ifname, name, KERNEL_TO_READ).record((readTs - kernelTs) * 1e6)
+				hist(ifname, name, TOTAL).record((end - kernelTs) * 1e6)
+			hist(ifname, name, READ_TO_DISPATCH).record((dispatchTs - readTs) * 1e6)
+			hist(ifname, name, DISPATCH_TO_START).record((start - dispatchTs) * 1e6)
+			hist(ifname, name, CALLBACK).record((end - start) * 1e6)
+			if end - start > self.slow_callback:
+				key = (ifname, name)
+				self._slow[key] = self._slow.get(key, 0) + 1
+				logging.warning("{} {}: slow frameReceived {:.1f}ms".format(ifname, name, (end - start) * 1e3))
+
+	def metrics(self):
+		"""Summaries in (name, labels, value) form, values in seconds."""
+		ret = []
+		for (ifname, proto, stage), hist in self._hists.items():
+			if not hist.count:
+				continue
+			labels = {"interface": ifname, "protocol": proto, "stage": stage}
+			for q in self.QUANTILES:
+				qlabels = dict(labels, quantile="{:g}".format(q / 100.0))
+				ret.append(("carbus_latency_seconds", qlabels, hist.percentile(q) / 1e6))
+			ret.append(("carbus_latency_seconds_sum", labels, hist.total / 1e6))
+			ret.append(("carbus_latency_seconds_count", labels, hist.count))
+		for (ifname, proto), count in self._slow.items():
+			ret.append(("carbus_slow_callbacks_total", {"interface": ifname, "protocol": proto}, count))
+		return ret
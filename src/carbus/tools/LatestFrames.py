@@ -0,0 +1,247 @@
+"""Latest frame per CAN id
+
+File: LatestFrames.py
+
+Description:
+	LatestFrameTable is a CANPort stage keeping the last frame of every id in
+	fixed slots of one preallocated buffer: 2048 slots indexed directly by
+	the standard id, followed by an open addressing hash table for extended
+	ids. Updating a slot is three `struct.pack_into` calls (odd lock, body,
+	even lock), no objects are allocated per frame. Pollers and dashboards read a slot whenever they
+	like instead of subscribing to the stream.
+
+	Every slot is guarded by a sequence lock (odd while it is written), so
+	SharedFrameTable can put the same layout in a
+	`multiprocessing.shared_memory` block and other processes can read it
+	consistently without any lock.
+
+	Layout (little endian):
+		header: magic "CBLT", layout version, standard slots, extended slots
+		slot:   lock u32, flags u32 (id, EFF/RTR), count u64, ts f64,
+		        dlc u8, 7 pad bytes, data 8 bytes
+"""
+
+import array
+import struct
+
+from ..can.SocketCAN import CAN_EFF_FLAG, CAN_EFF_MASK, CAN_RTR_FLAG, CAN_SFF_MASK, CANFrame
+
+HEADER = struct.Struct("<4sHHII")
+SLOT = struct.Struct("<IIQdB7x8s")
+LOCK = struct.Struct("<I")
+#slot without its lock, written between the odd and the even lock
+BODY = struct.Struct("<IQdB7x8s")
+MAGIC = b"CBLT"
+LAYOUT_VERSION = 1
+SFF_SLOTS = CAN_SFF_MASK + 1
+
+#reads retried while a writer holds the slot
+READ_RETRIES = 100
+
+def table_size(ext_capacity):
+	return HEADER.size + (SFF_SLOTS + ext_capacity) * SLOT.size
+
+class LatestFrameTable(object):
+	"""Latest frame, timestamp and frame count per CAN id.
+
+	Args:
+		ext_capacity: number of extended ids that can be tracked, rounded
+			up to a power of two. Ids beyond that are counted in
+			`overflow` and not stored.
+		buffer: writable buffer of `table_size(ext_capacity)` bytes,
+			allocated when None.
+		init: write the header and clear the buffer.
+	"""
+
+	def __init__(self, ext_capacity=1024, buffer=None, init=True):
+		capacity = 1
+		while capacity < ext_capacity:
+			capacity <<= 1
+		self.ext_capacity = capacity
+		if buffer is None:
+			buffer = bytearray(table_size(capacity))
+		self.buf = memoryview(buffer)
+		self.frames = 0
+		self.overflow = 0
+		#extended id -> slot, the writer's shortcut around probing
+		self._extSlots = {}
+		#frame count per slot, the writer derives the slot lock from it
+		self._counts = array.array("Q", [0]) * (SFF_SLOTS + capacity)
+		if init:
+			self.buf[:table_size(capacity)] = bytes(table_size(capacity))
+			HEADER.pack_into(self.buf, 0, MAGIC, LAYOUT_VERSION, 0, SFF_SLOTS, capacity)
+
+	########################
+	# Stage Interface
+	########################
+	def process(self, frames):
+		buf = self.buf
+		extSlots = self._extSlots
+		counts = self._counts
+		pack = BODY.pack_into
+		lock = LOCK.pack_into
+		base = HEADER.size
+		size = SLOT.size
+		for frame in frames:
+			addr = frame.addr
+			if addr > CAN_SFF_MASK:
+				slot = extSlots.get(addr)
+				if slot is None:
+					slot = self._insert(addr)
+					if slot is None:
+						continue
+				key = addr | CAN_EFF_FLAG
+			else:
+				slot = addr
+				key = addr
+			if frame.rtr:
+				key |= CAN_RTR_FLAG
+			offset = base + slot * size
+			count = counts[slot] + 1
+			counts[slot] = count
+			lock(buf, offset, (2 * count - 1) & 0xFFFFFFFF)
+			data = frame.data
+			pack(buf, offset + 4, key, count, frame.ts or 0.0, len(data), data)
+			lock(buf, offset, (2 * count) & 0xFFFFFFFF)
+		self.frames += len(frames)
+
+	########################
+	# Readers
+	########################
+	def read(self, can_id):
+		"""Consistent copy of the slot of `can_id`.
+
+		Returns:
+			(count, ts, data, rtr) or None if the id was not seen yet.
+		"""
+		offset = self._offset(can_id)
+		if offset is None:
+			return None
+		buf = self.buf
+		for _ in range(READ_RETRIES):
+			version, key, count, ts, dlc, data = SLOT.unpack_from(buf, offset)
+			if version & 1:
+				continue
+			if LOCK.unpack_from(buf, offset)[0] != version:
+				continue
+			if count == 0:
+				return None
+			return count, ts, data[:dlc], bool(key & CAN_RTR_FLAG)
+		return None
+
+	def get(self, can_id):
+		"""Latest CANFrame of `can_id` or None."""
+		slot = self.read(can_id)
+		if slot is None:
+			return None
+		count, ts, data, rtr = slot
+		return CANFrame(data, can_id, rtr, ts)
+
+	def count(self, can_id):
+		slot = self.read(can_id)
+		return 0 if slot is None else slot[0]
+
+	def ids(self):
+		"""Ids that have a frame, standard ids first."""
+		buf = self.buf
+		base = HEADER.size
+		size = SLOT.size
+		ret = []
+		for slot in range(SFF_SLOTS + self.ext_capacity):
+			_, key, count, _, _, _ = SLOT.unpack_from(buf, base + slot * size)
+			if count:
+				ret.append(key & CAN_EFF_MASK)
+		return ret
+
+	def metrics(self):
+		return [
+			("carbus_latest_frames_total", {}, self.frames),
+			("carbus_latest_extended_ids", {}, len(self._extSlots)),
+			("carbus_latest_extended_overflow_total", {}, self.overflow),
+		]
+
+	########################
+	# Internal Methods
+	########################
+	def _hash(self, can_id):
+		return ((can_id * 2654435761) >> 7) & (self.ext_capacity - 1)
+
+	def _probe(self, can_id):
+		"""Slot of an extended id or the empty slot ending its probe chain."""
+		buf = self.buf
+		base = HEADER.size
+		size = SLOT.size
+		key = can_id | CAN_EFF_FLAG
+		mask = self.ext_capacity - 1
+		idx = self._hash(can_id)
+		for _ in range(self.ext_capacity):
+			slot = SFF_SLOTS + idx
+			_, stored, _, _, _, _ = SLOT.unpack_from(buf, base + slot * size)
+			stored &= ~CAN_RTR_FLAG
+			if stored == key or stored == 0:
+				return slot, stored == key
+			idx = (idx + 1) & mask
+		return None, False
+
+	def _insert(self, can_id):
+		slot, found = self._probe(can_id)
+		if slot is None:
+			self.overflow += 1
+			return None
+		if not found:
+			#claim the slot before it holds a frame so readers probe past it
+			SLOT.pack_into(self.buf, HEADER.size + slot * SLOT.size, 0, can_id | CAN_EFF_FLAG, 0, 0.0, 0, b"")
+		self._extSlots[can_id] = slot
+		return slot
+
+	def _offset(self, can_id):
+		if can_id <= CAN_SFF_MASK:
+			slot = can_id
+		else:
+			slot = self._extSlots.get(can_id)
+			if slot is None:
+				slot, found = self._probe(can_id)
+				if not found:
+					return None
+		return HEADER.size + slot * SLOT.size
+
+class SharedFrameTable(LatestFrameTable):
+	"""LatestFrameTable in a named shared memory block.
+
+	The process reading the CAN port creates the table and adds it as a
+	stage; other processes attach with `SharedFrameTable(name, create=False)`
+	and only read.
+
+	Args:
+		name: shared memory name, generated when None (see `name`).
+		ext_capacity: see LatestFrameTable, ignored when attaching.
+		create: create the block instead of attaching to it.
+	"""
+
+	def __init__(self, name=None, ext_capacity=1024, create=True):
+		from multiprocessing import shared_memory
+
+		if create:
+			capacity = 1
+			while capacity < ext_capacity:
+				capacity <<= 1
+			self.shm = shared_memory.SharedMemory(name=name, create=True, size=table_size(capacity))
+		else:
+			self.shm = shared_memory.SharedMemory(name=name)
+			magic, layout, _, sff, capacity = HEADER.unpack_from(self.shm.buf, 0)
+			if magic != MAGIC or layout != LAYOUT_VERSION or sff != SFF_SLOTS:
+				self.shm.close()
+				raise ValueError("{} is not a frame table".format(name))
+		super(SharedFrameTable, self).__init__(capacity, self.shm.buf, init=create)
+
+	@property
+	def name(self):
+		return self.shm.name
+
+	def close(self):
+		self.buf.release()
+		self.shm.close()
+
+	def unlink(self):
+		"""Remove the block, call from the creating process when done."""
+		self.shm.unlink()
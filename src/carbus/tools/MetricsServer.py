@@ -0,0 +1,97 @@
+"""Local metrics endpoint.
+
+File: MetricsServer.py
+
+Description:
+	Collects samples from any number of sources and serves them in the
+	Prometheus text exposition format on a local TCP port. A source is any
+	object with a `metrics()` method returning a list of
+	(name, labels, value) tuples, such as TrafficStats, BusLoad or
+	LatencyRecorder. `render` can also be called in process.
+"""
+
+import asyncio
+import logging
+
+def _format_labels(labels):
+	if not labels:
+		return ""
+	items = ",".join(
+		'{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in sorted(labels.items())
+	)
+	return "{" + items + "}"
+
+class MetricsServer(object):
+
+	def __init__(self, host="127.0.0.1", port=9108):
+		self.host = host
+		self.port = port
+		self._sources = []
+		self._server = None
+
+	def register(self, source):
+		self._sources.append(source)
+
+	def unregister(self, source):
+		self._sources.remove(source)
+
+	def collect(self):
+		"""Gather the samples of every source.
+
+		Returns:
+			list of (name, labels, value) tuples.
+		"""
+		ret = []
+		for source in self._sources:
+			try:
+				ret.extend(source.metrics())
+			except Exception as exc:
+				logging.error("Metrics source {}: {}".format(source, exc))
+		return ret
+
+	def render(self):
+		"""Render the current samples in the Prometheus text format."""
+		lines = []
+		for name, labels, value in self.collect():
+			if value is None:
+				continue
+			lines.append("{}{} {}".format(name, _format_labels(labels), value))
+		lines.append("")
+		return "\n".join(lines)
+
+	async def start(self):
+		self._server = await asyncio.start_server(self._handle, self.host, self.port)
+		logging.info("Metrics available on http://{}:{}/metrics".format(self.host, self.port))
+
+	async def stop(self):
+		if self._server is not None:
+			self._server.close()
+			await self._server.wait_closed()
+			self._server = None
+
+	async def _handle(self, reader, writer):
+		try:
+			request = await reader.readline()
+			#drain the request headers
+			while True:
+				line = await reader.readline()
+				if not line or line in (b"\r\n", b"\n"):
+					break
+			parts = request.split()
+			if len(parts) >= 2 and parts[0] == b"GET" and parts[1] in (b"/", b"/metrics"):
+				status = "200 OK"
+				body = self.render().encode()
+			else:
+				status = "404 Not Found"
+				body = b""
+			writer.write(
+				"HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {}\r\n\r\n".format(
+					status, len(body)
+				).encode()
+			)
+			writer.write(body)
+			await writer.drain()
+		except Exception as exc:
+			logging.debug("Metrics request failed: {}".format(exc))
+		finally:
+			writer.close()
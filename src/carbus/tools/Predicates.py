@@ -0,0 +1,520 @@
+"""Signal predicates
+
+File: Predicates.py
+
+Description:
+	Conditions over decoded signals written as Python expressions, e.g.
+
+		brake and speed > 80 and within(changed(gear), "200ms")
+
+	are parsed with `ast` and compiled once into a tree of closures. The
+	PredicateEngine listens to a SignalDecoder and keeps an index from signal
+	name to the predicates reading it, so a frame only re-evaluates the
+	predicates whose inputs changed. Temporal operators that become true or
+	false with time alone (within, held) ask for a timer at their deadline.
+
+	Supported syntax:
+		- signal names, numbers, True/False, `sig("name")` for any name
+		- and, or, not, comparisons (also `in (1, 2)`), + - * / // % & | ^ << >>
+		- abs(x), min(a, b, ...), max(a, b, ...)
+		- dlc(id), byte(id, n), count(id): fields of the frame `id`
+		- changed(x): x differs from its value at the previous evaluation
+		- rising(c), falling(c): c became true / false
+		- within(c, t): c was true during the last t seconds
+		- held(c, t): c has been true for at least t seconds
+
+	Durations are seconds or strings with a unit: "200ms", "1.5s", "500us".
+	Unknown signal values (None) make comparisons false.
+"""
+
+import ast
+import asyncio
+import logging
+import operator
+import time
+
+from .Signals import FrameField
+from .TimerService import get_timer_service
+
+class PredicateError(ValueError):
+	pass
+
+_BINOPS = {
+	ast.Add: operator.add,
+	ast.Sub: operator.sub,
+	ast.Mult: operator.mul,
+	ast.Div: operator.truediv,
+	ast.FloorDiv: operator.floordiv,
+	ast.Mod: operator.mod,
+	ast.BitAnd: operator.and_,
+	ast.BitOr: operator.or_,
+	ast.BitXor: operator.xor,
+	ast.LShift: operator.lshift,
+	ast.RShift: operator.rshift,
+}
+
+_CMPOPS = {
+	ast.Eq: operator.eq,
+	ast.NotEq: operator.ne,
+	ast.Lt: operator.lt,
+	ast.LtE: operator.le,
+	ast.Gt: operator.gt,
+	ast.GtE: operator.ge,
+}
+
+_UNITS = (("ms", 1e-3), ("us", 1e-6), ("min", 60.0), ("s", 1.0))
+
+def parse_duration(value):
+	"""Seconds from a number or a string like "200ms"."""
+	if isinstance(value, (int, float)) and not isinstance(value, bool):
+		return float(value)
+	if isinstance(value, str):
+		text = value.strip().lower()
+		for unit, scale in _UNITS:
+			if text.endswith(unit):
+				try:
+					return float(text[:-len(unit)]) * scale
+				except ValueError:
+					break
+	raise PredicateError("Invalid duration {!r}".format(value))
+
+class _Context(object):
+	"""Evaluation time and the earliest deadline asked for."""
+	__slots__ = ("now", "deadline")
+
+	def __init__(self):
+		self.now = None
+		self.deadline = None
+
+	def wakeAt(self, ts):
+		if self.deadline is None or ts < self.deadline:
+			self.deadline = ts
+
+class _Compiler(object):
+	"""Turns an expression into `fn(ctx)` and the signal names it reads."""
+
+	def __init__(self, decoder):
+		self.decoder = decoder
+		self.values = decoder.values
+		self.deps = set()
+
+	def compile(self, expr):
+		try:
+			tree = ast.parse(expr, mode="eval")
+		except SyntaxError as exc:
+			raise PredicateError("Invalid predicate {!r}: {}".format(expr, exc.msg))
+		fn, _ = self.node(tree.body)
+		return fn, self.deps
+
+	def node(self, node):
+		"""Returns (fn, stateful)."""
+		method = getattr(self, "_" + type(node).__name__, None)
+		if method is None:
+			raise PredicateError("Unsupported syntax: {}".format(type(node).__name__))
+		return method(node)
+
+	def signal(self, name):
+		if name not in self.decoder.signals:
+			raise PredicateError("Unknown signal {}".format(name))
+		self.deps.add(name)
+		values = self.values
+		return (lambda ctx: values[name]), False
+
+	def constant(self, node):
+		if not isinstance(node, ast.Constant):
+			raise PredicateError("Expected a constant, got {}".format(type(node).__name__))
+		return node.value
+
+	########################
+	# Node Types
+	########################
+	def _Constant(self, node):
+		value = node.value
+		if not isinstance(value, (int, float, bool)):
+			raise PredicateError("Unsupported constant {!r}".format(value))
+		return (lambda ctx: value), False
+
+	def _Name(self, node):
+		return self.signal(node.id)
+
+	def _BoolOp(self, node):
+		parts = [self.node(value) for value in node.values]
+		fns = [fn for fn, _ in parts]
+		stateful = any(state for _, state in parts)
+		isAnd = isinstance(node.op, ast.And)
+		if stateful:
+			#every operand must see every evaluation to keep its history right
+			if isAnd:
+				return (lambda ctx: all([fn(ctx) for fn in fns])), True
+			return (lambda ctx: any([fn(ctx) for fn in fns])), True
+		if isAnd:
+			return (lambda ctx: all(fn(ctx) for fn in fns)), False
+		return (lambda ctx: any(fn(ctx) for fn in fns)), False
+
+	def _UnaryOp(self, node):
+		fn, stateful = self.node(node.operand)
+		if isinstance(node.op, ast.Not):
+			return (lambda ctx: not fn(ctx)), stateful
+		if isinstance(node.op, ast.USub):
+			op = operator.neg
+		elif isinstance(node.op, ast.UAdd):
+			op = operator.pos
+		elif isinstance(node.op, ast.Invert):
+			op = operator.invert
+		else:
+			raise PredicateError("Unsupported operator {}".format(type(node.op).__name__))
+
+		def unary(ctx):
+			value = fn(ctx)
+			return None if value is None else op(value)
+		return unary, stateful
+
+	def _BinOp(self, node):
+		op = _BINOPS.get(type(node.op))
+		if op is None:
+			raise PredicateError("Unsupported operator {}".format(type(node.op).__name__))
+		left, lState = self.node(node.left)
+		right, rState = self.node(node.right)
+
+		def binop(ctx):
+			a = left(ctx)
+			b = right(ctx)
+			if a is None or b is None:
+				return None
+			try:
+				return op(a, b)
+			except ZeroDivisionError:
+				return None
+		return binop, lState or rState
+
+	def _Compare(self, node):
+		first, stateful = self.node(node.left)
+		steps = []
+		for cmpop, comparator in zip(node.ops, node.comparators):
+			if isinstance(cmpop, (ast.In, ast.NotIn)):
+				if not isinstance(comparator, (ast.Tuple, ast.List, ast.Set)):
+					raise PredicateError("'in' needs a literal tuple")
+				choices = frozenset(self.constant(elt) for elt in comparator.elts)
+				steps.append((None, choices, isinstance(cmpop, ast.In)))
+				continue
+			op = _CMPOPS.get(type(cmpop))
+			if op is None:
+				raise PredicateError("Unsupported comparison {}".format(type(cmpop).__name__))
+			fn, state = self.node(comparator)
+			stateful = stateful or state
+			steps.append((op, fn, None))
+
+		def compare(ctx):
+			a = first(ctx)
+			result = a is not None
+			for op, arg, member in steps:
+				if op is None:
+					#membership tests keep the left operand for a chained comparison
+					result = result and (a in arg) == member
+					continue
+				b = arg(ctx)
+				result = result and b is not None and op(a, b)
+				a = b
+			return result
+		return compare, stateful
+
+	def _Call(self, node):
+		if not isinstance(node.func, ast.Name) or node.keywords:
+			raise PredicateError("Unsupported call")
+		name = node.func.id
+		method = getattr(self, "_call_" + name, None)
+		if method is None:
+			raise PredicateError("Unknown function {}".format(name))
+		return method(node.args)
+
+	########################
+	# Functions
+	########################
+	def _call_sig(self, args):
+		if len(args) != 1:
+			raise PredicateError("sig() takes a signal name")
+		return self.signal(self.constant(args[0]))
+
+	def _field(self, args, field, nargs):
+		if len(args) != nargs:
+			raise PredicateError("{}() takes {} argument(s)".format(field, nargs))
+		can_id = self.constant(args[0])
+		index = self.constant(args[1]) if nargs > 1 else None
+		sig = self.decoder.add(FrameField(can_id, field, index))
+		return self.signal(sig.name)
+
+	def _call_dlc(self, args):
+		return self._field(args, "dlc", 1)
+
+	def _call_byte(self, args):
+		return self._field(args, "byte", 2)
+
+	def _call_count(self, args):
+		return self._field(args, "count", 1)
+
+	def _call_abs(self, args):
+		if len(args) != 1:
+			raise PredicateError("abs() takes one argument")
+		fn, stateful = self.node(args[0])
+
+		def absolute(ctx):
+			value = fn(ctx)
+			return None if value is None else abs(value)
+		return absolute, stateful
+
+	def _reduce(self, args, func):
+		if not args:
+			raise PredicateError("{}() needs arguments".format(func.__name__))
+		parts = [self.node(arg) for arg in args]
+		fns = [fn for fn, _ in parts]
+
+		def reduced(ctx):
+			values = [fn(ctx) for fn in fns]
+			if None in values:
+				return None
+			return func(values)
+		return reduced, any(state for _, state in parts)
+
+	def _call_min(self, args):
+		return self._reduce(args, min)
+
+	def _call_max(self, args):
+		return self._reduce(args, max)
+
+	def _call_changed(self, args):
+		if len(args) != 1:
+			raise PredicateError("changed() takes one argument")
+		fn, _ = self.node(args[0])
+		prev = [None]
+
+		def changed(ctx):
+			value = fn(ctx)
+			last = prev[0]
+			prev[0] = value
+			#appearing from unknown is not a change
+			return last is not None and value is not None and value != last
+		return changed, True
+
+	def _edge(self, args, name, rising):
+		if len(args) != 1:
+			raise PredicateError("{}() takes one argument".format(name))
+		fn, _ = self.node(args[0])
+		prev = [None]
+
+		def edge(ctx):
+			value = fn(ctx)
+			last = prev[0]
+			prev[0] = value
+			if last is None or value is None:
+				return False
+			return (not last and bool(value)) if rising else (bool(last) and not value)
+		return edge, True
+
+	def _call_rising(self, args):
+		return self._edge(args, "rising", True)
+
+	def _call_falling(self, args):
+		return self._edge(args, "falling", False)
+
+	def _window(self, args, name):
+		if len(args) != 2:
+			raise PredicateError("{}() takes a condition and a duration".format(name))
+		fn, _ = self.node(args[0])
+		return fn, parse_duration(self.constant(args[1]))
+
+	def _call_within(self, args):
+		fn, period = self._window(args, "within")
+		last = [None]
+
+		def within(ctx):
+			now = ctx.now
+			if fn(ctx):
+				#an edge is true for one evaluation only, keep time running from it
+				last[0] = now
+				ctx.wakeAt(now + period)
+				return True
+			seen = last[0]
+			#compare with the deadline we wake at, now - seen can round below period
+			if seen is None or now >= seen + period:
+				return False
+			ctx.wakeAt(seen + period)
+			return True
+		return within, True
+
+	def _call_held(self, args):
+		fn, period = self._window(args, "held")
+		since = [None]
+
+		def held(ctx):
+			now = ctx.now
+			if not fn(ctx):
+				since[0] = None
+				return False
+			if since[0] is None:
+				since[0] = now
+			if now >= since[0] + period:
+				return True
+			ctx.wakeAt(since[0] + period)
+			return False
+		return held, True
+
+class Predicate(object):
+	"""A compiled predicate registered with a PredicateEngine."""
+
+	def __init__(self, name, expr, fn, deps, onTrue=None, onFalse=None):
+		self.name = name
+		self.expr = expr
+		self.fn = fn
+		self.deps = frozenset(deps)
+		self.onTrue = onTrue
+		self.onFalse = onFalse
+		self.state = False
+		self.since = None
+		self.fired = 0
+		self.evaluations = 0
+		self.deadline = None
+		self.timer = None
+
+	def __repr__(self):
+		return "Predicate({}: {})".format(self.name, self.expr)
+
+class PredicateEngine(object):
+	"""Evaluates predicates when their input signals change.
+
+	`onTrue(name, ts)` is called when a predicate becomes true and
+	`onFalse(name, ts)` when it becomes false again, so
+	`FlightRecorder.trigger` can be used as `onTrue` directly.
+
+	Args:
+		decoder: SignalDecoder providing the signals.
+		clock: time source matching the frame timestamps, used for timers.
+		loop: asyncio event loop.
+	"""
+
+	def __init__(self, decoder, clock=time.time, loop=None):
+		self.decoder = decoder
+		self.clock = clock
+		self.loop = loop
+		self.timers = None
+		self.predicates = {}
+		self.evaluations = 0
+		self._byInput = {}
+		self._ctx = _Context()
+		decoder.listen(self.signalsChanged)
+
+	def add(self, name, expr, onTrue=None, onFalse=None):
+		"""Compile and register a predicate.
+
+		Raises:
+			PredicateError if the expression is invalid.
+		"""
+		if name in self.predicates:
+			raise PredicateError("Predicate {} already defined".format(name))
+		fn, deps = _Compiler(self.decoder).compile(expr)
+		pred = Predicate(name, expr, fn, deps, onTrue, onFalse)
+		self.predicates[name] = pred
+		for dep in pred.deps:
+			self._byInput.setdefault(dep, []).append(pred)
+		self._evaluate(pred, self.clock())
+		return pred
+
+	def remove(self, name):
+		pred = self.predicates.pop(name)
+		for dep in pred.deps:
+			preds = self._byInput[dep]
+			preds.remove(pred)
+			if not preds:
+				del self._byInput[dep]
+		self._cancel(pred)
+
+	def stop(self):
+		for pred in self.predicates.values():
+			self._cancel(pred)
+		self.decoder.unlisten(self.signalsChanged)
+
+	def state(self, name):
+		return self.predicates[name].state
+
+	def signalsChanged(self, changes, ts):
+		"""SignalDecoder listener."""
+		byInput = self._byInput
+		if len(changes) == 1:
+			affected = byInput.get(changes[0][0], ())
+		else:
+			#dict keeps registration order and evaluates each predicate once
+			affected = {}
+			for name, _ in changes:
+				for pred in byInput.get(name, ()):
+					affected[pred] = None
+		if not affected:
+			return
+		now = ts if ts is not None else self.clock()
+		for pred in list(affected):
+			self._evaluate(pred, now)
+
+	def metrics(self):
+		ret = [
+			("carbus_predicates", {}, len(self.predicates)),
+			("carbus_predicate_evaluations_total", {}, self.evaluations),
+		]
+		for pred in self.predicates.values():
+			labels = {"predicate": pred.name}
+			ret.append(("carbus_predicate_state", labels, int(pred.state)))
+			ret.append(("carbus_predicate_fired_total", labels, pred.fired))
+		return ret
+
+	########################
+	# Internal Methods
+	########################
+	def _evaluate(self, pred, now):
+		ctx = self._ctx
+		ctx.now = now
+		ctx.deadline = None
+		self.evaluations += 1
+		pred.evaluations += 1
+		try:
+			result = bool(pred.fn(ctx))
+		except Exception as exc:
+			logging.error("Predicate {}: {}".format(pred.name, exc))
+			result = False
+		if ctx.deadline != pred.deadline:
+			if ctx.deadline is None:
+				self._cancel(pred)
+			else:
+				self._schedule(pred, ctx.deadline)
+		if result == pred.state:
+			return
+		pred.state = result
+		pred.since = now
+		callback = pred.onTrue if result else pred.onFalse
+		if result:
+			pred.fired += 1
+		if callback is not None:
+			try:
+				callback(pred.name, now)
+			except Exception as exc:
+				logging.error("Predicate {} callback: {}".format(pred.name, exc))
+
+	def _schedule(self, pred, deadline):
+		if self.timers is None:
+			if self.loop is None:
+				self.loop = asyncio.get_event_loop()
+			self.timers = get_timer_service(self.loop)
+		pred.deadline = deadline
+		delay = max(deadline - self.clock(), 0.0)
+		if pred.timer is None:
+			pred.timer = self.timers.call_later(delay, self._timer, pred)
+		else:
+			self.timers.rearm(pred.timer, delay)
+
+	def _timer(self, pred):
+		deadline = pred.deadline
+		pred.deadline = None
+		if self.predicates.get(pred.name) is pred:
+			#the loop clock and ours may drift, never evaluate before the deadline
+			self._evaluate(pred, max(self.clock(), deadline))
+
+	def _cancel(self, pred):
+		if pred.timer is not None:
+			pred.timer.cancel()
+		pred.deadline = None
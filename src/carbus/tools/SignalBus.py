@@ -0,0 +1,199 @@
+"""Signal publish/subscribe
+
+File: SignalBus.py
+
+Description:
+	SignalBus dispatches the changes reported by a SignalDecoder to clients
+	subscribed to single signals. Each frame is decoded once by the decoder;
+	the bus only looks at the subscribers of the signals that changed and
+	filters further per subscription:
+
+		- on change (default): every new value
+		- deadband: only when the value moved by at least `deadband`, or by
+		  `percent` of the last delivered value
+		- max_rate: at most that many deliveries per second, the newest
+		  value is delivered at the end of a suppressed period
+		- sample: the latest value every `sample` seconds, whether it
+		  changed or not
+"""
+
+import asyncio
+import logging
+import time
+
+from .TimerService import get_timer_service
+
+class Subscription(object):
+	"""One client of one signal, see SignalBus.subscribe."""
+
+	def __init__(self, bus, signal, callback, deadband=None, percent=None, max_rate=None, sample=None):
+		self.bus = bus
+		self.signal = signal
+		self.callback = callback
+		self.deadband = deadband
+		self.percent = percent
+		self.interval = 1.0 / max_rate if max_rate else None
+		self.sample = sample
+		self.value = None
+		self.ts = None
+		self.delivered = 0
+		self.suppressed = 0
+		#bus clock of the last delivery, max_rate counts from it and not from value timestamps
+		self._sent = None
+		self._pending = None
+		self._handle = None
+
+	def __repr__(self):
+		return "Subscription({}, {})".format(self.signal, self.callback)
+
+	def offer(self, value, ts):
+		"""A new value of the signal was decoded."""
+		if self.sample is not None:
+			return
+		if not self._outsideDeadband(value):
+			self.suppressed += 1
+			#a pending value is superseded by one the client does not need
+			self._pending = None
+			return
+		interval = self.interval
+		if interval is not None and self._sent is not None and self.bus.clock() - self._sent < interval:
+			self.suppressed += 1
+			self._pending = (value, ts)
+			if self._handle is None:
+				self._handle = self.bus._later(self._sent + interval, self._flush)
+			return
+		self._pending = None
+		self._deliver(value, ts)
+
+	def cancel(self):
+		if self._handle is not None:
+			self._handle.cancel()
+			self._handle = None
+		self._pending = None
+
+	########################
+	# Internal Methods
+	########################
+	def _outsideDeadband(self, value):
+		last = self.value
+		if self.ts is None:
+			return True
+		if last is None or value is None or (self.deadband is None and self.percent is None):
+			return value != last
+		delta = abs(value - last)
+		if self.deadband is not None and delta >= self.deadband:
+			return True
+		if self.percent is not None and delta >= abs(last) * self.percent / 100.0 and delta > 0:
+			return True
+		return False
+
+	def _flush(self):
+		self._handle = None
+		if self._pending is not None:
+			value, ts = self._pending
+			self._pending = None
+			self._deliver(value, ts)
+
+	def _sample(self):
+		#from the previous deadline, the tick the timer fired late by must not add up
+		self._handle.reschedule(self._handle.when + self.sample)
+		name = self.signal
+		self._deliver(self.bus.decoder.values.get(name), self.bus.decoder.stamps.get(name))
+
+	def _deliver(self, value, ts):
+		self.value = value
+		self.ts = ts
+		self._sent = self.bus.clock()
+		self.delivered += 1
+		try:
+			self.callback(self.signal, value, ts)
+		except Exception as exc:
+			logging.error("Signal subscriber {}: {}".format(self, exc))
+
+class SignalBus(object):
+	"""Dispatches decoded signal changes to per-signal subscribers.
+
+	Args:
+		decoder: SignalDecoder providing the values.
+		clock: time source matching the frame timestamps, used for timers.
+		loop: asyncio event loop.
+	"""
+
+	def __init__(self, decoder, clock=time.time, loop=None):
+		self.decoder = decoder
+		self.clock = clock
+		self.loop = loop
+		self.timers = None
+		self._bySignal = {}
+		decoder.listen(self.signalsChanged)
+
+	def subscribe(self, signal, callback, deadband=None, percent=None, max_rate=None, sample=None):
+		"""Subscribe to a signal.
+
+		Args:
+			signal: signal name known to the decoder.
+			callback: callable(name, value, ts).
+			deadband: absolute change needed for a delivery.
+			percent: change in percent of the last delivered value needed
+				for a delivery.
+			max_rate: maximum deliveries per second.
+			sample: deliver the latest value every `sample` seconds
+				instead of on change.
+
+		Returns:
+			Subscription, pass it to `unsubscribe`.
+		"""
+		if signal not in self.decoder.signals:
+			raise KeyError("Unknown signal {}".format(signal))
+		sub = Subscription(self, signal, callback, deadband, percent, max_rate, sample)
+		self._bySignal.setdefault(signal, []).append(sub)
+		if sample is not None:
+			sub._handle = self._later(self.clock() + sample, sub._sample)
+		return sub
+
+	def unsubscribe(self, sub):
+		sub.cancel()
+		subs = self._bySignal.get(sub.signal, [])
+		if sub in subs:
+			subs.remove(sub)
+			if not subs:
+				del self._bySignal[sub.signal]
+
+	def stop(self):
+		for subs in self._bySignal.values():
+			for sub in subs:
+				sub.cancel()
+		self._bySignal = {}
+		self.decoder.unlisten(self.signalsChanged)
+
+	def latest(self, signal):
+		"""Latest decoded value and its timestamp."""
+		return self.decoder.values[signal], self.decoder.stamps[signal]
+
+	def signalsChanged(self, changes, ts):
+		"""SignalDecoder listener."""
+		bySignal = self._bySignal
+		for name, value in changes:
+			subs = bySignal.get(name)
+			if subs is not None:
+				for sub in subs:
+					sub.offer(value, ts)
+
+	def metrics(self):
+		ret = []
+		for name, subs in self._bySignal.items():
+			labels = {"signal": name}
+			ret.append(("carbus_signal_subscribers", labels, len(subs)))
+			ret.append(("carbus_signal_deliveries_total", labels, sum(sub.delivered for sub in subs)))
+			ret.append(("carbus_signal_suppressed_total", labels, sum(sub.suppressed for sub in subs)))
+		return ret
+
+	########################
+	# Internal Methods
+	########################
+	def _later(self, when, callback):
+		if self.timers is None:
+			if self.loop is None:
+				self.loop = asyncio.get_event_loop()
+			self.timers = get_timer_service(self.loop)
+		return self.timers.call_later(max(when - self.clock(), 0.0), callback)
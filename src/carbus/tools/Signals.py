@@ -0,0 +1,279 @@
+"""Signal decoding
+
+File: Signals.py
+
+Description:
+	Signals are bit fields of a CAN frame payload scaled to a physical value,
+	as described in a DBC file. SignalDecoder is a CANPort stage that decodes
+	the signals of every frame it knows, keeps the latest value of each and
+	tells its listeners which signals changed. A frame whose payload is equal
+	to the previous one of the same id is not decoded at all, so periodic
+	traffic that does not change costs one dict lookup and one compare.
+
+	SignalConsumer wraps a decoder in a FrameConsumer for code that attaches
+	protocols instead of stages.
+"""
+
+import logging
+
+from .FrameConsumer import FrameConsumer
+from ..can.SocketCAN import CAN_EFF_MASK, CAN_SFF_MASK, CANAddress, CANFilter, FRAME_LEN
+
+class Signal(object):
+	"""One signal of a CAN frame.
+
+	Args:
+		name: unique signal name.
+		can_id: id of the frame carrying the signal.
+		start: start bit. For little endian (Intel) signals this is the
+			least significant bit, for big endian (Motorola) signals the
+			most significant bit, both numbered like a DBC file does.
+		length: length in bits.
+		little_endian: byte order of the signal.
+		signed: two's complement signal.
+		factor: physical = raw * factor + offset.
+		offset: see factor.
+	"""
+
+	#values of fields that can change while the payload does not
+	always = False
+
+	def __init__(self, name, can_id, start, length, little_endian=True, signed=False, factor=1, offset=0):
+		if length < 1 or length > 8 * FRAME_LEN:
+			raise ValueError("Invalid signal length {} for {}".format(length, name))
+		self.name = name
+		self.can_id = can_id
+		self.start = start
+		self.length = length
+		self.little_endian = little_endian
+		self.signed = signed
+		self.factor = factor
+		self.offset = offset
+		self.decode = self._compile()
+
+	def __repr__(self):
+		return "Signal({}, can_id=0x{:x}, start={}, length={}, {})".format(
+			self.name, self.can_id, self.start, self.length, "intel" if self.little_endian else "motorola"
+		)
+
+	def _compile(self):
+		"""Build `decode(data)`, returning the physical value or None when
+		the payload is too short to hold the signal.
+		"""
+		length = self.length
+		mask = (1 << length) - 1
+		sign = 1 << (length - 1) if self.signed else 0
+		factor = self.factor
+		offset = self.offset
+		scaled = factor != 1 or offset != 0
+		if self.little_endian:
+			shift = self.start
+			need = (self.start + length + 7) // 8
+			order = "little"
+		else:
+			#DBC numbers Motorola bits msb first within a byte, count from the msb of byte 0 instead
+			msb = (self.start // 8) * 8 + 7 - self.start % 8
+			lsb = msb + length - 1
+			need = lsb // 8 + 1
+			shift = need * 8 - 1 - lsb
+			order = "big"
+		if need > FRAME_LEN:
+			raise ValueError("Signal {} does not fit in a frame".format(self.name))
+
+		def decode(data):
+			if len(data) < need:
+				return None
+			raw = (int.from_bytes(data[:need], order) >> shift) & mask
+			if raw & sign:
+				raw -= sign << 1
+			if scaled:
+				return raw * factor + offset
+			return raw
+		return decode
+
+class FrameField(object):
+	"""A field of the frame itself used like a signal.
+
+	Args:
+		can_id: frame id.
+		field: "dlc" (payload length), "byte" (one payload byte) or
+			"count" (number of frames received).
+		index: byte index for "byte".
+		name: signal name, defaults to `field(0x<id>[, index])`.
+	"""
+
+	FIELDS = ("dlc", "byte", "count")
+
+	def __init__(self, can_id, field, index=None, name=None):
+		if field not in self.FIELDS:
+			raise ValueError("Unknown frame field {}".format(field))
+		if field == "byte" and (index is None or not 0 <= index < FRAME_LEN):
+			raise ValueError("Invalid byte index {}".format(index))
+		self.can_id = can_id
+		self.field = field
+		self.index = index
+		if name is None:
+			name = "{}(0x{:x}{})".format(field, can_id, "" if index is None else ", {}".format(index))
+		self.name = name
+		#the frame count changes with every frame, not only with the payload
+		self.always = field == "count"
+		self._count = 0
+
+	def __repr__(self):
+		return "FrameField({})".format(self.name)
+
+	def decode(self, data):
+		if self.field == "dlc":
+			return len(data)
+		if self.field == "byte":
+			return data[self.index] if len(data) > self.index else None
+		self._count += 1
+		return self._count
+
+class _IdEntry(object):
+	__slots__ = ("signals", "always", "data", "ts")
+
+	def __init__(self):
+		self.signals = []
+		self.always = []
+		self.data = None
+		self.ts = None
+
+class SignalDecoder(object):
+	"""CANPort stage decoding signals and reporting changes.
+
+	Listeners are called as `listener(changes, ts)` once per frame that
+	changed at least one signal, with `changes` a list of (name, value)
+	and `ts` the frame timestamp.
+
+	Args:
+		signals: iterable of Signal / FrameField objects.
+		onChange: optional first listener.
+	"""
+
+	def __init__(self, signals=(), onChange=None):
+		self.signals = {}
+		#latest value per signal name, None until decoded
+		self.values = {}
+		#timestamp of the frame that last changed each signal
+		self.stamps = {}
+		self.frames = 0
+		self.decoded = 0
+		self._byId = {}
+		self._listeners = []
+		for sig in signals:
+			self.add(sig)
+		if onChange is not None:
+			self.listen(onChange)
+
+	@property
+	def ids(self):
+		return list(self._byId)
+
+	def add(self, signal):
+		"""Add a signal, returns the registered signal of that name."""
+		known = self.signals.get(signal.name)
+		if known is not None:
+			if known.can_id != signal.can_id:
+				raise ValueError("Signal {} already defined on 0x{:x}".format(signal.name, known.can_id))
+			return known
+		self.signals[signal.name] = signal
+		self.values[signal.name] = None
+		self.stamps[signal.name] = None
+		entry = self._byId.get(signal.can_id)
+		if entry is None:
+			entry = self._byId[signal.can_id] = _IdEntry()
+		entry.signals.append(signal)
+		if signal.always:
+			entry.always.append(signal)
+		#decode the next frame of that id even if its payload did not change
+		entry.data = None
+		return signal
+
+	def listen(self, listener):
+		self._listeners.append(listener)
+
+	def unlisten(self, listener):
+		self._listeners.remove(listener)
+
+	def lastSeen(self, can_id):
+		"""Timestamp of the last frame of `can_id`, changed or not."""
+		entry = self._byId.get(can_id)
+		return None if entry is None else entry.ts
+
+	########################
+	# Stage Interface
+	########################
+	def process(self, frames):
+		byId = self._byId
+		values = self.values
+		for frame in frames:
+			entry = byId.get(frame.addr)
+			if entry is None or frame.rtr:
+				continue
+			self.frames += 1
+			data = frame.data
+			entry.ts = frame.ts
+			if data == entry.data:
+				signals = entry.always
+				if not signals:
+					continue
+			else:
+				entry.data = data
+				signals = entry.signals
+			self.decoded += 1
+			changes = None
+			for sig in signals:
+				value = sig.decode(data)
+				name = sig.name
+				if value != values[name]:
+					values[name] = value
+					if changes is None:
+						changes = []
+					changes.append((name, value))
+			if changes is not None:
+				self._notify(changes, frame.ts)
+
+	def decode(self, frame):
+		"""Decode all signals of one frame without touching the state."""
+		entry = self._byId.get(frame.addr)
+		if entry is None:
+			return {}
+		return {sig.name: sig.decode(frame.data) for sig in entry.signals if not sig.always}
+
+	########################
+	# Internal Methods
+	########################
+	def _notify(self, changes, ts):
+		stamps = self.stamps
+		for name, _ in changes:
+			stamps[name] = ts
+		for listener in self._listeners:
+			try:
+				listener(changes, ts)
+			except Exception as exc:
+				logging.error("Signal listener {}: {}".format(listener, exc))
+
+class SignalConsumer(FrameConsumer):
+	"""FrameConsumer feeding received frames into a SignalDecoder."""
+
+	def __init__(self, decoder, loop=None):
+		super(SignalConsumer, self).__init__(cobIds=decoder.ids, loop=loop)
+		self.decoder = decoder
+
+	def getFilters(self):
+		filters = []
+		for cob in self.decoder.ids:
+			if cob > CAN_SFF_MASK:
+				filters.append(CANFilter(cob, CAN_EFF_MASK, CANAddress.Extended))
+			else:
+				filters.append(CANFilter(cob, CAN_SFF_MASK, CANAddress.Standard))
+		return filters
+
+	def transform(self, frame):
+		self.decoder.process((frame,))
+		return frame
+
+	def process_single_frame(self, frame):
+		self.curr_raw_frame = frame
+		self.transform(frame)
@@ -0,0 +1,142 @@
+"""Shared protocol timer service
+
+File: TimerService.py
+
+Description:
+	Protocol timers (ISO-TP N_Bs/N_Cr, UDS P2/P2*, change filter and cycle timeouts,
+	predicate deadlines, ...) are armed and cancelled on nearly every frame.
+	With `loop.call_later` each of those is a new TimerHandle pushed on the
+	event loop heap and a cancelled entry left behind in it.
+
+	TimerService is a TimerWheel driven by the event loop: arming, cancelling
+	and re-arming a timer only touches the wheel, and the service keeps a
+	single loop callback at the next tick that has timers. The loop is woken
+	at most once per tick and not at all while no timer is pending. Timers
+	are late by up to one `resolution`.
+
+	`get_timer_service(loop)` returns the service shared by all carbus
+	protocols of a loop.
+"""
+
+import asyncio
+import math
+import weakref
+
+from .TimerWheel import TimerWheel
+
+DEFAULT_RESOLUTION = 0.001
+
+_services = weakref.WeakKeyDictionary()
+
+def get_timer_service(loop=None, resolution=None):
+	"""Shared TimerService of `loop`.
+
+	Args:
+		loop: asyncio event loop, the current one when None.
+		resolution: tick used when the service is created, later calls
+			get the existing service whatever they ask for.
+	"""
+	if loop is None:
+		loop = asyncio.get_event_loop()
+	service = _services.get(loop)
+	if service is None:
+		service = _services[loop] = TimerService(resolution or DEFAULT_RESOLUTION, loop)
+	return service
+
+class TimerService(TimerWheel):
+	"""TimerWheel on the loop clock with one loop callback per tick.
+
+	Args:
+		resolution: tick length in seconds.
+		loop: asyncio event loop.
+	"""
+
+	def __init__(self, resolution=DEFAULT_RESOLUTION, loop=None):
+		if loop is None:
+			loop = asyncio.get_event_loop()
+		super(TimerService, self).__init__(resolution, loop.time())
+		self.loop = loop
+		self.wakeups = 0
+		self._handle = None
+		self._wakeTick = None
+		self._running = False
+
+	def time(self):
+		"""Current loop time, the clock `call_at` expects."""
+		return self.loop.time()
+
+	def call_later(self, delay, callback, *args):
+		"""Like `loop.call_later`, returns a Timer with `cancel()`."""
+		return self.schedule(self.loop.time() + delay, callback, *args)
+
+	def call_at(self, when, callback, *args):
+		"""Like `loop.call_at`, `when` is loop time."""
+		return self.schedule(when, callback, *args)
+
+	def rearm(self, timer, delay):
+		"""Move (or restart) `timer` to expire `delay` seconds from now."""
+		self.reschedule(timer, self.loop.time() + delay)
+		return timer
+
+	def schedule(self, when, callback, *args):
+		self._catchUp()
+		timer = super(TimerService, self).schedule(when, callback, *args)
+		self._wake(timer.tick)
+		return timer
+
+	def reschedule(self, timer, when):
+		self._catchUp()
+		super(TimerService, self).reschedule(timer, when)
+		self._wake(timer.tick)
+
+	def close(self):
+		"""Stop waking the loop, pending timers do not fire anymore."""
+		if self._handle is not None:
+			self._handle.cancel()
+			self._handle = None
+		self._wakeTick = None
+
+	def metrics(self):
+		return [
+			("carbus_timers_pending", {}, len(self)),
+			("carbus_timers_fired_total", {}, self.fired),
+			("carbus_timer_wakeups_total", {}, self.wakeups),
+		]
+
+	########################
+	# Internal Methods
+	########################
+	def _catchUp(self):
+		"""Nothing advances an empty wheel, move it to the current tick
+		before arming the first timer so the idle ticks are not walked.
+		"""
+		if self._count == 0 and not self._running:
+			self._expire(int(math.floor(self.loop.time() / self.resolution)))
+
+	def _wake(self, tick):
+		"""Make sure the loop calls us no later than `tick`."""
+		if self._running:
+			#_run reschedules itself once the expired timers are done
+			return
+		tick = max(tick, self._next)
+		if self._wakeTick is not None and self._wakeTick <= tick:
+			return
+		if self._handle is not None:
+			self._handle.cancel()
+		self._wakeTick = tick
+		self._handle = self.loop.call_at(tick * self.resolution, self._run)
+
+	def _run(self):
+		#the loop may run a callback a little before its time, expire at least the tick we were woken for
+		target = max(int(math.floor(self.loop.time() / self.resolution)), self._wakeTick)
+		self._handle = None
+		self._wakeTick = None
+		self.wakeups += 1
+		self._running = True
+		try:
+			self._expire(target)
+		finally:
+			self._running = False
+		tick = self._nextTick()
+		if tick is not None:
+			self._wake(tick)
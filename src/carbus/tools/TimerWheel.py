@@ -0,0 +1,224 @@
+"""Hierarchical timer wheel
+
+File: TimerWheel.py
+
+Description:
+	TimerWheel keeps timers in buckets of time instead of a heap, like the
+	classic Linux kernel timer wheel: time is cut into ticks of `resolution`
+	seconds, the first level has one bucket per tick for the next 256 ticks
+	and four more levels of 64 buckets each cover ranges 64 times coarser.
+	Timers of the coarser levels are moved down ("cascaded") when the lower
+	level wraps around.
+
+	Scheduling, rescheduling and cancelling a timer is a dict insert or
+	delete, independent of the number of timers, and `advance` jumps from
+	one tick with work (a non-empty bucket or a cascade) to the next, so
+	ticks without timers cost nothing. Timers fire at the first tick
+	boundary at or after their expiry, so they are late by at most one tick.
+
+	The wheel does not know about asyncio; whoever owns it calls `advance`
+	with the current time.
+"""
+
+import logging
+import math
+
+#bits per level: level 0 has 256 buckets, the others 64
+LEVEL_BITS = (8, 6, 6, 6, 6)
+
+class Timer(object):
+	"""A timer scheduled on a TimerWheel, returned by `schedule`."""
+	__slots__ = ("wheel", "when", "tick", "callback", "args", "_bucket")
+
+	def __init__(self, wheel, when, tick, callback, args):
+		self.wheel = wheel
+		self.when = when
+		self.tick = tick
+		self.callback = callback
+		self.args = args
+		self._bucket = None
+
+	def __repr__(self):
+		return "Timer(when={}, callback={})".format(self.when, self.callback)
+
+	@property
+	def active(self):
+		return self._bucket is not None
+
+	def cancel(self):
+		self.wheel.cancel(self)
+
+	def reschedule(self, when):
+		self.wheel.reschedule(self, when)
+
+class TimerWheel(object):
+	"""Timers with O(1) schedule/cancel and one bucket scan per tick.
+
+	Args:
+		resolution: tick length in seconds.
+		now: current time, the wheel starts at the tick containing it.
+	"""
+
+	def __init__(self, resolution=0.001, now=0.0):
+		self.resolution = resolution
+		self._levels = [[{} for _ in range(1 << bits)] for bits in LEVEL_BITS]
+		self._shifts = []
+		shift = 0
+		for bits in LEVEL_BITS:
+			self._shifts.append(shift)
+			shift += bits
+		self._span = 1 << shift
+		#next tick to expire
+		self._next = int(math.floor(now / resolution)) + 1
+		self._count = 0
+		self.fired = 0
+
+	def __len__(self):
+		return self._count
+
+	@property
+	def expired_until(self):
+		"""Time up to which the wheel has expired its timers."""
+		return (self._next - 1) * self.resolution
+
+	def schedule(self, when, callback, *args):
+		"""Call `callback(*args)` once the wheel is advanced past `when`."""
+		timer = Timer(self, when, self._tick(when), callback, args)
+		self._insert(timer)
+		self._count += 1
+		return timer
+
+	def reschedule(self, timer, when):
+		"""Move a timer, also re-arms one that already fired or was cancelled."""
+		if timer._bucket is not None:
+			del timer._bucket[timer]
+		else:
+			self._count += 1
+		timer.when = when
+		timer.tick = self._tick(when)
+		self._insert(timer)
+
+	def cancel(self, timer):
+		bucket = timer._bucket
+		if bucket is not None:
+			del bucket[timer]
+			timer._bucket = None
+			self._count -= 1
+
+	def advance(self, now):
+		"""Fire every timer due at `now`.
+
+		Returns:
+			number of timers fired.
+		"""
+		return self._expire(int(math.floor(now / self.resolution)))
+
+	def next_expiry(self):
+		"""Time of the next non-empty level 0 bucket, a coarser estimate
+		(the next cascade of a non-empty bucket) when that comes first,
+		None without timers.
+		"""
+		tick = self._nextTick()
+		return None if tick is None else tick * self.resolution
+
+	########################
+	# Internal Methods
+	########################
+	def _expire(self, target):
+		"""Expire every tick up to and including `target`."""
+		if self._count == 0:
+			if target >= self._next:
+				self._next = target + 1
+			return 0
+		fired = 0
+		level0 = self._levels[0]
+		mask = len(level0) - 1
+		while self._next <= target:
+			tick = self._next
+			index = tick & mask
+			if index == 0:
+				self._cascade(tick)
+			elif not level0[index]:
+				#skip the empty ticks up to the next bucket or cascade with timers
+				tick = self._nextTick()
+				if tick > target:
+					self._next = target + 1
+					break
+				self._next = tick
+				continue
+			#timers scheduled from the callbacks for this tick go to the next one
+			self._next = tick + 1
+			bucket = level0[index]
+			if not bucket:
+				continue
+			level0[index] = {}
+			for timer in bucket:
+				timer._bucket = None
+				self._count -= 1
+				fired += 1
+				try:
+					timer.callback(*timer.args)
+				except Exception as exc:
+					logging.error("Timer {}: {}".format(timer, exc))
+			if self._count == 0:
+				self._next = target + 1
+				break
+		self.fired += fired
+		return fired
+
+	def _nextTick(self):
+		"""First tick from `_next` on that fires a level 0 bucket or cascades
+		a non-empty coarser one, None without timers.
+		"""
+		if self._count == 0:
+			return None
+		found = None
+		for level, bits in enumerate(LEVEL_BITS):
+			shift = self._shifts[level]
+			buckets = self._levels[level]
+			mask = (1 << bits) - 1
+			#a bucket of this level is cascaded at the first tick of its slot
+			slot = (self._next + (1 << shift) - 1) >> shift
+			for _ in range(1 << bits):
+				if found is not None and slot << shift >= found:
+					break
+				if buckets[slot & mask]:
+					found = slot << shift
+					break
+				slot += 1
+		return found
+
+	def _tick(self, when):
+		return int(math.ceil(when / self.resolution))
+
+	def _insert(self, timer):
+		tick = timer.tick
+		delta = tick - self._next
+		if delta < 0:
+			#already due, expire with the next tick
+			tick = self._next
+			delta = 0
+		elif delta >= self._span:
+			tick = self._next + self._span - 1
+			delta = self._span - 1
+		for level, bits in enumerate(LEVEL_BITS):
+			shift = self._shifts[level]
+			if delta < 1 << (shift + bits):
+				bucket = self._levels[level][(tick >> shift) & ((1 << bits) - 1)]
+				break
+		bucket[timer] = None
+		timer._bucket = bucket
+
+	def _cascade(self, tick):
+		"""Move the timers of the coarser buckets that start at `tick` down."""
+		for level in range(1, len(LEVEL_BITS)):
+			shift = self._shifts[level]
+			index = (tick >> shift) & ((1 << LEVEL_BITS[level]) - 1)
+			buckets = self._levels[level]
+			bucket = buckets[index]
+			if bucket:
+				buckets[index] = {}
+				for timer in bucket:
+					self._insert(timer)
+			if index != 0:
+				break
@@ -0,0 +1,259 @@
+"""Synthetic vehicle traffic generator.
+
+File: TrafficGenerator.py
+
+Description:
+	Emits realistic CAN traffic for load testing consumers: periodic ids at
+	their real periods with rolling counters, checksums and slowly varying
+	signals, plus bursty event frames. A profile is declared per id or
+	learned from a list of captured frames. All frames that are due at the
+	same time are written with one sendmmsg call, and `speed` scales the
+	whole profile above real time. When the interface TX queue is full the
+	rest of a batch is retried with a short backoff until the next frame is
+	due, only then it is dropped. The frames that were sent are fed into a
+	TrafficStats instance, stamped when they were written, which reports the
+	achieved rate and period jitter per id.
+"""
+
+import asyncio
+import heapq
+import random
+import statistics
+import time
+
+from ..can.SocketCAN import CANFrame
+from .TrafficStats import TrafficStats
+
+SEND_BACKOFF = 0.0005 #first wait for room in a full TX queue, doubled per retry
+SEND_BACKOFF_MAX = 0.008
+
+class RampSignal(object):
+	"""Slowly varying signal that ramps between `lo` and `hi` and back.
+
+	Args:
+		start: first byte of the signal.
+		length: signal length in bytes (big endian).
+		step: change per frame.
+	"""
+
+	def __init__(self, start, length=1, lo=0, hi=None, step=1):
+		self.start = start
+		self.length = length
+		self.lo = lo
+		self.hi = (1 << (8 * length)) - 1 if hi is None else hi
+		self.step = step
+		self.value = lo
+		self._dir = 1
+
+	def apply(self, buf):
+		buf[self.start:self.start + self.length] = self.value.to_bytes(self.length, "big")
+		nxt = self.value + self._dir * self.step
+		if nxt > self.hi or nxt < self.lo:
+			self._dir = -self._dir
+			nxt = self.value + self._dir * self.step
+		self.value = min(self.hi, max(self.lo, nxt))
+
+class IdProfile(object):
+	"""Traffic description of one CAN id.
+
+	Args:
+		addr: CAN id.
+		period: cycle time in seconds, for event frames the mean time
+			between bursts.
+		payload: template payload, its length is the DLC.
+		counter: (byte, shift, bits) of a rolling counter, e.g. (6, 0, 4)
+			for a nibble counter in the low half of byte 6.
+		checksum: (byte, kind) with kind "sum" or "xor" over the other bytes.
+		signals: list of RampSignal objects.
+		event: frame is sent in random bursts instead of cyclically.
+		burst: maximum number of frames in an event burst.
+	"""
+
+	def __init__(self, addr, period, payload=bytes(8), ext=False, counter=None, checksum=None,
+			signals=(), event=False, burst=3):
+		self.addr = addr
+		self.period = period
+		self.payload = bytearray(payload)
+		self.ext = ext
+		self.counter = counter
+		self.checksum = checksum
+		self.signals = list(signals)
+		self.event = event
+		self.burst = burst
+		self._count = 0
+
+	def next_payload(self):
+		buf = self.payload
+		for sig in self.signals:
+			sig.apply(buf)
+		if self.counter is not None:
+			byte, shift, bits = self.counter
+			mask = ((1 << bits) - 1) << shift
+			buf[byte] = (buf[byte] & ~mask & 0xFF) | ((self._count << shift) & mask)
+			self._count += 1
+		if self.checksum is not None:
+			byte, kind = self.checksum
+			total = 0
+			for i, b in enumerate(buf):
+				if i == byte:
+					continue
+				total = total ^ b if kind == "xor" else total + b
+			buf[byte] = total & 0xFF
+		return bytes(buf)
+
+	def next_interval(self, rng):
+		if self.event:
+			return rng.expovariate(1.0 / self.period)
+		return self.period
+
+class TrafficProfile(object):
+	"""A set of IdProfiles."""
+
+	def __init__(self, ids=()):
+		self.ids = list(ids)
+
+	def add(self, profile):
+		self.ids.append(profile)
+
+	@classmethod
+	def from_capture(cls, frames, event_jitter=0.5, min_frames=3):
+		"""Learn a profile from captured CANFrame objects.
+
+		The period of each id is the median inter-arrival time. Ids whose
+		inter-arrival times vary by more than `event_jitter` (relative
+		standard deviation) are treated as event frames. A byte that
+		increments by one per frame is modeled as a counter.
+		"""
+		byId = {}
+		for frame in frames:
+			byId.setdefault(frame.addr, []).append(frame)
+
+		ret = cls()
+		for addr, seen in sorted(byId.items()):
+			if len(seen) < min_frames:
+				continue
+			gaps = [b.ts - a.ts for a, b in zip(seen, seen[1:]) if a.ts is not None and b.ts is not None]
+			if not gaps:
+				continue
+			period = statistics.median(gaps)
+			if period <= 0:
+				continue
+			spread = statistics.pstdev(gaps) / period
+			ret.add(IdProfile(
+				addr,
+				period,
+				seen[-1].data,
+				ext=addr > 0x7FF,
+				counter=cls._find_counter(seen),
+				event=spread > event_jitter,
+			))
+		return ret
+
+	@staticmethod
+	def _find_counter(frames):
+		dlc = min(len(f.data) for f in frames)
+		for byte in range(dlc):
+			for shift, bits in ((0, 8), (0, 4), (4, 4)):
+				mask = (1 << bits) - 1
+				vals = [(f.data[byte] >> shift) & mask for f in frames]
+				if len(set(vals)) > 2 and all((b - a) & mask == 1 for a, b in zip(vals, vals[1:])):
+					return (byte, shift, bits)
+		return None
+
+class TrafficGenerator(object):
+	"""Play a TrafficProfile onto a SocketCAN socket.
+
+	Args:
+		socket: bound SocketCAN socket.
+		profile: TrafficProfile to play.
+		speed: 1.0 plays the profile in real time, 2.0 twice as fast.
+		seed: seed for the event frame timing.
+	"""
+
+	def __init__(self, socket, profile, speed=1.0, seed=None):
+		self.socket = socket
+		self.profile = profile
+		self.speed = speed
+		self.stats = TrafficStats()
+		self.sent = 0
+		self.dropped = 0
+		#per CAN id, frames still unsent when the next ones were due
+		self.dropped_ids = {}
+		self.retries = 0
+		self._rng = random.Random(seed)
+
+	async def run(self, duration):
+		"""Generate traffic for `duration` seconds.
+
+		Returns:
+			dict of CAN id -> IdStats describing the traffic actually sent.
+		"""
+		loop = asyncio.get_event_loop()
+		start = loop.time()
+		end = start + duration
+		heap = []
+		for i, prof in enumerate(self.profile.ids):
+			heapq.heappush(heap, (start + prof.next_interval(self._rng) / self.speed * self._rng.random(), i))
+
+		while heap:
+			now = loop.time()
+			if now >= end:
+				break
+			due = []
+			dueExt = []
+			while heap and heap[0][0] <= now:
+				when, i = heapq.heappop(heap)
+				prof = self.profile.ids[i]
+				count = self._rng.randint(1, prof.burst) if prof.event else 1
+				frames = dueExt if prof.ext else due
+				for _ in range(count):
+					frames.append(CANFrame(prof.next_payload(), prof.addr, False))
+				nxt = when + prof.next_interval(self._rng) / self.speed
+				if nxt < now:
+					#fell behind by more than a period, resync instead of bursting
+					nxt = now + prof.next_interval(self._rng) / self.speed
+				heapq.heappush(heap, (nxt, i))
+
+			#a full TX queue is retried until the next frame is due
+			deadline = heap[0][0] if heap else end
+			if due:
+				await self._send(due, deadline)
+			if dueExt:
+				await self._send(dueExt, deadline, ext=True)
+			delay = heap[0][0] - loop.time() if heap else 0.0
+			await asyncio.sleep(max(0.0, delay))
+		return self.report()
+
+	def report(self):
+		return self.stats.snapshot()
+
+	async def _send(self, frames, deadline, ext=False):
+		"""Write `frames`, backing off while the TX queue is full. What is
+		still unsent at `deadline` (loop time) is dropped.
+		"""
+		loop = asyncio.get_event_loop()
+		sent = 0
+		backoff = SEND_BACKOFF
+		while sent < len(frames):
+			n = self.socket.write_batch(frames[sent:], ext)
+			if n > 0:
+				self._sent(frames[sent:sent + n])
+				sent += n
+				backoff = SEND_BACKOFF
+				continue
+			wait = min(backoff, deadline - loop.time())
+			if wait <= 0:
+				break
+			self.retries += 1
+			await asyncio.sleep(wait)
+			backoff = min(backoff * 2, SEND_BACKOFF_MAX)
+		for frame in frames[sent:]:
+			self.dropped_ids[frame.addr] = self.dropped_ids.get(frame.addr, 0) + 1
+		self.dropped += len(frames) - sent
+
+	def _sent(self, frames):
+		ts = time.time()
+		for frame in frames:
+			frame.ts = ts
+		self.stats.process(frames)
+		self.sent += len(frames)
@@ -0,0 +1,312 @@
+"""Per CAN id traffic statistics.
+
+File: TrafficStats.py
+
+Description:
+	TrafficStats is a CANPort stage that keeps frame rate, inter-arrival
+	jitter, DLC changes and payload change counts for every CAN id. The
+	accumulators are flat `array` columns indexed by the 11-bit id, 29-bit
+	ids get a slot appended to the same columns through a dict.
+
+	`process` only appends the batch to a pending list. Once per window,
+	or when `fold_frames` are pending, it schedules a fold with
+	`loop.call_soon`, so the fold runs after the read callback instead of
+	inside it; `snapshot` folds right away. The fold groups the frames by
+	id and computes every statistic of an id with one builtin
+	`map`/`sum`/`min`/`max` pass over its timestamps or payloads, so the
+	per-frame work runs in C instead of the interpreter loop.
+"""
+
+import array
+import asyncio
+import math
+import time
+from collections import namedtuple
+from itertools import islice
+from operator import attrgetter, mul, ne, sub
+
+from ..can.SocketCAN import CAN_SFF_MASK, CANFrame
+
+SFF_SLOTS = CAN_SFF_MASK + 1
+
+_getTs = attrgetter("ts")
+_getData = attrgetter("data")
+
+IdStats = namedtuple(
+	"IdStats",
+	(
+		"count", #frames seen since the last reset
+		"rate", #frames/s since the first frame
+		"window_rate", #frames/s over the last complete window
+		"period", #mean inter-arrival time (s)
+		"jitter", #standard deviation of the inter-arrival time (s)
+		"min_period",
+		"max_period",
+		"dlc", #last DLC seen
+		"dlc_changes",
+		"payload_changes",
+		"change_rate", #payload changes/s over the last complete window
+	),
+)
+
+class TrafficStats(object):
+	"""Statistics stage for CANPort batches.
+
+	Register it with `CANPort.addStage`, or feed it lists of CANFrame objects
+	through `process`.
+	"""
+
+	def __init__(self, window=1.0, fold_frames=16384, loop=None):
+		"""TrafficStats Constructor
+
+		Args:
+			window: length in seconds of the window used for `window_rate`
+				and `change_rate`.
+			fold_frames: pending frames that trigger a fold before the
+				window ends, bounds the memory held by the pending list.
+			loop: asyncio event loop that runs the folds, the running loop
+				by default. Without a running loop `process` folds itself.
+		"""
+		self.window = window
+		self.fold_frames = fold_frames
+		self.loop = loop
+		self._handle = None
+		self.reset()
+
+	def reset(self):
+		"""Drop every accumulator and start over."""
+		if self._handle is not None:
+			self._handle.cancel()
+			self._handle = None
+		self._pending = []
+		#a window ended at _rollAt, the first _rollFrames pending frames belong to it
+		self._rollAt = None
+		self._rollFrames = 0
+		self._ext = {}
+		self._ids = []
+		self._count = array.array("Q", bytes(8 * SFF_SLOTS))
+		self._first = array.array("d", bytes(8 * SFF_SLOTS))
+		self._last = array.array("d", bytes(8 * SFF_SLOTS))
+		self._sumDt = array.array("d", bytes(8 * SFF_SLOTS))
+		self._sumDt2 = array.array("d", bytes(8 * SFF_SLOTS))
+		self._minDt = array.array("d", [math.inf]) * SFF_SLOTS
+		self._maxDt = array.array("d", bytes(8 * SFF_SLOTS))
+		self._dlc = array.array("b", [-1]) * SFF_SLOTS
+		self._dlcChanges = array.array("Q", bytes(8 * SFF_SLOTS))
+		self._payload = [None] * SFF_SLOTS
+		self._changes = array.array("Q", bytes(8 * SFF_SLOTS))
+
+		self._winStart = None
+		self._winCount = array.array("Q", bytes(8 * SFF_SLOTS))
+		self._winChanges = array.array("Q", bytes(8 * SFF_SLOTS))
+		self._winRate = array.array("d", bytes(8 * SFF_SLOTS))
+		self._winChangeRate = array.array("d", bytes(8 * SFF_SLOTS))
+
+	def process(self, frames):
+		"""Queue a batch of CANFrame objects for the next fold."""
+		if not frames:
+			return
+		ts = frames[-1].ts
+		if ts is None or frames[0].ts is None:
+			#untimestamped input gets the time it was processed at
+			ts = time.time()
+			frames = [f if f.ts is not None else CANFrame(f.data, f.addr, f.rtr, ts, f.ifname) for f in frames]
+		pending = self._pending
+		pending.extend(frames)
+		if self._winStart is None:
+			self._winStart = ts
+		elif self._rollAt is None and ts - self._winStart >= self.window:
+			self._rollAt = ts
+			self._rollFrames = len(pending)
+			self._foldSoon()
+		elif len(pending) >= self.fold_frames:
+			self._foldSoon()
+
+	def snapshot(self, addrs=None):
+		"""Get the current statistics.
+
+		Args:
+			addrs: optional iterable of CAN ids, defaults to every id seen.
+
+		Returns:
+			dict of CAN id -> IdStats
+		"""
+		self._flush()
+		ret = {}
+		for addr in (self._ids if addrs is None else addrs):
+			i = self._slot(addr)
+			if i is None or not self._count[i]:
+				continue
+			n = self._count[i]
+			span = self._last[i] - self._first[i]
+			period = jitter = minP = maxP = None
+			if n > 1:
+				period = self._sumDt[i] / (n - 1)
+				var = self._sumDt2[i] / (n - 1) - period * period
+				jitter = math.sqrt(var) if var > 0.0 else 0.0
+				minP = self._minDt[i]
+				maxP = self._maxDt[i]
+			ret[addr] = IdStats(
+				n,
+				(n - 1) / span if span > 0.0 else 0.0,
+				self._winRate[i],
+				period,
+				jitter,
+				minP,
+				maxP,
+				self._dlc[i],
+				self._dlcChanges[i],
+				self._changes[i],
+				self._winChangeRate[i],
+			)
+		return ret
+
+	def metrics(self):
+		"""Flatten the snapshot into (name, labels, value) samples."""
+		ret = []
+		for addr, st in self.snapshot().items():
+			labels = {"can_id": "0x{:x}".format(addr)}
+			ret.append(("carbus_frames_total", labels, st.count))
+			ret.append(("carbus_frame_rate", labels, st.window_rate))
+			ret.append(("carbus_payload_changes_total", labels, st.payload_changes))
+			ret.append(("carbus_dlc_changes_total", labels, st.dlc_changes))
+			if st.jitter is not None:
+				ret.append(("carbus_period_seconds", labels, st.period))
+				ret.append(("carbus_jitter_seconds", labels, st.jitter))
+		return ret
+
+	########################
+	# Internal Methods
+	########################
+	def _slot(self, addr):
+		if addr < SFF_SLOTS:
+			return addr
+		return self._ext.get(addr)
+
+	def _add_ext(self, addr):
+		i = len(self._count)
+		self._ext[addr] = i
+		for col in (self._count, self._dlcChanges, self._changes, self._winCount, self._winChanges):
+			col.append(0)
+		self._payload.append(None)
+		for col in (self._first, self._last, self._sumDt, self._sumDt2, self._maxDt, self._winRate, self._winChangeRate):
+			col.append(0.0)
+		self._minDt.append(math.inf)
+		self._dlc.append(-1)
+		return i
+
+	def _foldSoon(self):
+		if self._handle is not None:
+			return
+		loop = self.loop
+		if loop is None:
+			try:
+				loop = asyncio.get_running_loop()
+			except RuntimeError:
+				loop = None
+		if loop is None or not loop.is_running():
+			#offline use, nobody would run the callback
+			self._flush()
+			return
+		self._handle = loop.call_soon(self._folded)
+
+	def _folded(self):
+		self._handle = None
+		self._flush()
+
+	def _flush(self):
+		"""Fold everything pending, closing a window that ended meanwhile."""
+		if self._rollAt is not None:
+			self._fold(self._rollFrames)
+			self._roll_window(self._rollAt)
+			self._rollAt = None
+		self._fold()
+
+	def _fold(self, count=None):
+		"""Fold the first `count` (default all) pending frames into the
+		columns, one id at a time.
+		"""
+		pending = self._pending
+		if not pending:
+			return
+		if count is not None and count < len(pending):
+			self._pending = pending[count:]
+			pending = pending[:count]
+		else:
+			self._pending = []
+		byAddr = {}
+		for frame in pending:
+			group = byAddr.get(frame.addr)
+			if group is None:
+				byAddr[frame.addr] = [frame]
+			else:
+				group.append(frame)
+
+		count = self._count
+		last = self._last
+		dlcs = self._dlc
+		payloads = self._payload
+		ext = self._ext
+		for addr, group in byAddr.items():
+			if addr < SFF_SLOTS:
+				i = addr
+			else:
+				i = ext.get(addr)
+				if i is None:
+					i = self._add_ext(addr)
+			ts = list(map(_getTs, group))
+			data = list(map(_getData, group))
+			n = count[i]
+			k = len(group)
+			if n:
+				#the pair between the previous fold and this one
+				dt = ts[0] - last[i]
+				sumDt = dt
+				sumDt2 = dt * dt
+				minDt = maxDt = dt
+				changes = data[0] != payloads[i]
+				prevDlc = dlcs[i]
+			else:
+				self._first[i] = ts[0]
+				self._ids.append(addr)
+				sumDt = sumDt2 = 0.0
+				minDt = math.inf
+				maxDt = 0.0
+				changes = 0
+				prevDlc = len(data[0])
+			if k > 1:
+				dts = list(map(sub, islice(ts, 1, None), ts))
+				sumDt += ts[-1] - ts[0]
+				sumDt2 += sum(map(mul, dts, dts))
+				minDt = min(minDt, min(dts))
+				maxDt = max(maxDt, max(dts))
+				changes += sum(map(ne, islice(data, 1, None), data))
+			if n or k > 1:
+				self._sumDt[i] += sumDt
+				self._sumDt2[i] += sumDt2
+				if minDt < self._minDt[i]:
+					self._minDt[i] = minDt
+				if maxDt > self._maxDt[i]:
+					self._maxDt[i] = maxDt
+				self._changes[i] += changes
+			lens = list(map(len, data))
+			if lens.count(prevDlc) != k:
+				self._dlcChanges[i] += sum(map(ne, lens, [prevDlc] + lens))
+			count[i] = n + k
+			last[i] = ts[-1]
+			dlcs[i] = lens[-1]
+			payloads[i] = data[-1]
+
+	def _roll_window(self, now):
+		elapsed = now - self._winStart
+		if elapsed < self.window:
+			return
+		for addr in self._ids:
+			i = self._slot(addr)
+			n = self._count[i]
+			c = self._changes[i]
+			self._winRate[i] = (n - self._winCount[i]) / elapsed
+			self._winChangeRate[i] = (c - self._winChanges[i]) / elapsed
+			self._winCount[i] = n
+			self._winChanges[i] = c
+		self._winStart = now
@@ -0,0 +1,342 @@
+"""Implementation of a UDS (ISO 14229-1) client.
+
+File: UDSClient.py
+
+Description:
+	This file contains a client for the Unified Diagnostic Services that runs
+	on top of the ISO 15765-2 transport in DoCANProtocol. Besides the single
+	request services it provides block transfers (ReadMemoryByAddress and
+	RequestUpload/TransferData) that stream into a file or buffer. Each request
+	of a transfer is issued as soon as the previous response arrives and the
+	received block is stored while the ECU works on the next one.
+"""
+
+import asyncio
+import logging
+import struct
+from enum import IntEnum
+
+NEGATIVE_RESPONSE = 0x7F
+POSITIVE_RESPONSE_OFFSET = 0x40
+SUPPRESS_POS_RSP = 0x80
+
+#client side timing (seconds), P2/P2* are replaced by the values the server
+# reports in its DiagnosticSessionControl response
+P2_CLIENT = 1.0
+P2_STAR_CLIENT = 5.0
+P2_MARGIN = 0.05
+TESTER_PRESENT_PERIOD = 2.0
+
+class UDSService(IntEnum):
+	DiagnosticSessionControl = 0x10
+	ECUReset = 0x11
+	ReadDataByIdentifier = 0x22
+	ReadMemoryByAddress = 0x23
+	RequestUpload = 0x35
+	TransferData = 0x36
+	RequestTransferExit = 0x37
+	TesterPresent = 0x3E
+
+class DiagnosticSession(IntEnum):
+	Default = 0x01
+	Programming = 0x02
+	Extended = 0x03
+
+class NRC(IntEnum):
+	"""Negative response codes"""
+	GeneralReject = 0x10
+	ServiceNotSupported = 0x11
+	SubFunctionNotSupported = 0x12
+	IncorrectMessageLengthOrInvalidFormat = 0x13
+	ResponseTooLong = 0x14
+	BusyRepeatRequest = 0x21
+	ConditionsNotCorrect = 0x22
+	RequestSequenceError = 0x24
+	RequestOutOfRange = 0x31
+	SecurityAccessDenied = 0x33
+	UploadDownloadNotAccepted = 0x70
+	TransferDataSuspended = 0x71
+	GeneralProgrammingFailure = 0x72
+	WrongBlockSequenceCounter = 0x73
+	RequestCorrectlyReceivedResponsePending = 0x78
+	ServiceNotSupportedInActiveSession = 0x7F
+
+class UDSError(RuntimeError):
+	pass
+
+class UDSTimeoutError(UDSError):
+	pass
+
+class NegativeResponseError(UDSError):
+	def __init__(self, service, code):
+		try:
+			name = NRC(code).name
+		except ValueError:
+			name = "Unknown"
+		super(NegativeResponseError, self).__init__(
+			"Service 0x{:02X} rejected: NRC 0x{:02X} ({})".format(service, code, name)
+		)
+		self.service = service
+		self.code = code
+
+def address_and_length_format(address, size, address_len, size_len):
+	"""Encode addressAndLengthFormatIdentifier, memoryAddress and memorySize."""
+	alfid = ((size_len & 0x0F) << 4) | (address_len & 0x0F)
+	return bytes([alfid]) + address.to_bytes(address_len, "big") + size.to_bytes(size_len, "big")
+
+def write_sink(sink, data):
+	"""Append a block of data to a bytearray or a file-like object."""
+	if isinstance(sink, bytearray):
+		sink += data
+	else:
+		sink.write(data)
+
+class UDSClient(object):
+	"""UDS client bound to a DoCANProtocol instance.
+
+	The protocol must already be connected to a transport and have its
+	tx_id/rx_id set to the physical request/response ids of the ECU, for
+	example 0x7E0/0x7E8.
+	"""
+
+	def __init__(self, protocol, p2=P2_CLIENT, p2_star=P2_STAR_CLIENT):
+		self.protocol = protocol
+		self.p2 = p2
+		self.p2_star = p2_star
+		self._tester_present = None
+
+	########################
+	# Request/Response
+	########################
+	async def request(self, payload, suppress_response=False):
+		"""Send a request and wait for its positive response.
+
+		Args:
+			payload: complete request including the service id.
+			suppress_response: do not wait for a response, used together
+				with the suppressPosRspMsgIndicationBit.
+
+		Returns:
+			bytes of the positive response or None if suppressed.
+
+		Raises:
+			NegativeResponseError, UDSTimeoutError
+		"""
+		await self.protocol.send(payload)
+		if suppress_response:
+			return None
+		return await self._wait_response(payload[0])
+
+	async def _wait_response(self, service):
+		"""Wait for the response to `service`.
+
+		NRC 0x78 (response pending) extends the timeout from P2 to P2* and
+		keeps waiting, as often as the server sends it.
+		"""
+		timeout = self.p2
+		while True:
+			try:
+				rsp = await self.protocol.recv(timeout)
+			except asyncio.TimeoutError:
+				raise UDSTimeoutError("Service 0x{:02X}: no response".format(service))
+
+			if len(rsp) >= 3 and rsp[0] == NEGATIVE_RESPONSE and rsp[1] == service:
+				if rsp[2] == NRC.RequestCorrectlyReceivedResponsePending:
+					timeout = self.p2_star
+					continue
+				raise NegativeResponseError(service, rsp[2])
+
+			if rsp and rsp[0] == service + POSITIVE_RESPONSE_OFFSET:
+				return rsp
+			logging.debug("UDS: dropping unexpected response {}".format(rsp.hex()))
+
+	########################
+	# Services
+	########################
+	async def diagnostic_session_control(self, session=DiagnosticSession.Default):
+		"""Switch the diagnostic session and adopt the server's P2/P2* timing.
+
+		Returns:
+			tuple of (P2, P2*) in seconds reported by the server or None.
+		"""
+		rsp = await self.request(bytes([UDSService.DiagnosticSessionControl, session]))
+		if len(rsp) < 6:
+			return None
+		p2_ms, p2_star_10ms = struct.unpack_from(">HH", rsp, 2)
+		self.p2 = p2_ms / 1000.0 + P2_MARGIN
+		self.p2_star = p2_star_10ms / 100.0 + P2_MARGIN
+		return self.p2, self.p2_star
+
+	async def tester_present(self, suppress_response=True):
+		sub = 0x00 | (SUPPRESS_POS_RSP if suppress_response else 0)
+		return await self.request(bytes([UDSService.TesterPresent, sub]), suppress_response)
+
+	def start_tester_present(self, period=TESTER_PRESENT_PERIOD):
+		"""Keep the current non-default session alive in the background."""
+		self.stop_tester_present()
+		self._tester_present = asyncio.ensure_future(self._tester_present_loop(period))
+
+	def stop_tester_present(self):
+		if self._tester_present is not None:
+			self._tester_present.cancel()
+			self._tester_present = None
+
+	async def _tester_present_loop(self, period):
+		while True:
+			try:
+				await self.tester_present()
+			except Exception as exc:
+				logging.warning("UDS TesterPresent: {}".format(exc))
+			await asyncio.sleep(period)
+
+	async def read_data_by_identifier(self, dids, lengths=None):
+		"""Read one or more data identifiers with a single request.
+
+		Args:
+			dids: int or list of ints of the DIDs to read.
+			lengths: dict of DID -> record length. Needed for every DID but
+				the last one when reading more than one DID.
+
+		Returns:
+			dict of DID -> bytes in the order of the response.
+		"""
+		if isinstance(dids, int):
+			dids = [dids]
+		lengths = lengths or {}
+		payload = bytearray([UDSService.ReadDataByIdentifier])
+		for did in dids:
+			payload += struct.pack(">H", did)
+		rsp = await self.request(bytes(payload))
+
+		ret = {}
+		pos = 1
+		for i, did in enumerate(dids):
+			got = struct.unpack_from(">H", rsp, pos)[0]
+			if got != did:
+				raise UDSError("DID mismatch: 0x{:04X} != 0x{:04X}".format(got, did))
+			pos += 2
+			length = lengths.get(did)
+			if length is None:
+				if i != len(dids) - 1:
+					raise ValueError("Length of DID 0x{:04X} is required".format(did))
+				length = len(rsp) - pos
+			ret[did] = rsp[pos:pos + length]
+			pos += length
+		return ret
+
+	async def read_memory_by_address(self, address, size, address_len=4, size_len=2):
+		payload = bytes([UDSService.ReadMemoryByAddress]) + address_and_length_format(
+			address, size, address_len, size_len
+		)
+		rsp = await self.request(payload)
+		return rsp[1:]
+
+	async def dump_memory(self, address, size, sink, block_size=0xFF0, address_len=4, size_len=2):
+		"""Read a memory range with consecutive ReadMemoryByAddress requests.
+
+		Args:
+			sink: bytearray or file-like object receiving the data.
+			block_size: number of bytes requested per ReadMemoryByAddress.
+
+		Returns:
+			number of bytes written to the sink.
+		"""
+		service = UDSService.ReadMemoryByAddress
+		offset = 0
+		count = min(block_size, size)
+		await self.protocol.send(bytes([service]) + address_and_length_format(
+			address, count, address_len, size_len
+		))
+		while True:
+			data = (await self._wait_response(service))[1:]
+			if len(data) != count:
+				raise UDSError("Short read at 0x{:X}: {} != {}".format(address + offset, len(data), count))
+			offset += count
+			if offset < size:
+				#issue the next request before storing this block
+				count = min(block_size, size - offset)
+				await self.protocol.send(bytes([service]) + address_and_length_format(
+					address + offset, count, address_len, size_len
+				))
+			write_sink(sink, data)
+			if offset >= size:
+				return offset
+
+	async def request_upload(self, address, size, data_format=0x00, address_len=4, size_len=4):
+		"""RequestUpload
+
+		Returns:
+			maxNumberOfBlockLength reported by the server.
+		"""
+		payload = bytes([UDSService.RequestUpload, data_format]) + address_and_length_format(
+			address, size, address_len, size_len
+		)
+		rsp = await self.request(payload)
+		num = rsp[1] >> 4
+		return int.from_bytes(rsp[2:2 + num], "big")
+
+	async def request_transfer_exit(self, data=b""):
+		rsp = await self.request(bytes([UDSService.RequestTransferExit]) + data)
+		return rsp[1:]
+
+	async def upload(self, address, size, sink, data_format=0x00, address_len=4, size_len=4, retries=2):
+		"""Upload a memory range from the ECU into `sink`.
+
+		Runs RequestUpload, the TransferData sequence and RequestTransferExit.
+		The blockSequenceCounter starts at 1 and wraps to 0. A block that
+		times out is requested again with the same counter, stale repeats of
+		the previous block are dropped. Data past `size` in the last block
+		(alignment padding) is not written to the sink.
+
+		Returns:
+			number of bytes written to the sink.
+
+		Raises:
+			UDSError if the server's maxNumberOfBlockLength is more than
+			the protocol's max_rx_size, the transfer is exited first.
+		"""
+		service = UDSService.TransferData
+		blockLength = await self.request_upload(address, size, data_format, address_len, size_len)
+		limit = self.protocol.max_rx_size
+		if limit is not None and blockLength > limit:
+			#every TransferData response would be refused with FC Overflow
+			try:
+				await self.request_transfer_exit()
+			except UDSError as exc:
+				logging.warning("UDS RequestTransferExit: {}".format(exc))
+			raise UDSError("Upload block length {} exceeds max_rx_size {}".format(blockLength, limit))
+
+		received = 0
+		counter = 1
+		attempts = 0
+		await self.protocol.send(bytes([service, counter]))
+		while received < size:
+			try:
+				rsp = await self._wait_response(service)
+			except UDSTimeoutError:
+				attempts += 1
+				if attempts > retries:
+					raise
+				await self.protocol.send(bytes([service, counter]))
+				continue
+
+			if len(rsp) < 2 or rsp[1] != counter:
+				if len(rsp) >= 2 and rsp[1] == (counter - 1) & 0xFF:
+					continue
+				raise UDSError("Unexpected block sequence {} != {}".format(rsp[1:2].hex(), counter))
+			data = rsp[2:]
+			if not data:
+				raise UDSError("Empty TransferData block {}".format(counter))
+
+			attempts = 0
+			if len(data) > size - received:
+				logging.debug("UDS: dropping {} bytes past the upload size".format(len(data) - (size - received)))
+				data = data[:size - received]
+			received += len(data)
+			if received < size:
+				counter = (counter + 1) & 0xFF
+				await self.protocol.send(bytes([service, counter]))
+			write_sink(sink, data)
+
+		await self.request_transfer_exit()
+		return received
@@ -1 +1,21 @@
-sudo ip link del vcan0
+#!/bin/bash
+#
+#  Remove a virtual CAN device, default 'vcan0':
+#    $> bringdown_vcan.sh -i vcan1
+#
+
+ifname="vcan0"
+PYTHON=${PYTHON:-python3}
+
+while getopts "i:" opt; do
+	case "$opt" in
+		i)
+			ifname=${OPTARG}
+			;;
+		*)
+			echo "usage: bringdown_vcan.sh [-i ifname]"
+			exit 1
+	esac
+done
+
+sudo ${PYTHON} -m carbus.utils.can_link delete -i ${ifname}
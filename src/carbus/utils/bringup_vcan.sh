@@ -1,2 +1,21 @@
-sudo ip link add type vcan
-sudo ip link add dev vcan0 type vcan
+#!/bin/bash
+#
+#  Create and bring up a virtual CAN device, default 'vcan0':
+#    $> bringup_vcan.sh -i vcan1
+#
+
+ifname="vcan0"
+PYTHON=${PYTHON:-python3}
+
+while getopts "i:" opt; do
+	case "$opt" in
+		i)
+			ifname=${OPTARG}
+			;;
+		*)
+			echo "usage: bringup_vcan.sh [-i ifname]"
+			exit 1
+	esac
+done
+
+sudo ${PYTHON} -m carbus.utils.can_link vcan -i ${ifname}
@@ -0,0 +1,65 @@
+"""Bring CAN interfaces up and down over rtnetlink
+
+File: can_link.py
+
+Description:
+	Replacement for `ip link` in the bring-up scripts.
+
+	$> python -m carbus.utils.can_link up -i can0 -b 500000 --restart-ms 100
+	$> python -m carbus.utils.can_link vcan -i vcan0
+	$> python -m carbus.utils.can_link show -i can0
+"""
+
+import argparse
+import sys
+
+from carbus.can.Netlink import RtNetlink
+from carbus.can.SocketCAN import CANInterfaceUtils
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="CAN interface setup")
+	parser.add_argument("command", choices=["up", "down", "show", "restart", "vcan", "delete"])
+	CANInterfaceUtils.add_interface_arg(parser)
+	parser.add_argument("-b", "--bitrate", type=int)
+	parser.add_argument("--sample-point", type=float)
+	parser.add_argument("--restart-ms", type=int)
+	parser.add_argument("--data-bitrate", type=int)
+	parser.add_argument("--data-sample-point", type=float)
+	parser.add_argument("--listen-only", choices=["on", "off"])
+	parser.add_argument("--fd", choices=["on", "off"])
+	parser.add_argument("--berr-reporting", choices=["on", "off"])
+	args = parser.parse_args(argv)
+
+	def mode(val):
+		return None if val is None else val == "on"
+
+	ifname = args.interface
+	with RtNetlink() as nl:
+		if args.command == "up":
+			nl.configure(
+				ifname,
+				bitrate=args.bitrate,
+				sample_point=args.sample_point,
+				restart_ms=args.restart_ms,
+				data_bitrate=args.data_bitrate,
+				data_sample_point=args.data_sample_point,
+				listen_only=mode(args.listen_only),
+				fd=mode(args.fd),
+				berr_reporting=mode(args.berr_reporting),
+			)
+		elif args.command == "down":
+			nl.set_down(ifname)
+		elif args.command == "restart":
+			nl.restart(ifname)
+		elif args.command == "vcan":
+			nl.add_vcan(ifname)
+		elif args.command == "delete":
+			nl.delete_link(ifname)
+
+		link = nl.get_link(ifname) if args.command != "delete" else None
+	if link is not None:
+		print(link)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
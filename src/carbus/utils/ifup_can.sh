@@ -20,7 +20,8 @@ show_help() {
 }
 
 ifname="can0"
-BITRATE=1000000
+BITRATE=500000
+PYTHON=${PYTHON:-python3}
 RESTARTMS=100
 
 while getopts "i:b:" opt; do
@@ -44,6 +45,8 @@ if [ -z "${ifname}" ]; then
 fi
 
 echo "CAN Interface: $ifname"
+echo "Bitrate: $BITRATE"
 
 
-sudo ip link set can0 up type can bitrate 500000 restart-ms 100 listen-only on
+#can_link takes the link down, applies the bit timing and brings it back up
+sudo ${PYTHON} -m carbus.utils.can_link up -i ${ifname} -b ${BITRATE} --restart-ms ${RESTARTMS} --listen-only on
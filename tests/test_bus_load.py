@@ -0,0 +1,62 @@
+import random
+
+from carbus.tools.BusLoad import (
+	FRAME_TAIL_BITS,
+	crc15,
+	frame_bit_length,
+	frame_bits,
+	stuff_bit_count,
+	worst_case_bit_length,
+)
+
+def bits_of(data):
+	return [(byte >> i) & 1 for byte in data for i in range(7, -1, -1)]
+
+def stuff(bits):
+	"""Reference stuffer building the transmitted sequence."""
+	out = []
+	run = 0
+	for bit in bits:
+		out.append(bit)
+		run = run + 1 if len(out) > 1 and out[-2] == bit else 1
+		if run == 5:
+			out.append(1 - bit)
+			run = 1
+	return out
+
+def test_crc15_check_value():
+	#CRC-15/CAN check value of "123456789"
+	assert crc15(bits_of(b"123456789")) == 0x059E
+
+def test_crc15_of_frame_leaves_zero_remainder():
+	bits = frame_bits(0x123, b"\x01\x02\x03")
+	assert crc15(bits) == 0
+
+def test_stuff_bit_takes_part_in_next_run():
+	assert stuff_bit_count([0] * 5) == 1
+	assert stuff_bit_count([0] * 4 + [1]) == 0
+	#the stuff bit after five zeros is a one and starts the run of ones
+	assert stuff_bit_count([0] * 5 + [1] * 4) == 2
+	assert stuff_bit_count([0] * 10) == 2
+
+def test_frame_length_matches_reference_stuffing():
+	rng = random.Random(31)
+	for _ in range(500):
+		ext = rng.random() < 0.5
+		addr = rng.getrandbits(29 if ext else 11)
+		data = bytes(rng.choice([0x00, 0xFF, rng.getrandbits(8)]) for _ in range(rng.randint(0, 8)))
+		rtr = rng.random() < 0.1
+		bits = frame_bits(addr, data, ext, rtr)
+		stuffed = stuff(bits)
+		#no six equal bits in a row on the wire
+		assert all(len(set(stuffed[i:i + 6])) == 2 for i in range(len(stuffed) - 5))
+		length = frame_bit_length(addr, data, ext, rtr)
+		assert length == len(stuffed) + FRAME_TAIL_BITS
+		assert length <= worst_case_bit_length(0 if rtr else len(data), ext)
+
+def test_known_lengths():
+	#SOF..CRC of a standard frame is 34 + 8 * dlc bits before stuffing
+	assert len(frame_bits(0x555, bytes(0))) == 34
+	assert len(frame_bits(0x555, bytes(8))) == 98
+	assert len(frame_bits(0x18DAF110, bytes(8), ext=True)) == 118
+	assert worst_case_bit_length(8) == 98 + 24 + FRAME_TAIL_BITS
@@ -0,0 +1,64 @@
+import select
+import socket
+
+import pytest
+
+from carbus.can.CanGateway import CanGateway, FrameMod, GatewayRule
+from carbus.can.SocketCAN import CANFilter, SocketCAN
+
+UID = 0x44
+
+def read_frame(sock, addr, timeout=1.0):
+	"""Next frame with this id, None if it does not arrive in time."""
+	while select.select([sock], [], [], timeout)[0]:
+		frame = sock.read()
+		if getattr(frame, "addr", None) == addr:
+			return frame
+	return None
+
+@pytest.fixture
+def gateway():
+	if not hasattr(socket, "AF_CAN"):
+		pytest.skip("no AF_CAN support")
+	if not (SocketCAN.is_up("vcan0") and SocketCAN.is_up("vcan1")):
+		pytest.skip("vcan0/vcan1 are not up")
+	try:
+		gw = CanGateway()
+		#a probe rule, fails without the can-gw module or CAP_NET_ADMIN
+		probe = GatewayRule("vcan0", "vcan1", CANFilter(0x7FF, 0x7FF), uid=UID + 1)
+		gw.add(probe)
+		gw.remove(probe)
+	except OSError as e:
+		pytest.skip("can-gw is not available: {}".format(e))
+	yield gw
+	gw.close()
+
+def test_add_forward_list_remove(gateway):
+	rule = GatewayRule("vcan0", "vcan1", CANFilter(0x123, 0x7FF), mods=[FrameMod("set", can_id=0x321)], uid=UID)
+	tx = SocketCAN()
+	rx = SocketCAN()
+	try:
+		tx.bind("vcan0")
+		rx.bind("vcan1")
+		gateway.add(rule)
+		try:
+			tx.write(b"\x11\x22", 0x123)
+			#not matched by the filter, stays on vcan0
+			tx.write(b"\x33", 0x124)
+			frame = read_frame(rx, 0x321)
+			assert frame is not None and frame.data == b"\x11\x22"
+			assert read_frame(rx, 0x124, timeout=0.1) is None
+
+			rules = [r for r in gateway.list() if r.uid == UID]
+			assert len(rules) == 1
+			listed = rules[0]
+			assert (listed.src, listed.dst) == ("vcan0", "vcan1")
+			assert listed.filter == rule.filter
+			assert [(m.op, m.can_id) for m in listed.mods] == [("set", 0x321)]
+			assert listed.handled == 1 and listed.dropped == 0
+		finally:
+			gateway.remove(rule)
+		assert not [r for r in gateway.list() if r.uid == UID]
+	finally:
+		tx.close()
+		rx.close()
@@ -0,0 +1,90 @@
+import asyncio
+
+from carbus.can.SocketCAN import CANFrame
+from carbus.sim.VirtualTimeLoop import run_simulation
+from carbus.tools.CycleWatchdog import CycleWatchdog
+
+def frame(addr):
+	return CANFrame(b"\x00", addr, False)
+
+async def feed(loop, watchdog, addr, period, until):
+	while loop.time() < until:
+		watchdog.process([frame(addr)])
+		await asyncio.sleep(period)
+
+def test_timeout_and_recovery():
+	events = []
+
+	async def main(loop):
+		watchdog = CycleWatchdog(
+			{0x100: 0.010}, tolerance=0.5, loop=loop,
+			onTimeout=lambda can_id, age: events.append(("timeout", can_id, round(age, 4), round(loop.time(), 4))),
+			onRecovered=lambda can_id, outage: events.append(("recovered", can_id, round(outage, 4))),
+		)
+		watchdog.start()
+		await feed(loop, watchdog, 0x100, 0.010, 0.1)
+		assert watchdog.missing == []
+		#last frame at 0.09, the id is missing 15 ms later
+		await asyncio.sleep(0.1)
+		assert watchdog.missing == [0x100]
+		watchdog.process([frame(0x100)])
+		watchdog.stop()
+		return watchdog
+
+	watchdog = run_simulation(main)
+	kind, can_id, age, at = events[0]
+	assert (kind, can_id) == ("timeout", 0x100)
+	#late by at most one 1 ms tick of the shared service
+	assert 0.015 <= age <= 0.0161
+	assert events[1] == ("recovered", 0x100, 0.11)
+	assert len(events) == 2
+	assert watchdog.timeouts == 1 and watchdog.recoveries == 1
+
+def test_no_timeout_within_tolerance():
+	events = []
+
+	async def main(loop):
+		watchdog = CycleWatchdog({0x100: 0.010, 0x200: 0.050}, tolerance=0.5, loop=loop, onTimeout=lambda *a: events.append(a))
+		watchdog.start()
+		#0x100 jitters up to 14 ms, below its 15 ms limit
+		periods = [0.006, 0.014, 0.010, 0.014, 0.008] * 20
+		for i, period in enumerate(periods):
+			watchdog.process([frame(0x100)] + ([frame(0x200)] if i % 5 == 0 else []))
+			await asyncio.sleep(period)
+		watchdog.stop()
+
+	run_simulation(main)
+	assert events == []
+
+def test_missing_from_start():
+	events = []
+
+	async def main(loop):
+		watchdog = CycleWatchdog({0x300: 0.020}, tolerance=1.0, loop=loop, onTimeout=lambda can_id, age: events.append(loop.time()))
+		watchdog.start()
+		await asyncio.sleep(0.1)
+		watchdog.stop()
+
+	run_simulation(main)
+	#expected within one limit of start, reported once
+	assert len(events) == 1
+	assert 0.040 <= events[0] <= 0.041
+
+def test_learned_period():
+	events = []
+
+	async def main(loop):
+		watchdog = CycleWatchdog(learn=True, learn_frames=5, tolerance=0.5, loop=loop, onTimeout=lambda can_id, age: events.append(can_id))
+		watchdog.start()
+		await feed(loop, watchdog, 0x18DAF110, 0.020, 0.2)
+		period = watchdog.period(0x18DAF110)
+		await asyncio.sleep(0.1)
+		watchdog.stop()
+		return period, watchdog
+
+	period, watchdog = run_simulation(main)
+	assert abs(period - 0.020) < 1e-9
+	assert events == [0x18DAF110]
+	metrics = {name: value for name, labels, value in watchdog.metrics() if not labels}
+	assert metrics["carbus_cycle_monitored_ids"] == 1
+	assert metrics["carbus_cycle_timeouts_total"] == 1
@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+from carbus.can.SocketCAN import CANFrame
+from carbus.tools.CaptureLog import parse_line
+from carbus.tools.FlightRecorder import FlightRecorder
+
+def read_dump(path):
+	with open(path) as f:
+		return [parse_line(line) for line in f]
+
+def run_dumps(recorder, scenario, count):
+	"""Run scenario(recorder) and wait for `count` dumps."""
+	dumps = []
+
+	async def main():
+		done = asyncio.Event()
+
+		def onDump(path, reason):
+			dumps.append((reason, read_dump(path)))
+			if len(dumps) == count:
+				done.set()
+
+		recorder.loop = asyncio.get_running_loop()
+		recorder.onDump = onDump
+		scenario(recorder)
+		await asyncio.wait_for(done.wait(), 2.0)
+		#give a stray dump timer the chance to fire
+		await asyncio.sleep(0.05)
+
+	asyncio.run(main())
+	return dumps
+
+def test_ring_wraps_oldest_first():
+	recorder = FlightRecorder(capacity=4)
+	recorder.process([CANFrame(bytes([i]), 0x100 + i, False, float(i), "can0") for i in range(5)])
+	recorder.record(CANFrame(b"\x01\x02", 0x18DAF110, False, 5.0, "can1"))
+	recorder.record(CANFrame(b"", 0x7DF, True, 6.0, "can0"))
+	frames = recorder.frames()
+	assert [frame.ts for frame in frames] == [3.0, 4.0, 5.0, 6.0]
+	assert [(frame.addr, frame.data, frame.ifname) for frame in frames[:3]] == [
+		(0x103, b"\x03", "can0"),
+		(0x104, b"\x04", "can0"),
+		(0x18DAF110, b"\x01\x02", "can1"),
+	]
+	assert frames[3].rtr and frames[3].addr == 0x7DF
+	assert [frame.ts for frame in recorder.frames(4.0, 5.0)] == [4.0, 5.0]
+	assert recorder.count == 7
+
+def test_trigger_inside_post_window_extends_dump(tmp_path):
+	now = time.time()
+	recorder = FlightRecorder(capacity=16, pre=0.1, post=0.05, directory=str(tmp_path))
+	recorder.process([CANFrame(b"\x00", 0x100, False, now + offset, "can0") for offset in (-0.2, -0.05, 0.03, 0.07, 0.2)])
+
+	def scenario(recorder):
+		assert recorder.trigger("first", now)
+		assert not recorder.trigger("second", now + 0.03)
+
+	dumps = run_dumps(recorder, scenario, 1)
+	assert len(dumps) == 1
+	reason, frames = dumps[0]
+	assert reason == "first+second"
+	#now - 0.1 up to the extended end, now + 0.08
+	assert [round(frame.ts - now, 2) for frame in frames] == [-0.05, 0.03, 0.07]
+
+def test_trigger_after_pending_window_flushes_it(tmp_path):
+	now = time.time()
+	recorder = FlightRecorder(capacity=16, pre=0.1, post=0.05, directory=str(tmp_path))
+	recorder.process([CANFrame(b"\x00", 0x100, False, now + offset, "can0") for offset in (-1.05, -0.95, -0.5, -0.05)])
+
+	def scenario(recorder):
+		#the first window ended before the second trigger, its timer has not run yet
+		assert recorder.trigger("first", now - 1.0)
+		assert recorder.trigger("second", now)
+
+	dumps = run_dumps(recorder, scenario, 2)
+	assert [reason for reason, _ in dumps] == ["first", "second"]
+	assert [round(frame.ts - now, 2) for frame in dumps[0][1]] == [-1.05, -0.95]
+	assert [round(frame.ts - now, 2) for frame in dumps[1][1]] == [-0.05]
+	assert recorder.dumps == 2
@@ -0,0 +1,75 @@
+import io
+
+from carbus.can.SocketCAN import CANFrame
+from carbus.tools.CaptureLog import CaptureReader, format_frame, parse_line
+from carbus.tools.FrameMerge import MergeStats, merge_streams
+
+CAPTURE_A = """\
+(1.000000) can0 100#01
+(1.200000) can0 100#02
+(1.400000) can0 100#03
+(1.600000) can0 100#04
+"""
+
+#1.15 is written after 1.3, later than the reorder window allows for
+CAPTURE_B = """\
+(1.100000) can0 200#11
+(1.300000) can0 200#12
+(1.150000) can0 200#13
+(1.500000) can0 200#14
+"""
+
+def merge(window, dropLate=False):
+	stats = MergeStats()
+	sources = [
+		CaptureReader(io.StringIO(CAPTURE_A), ifname="a"),
+		CaptureReader(io.StringIO(CAPTURE_B), ifname="b"),
+	]
+	frames = list(merge_streams(sources, window=window, dropLate=dropLate, stats=stats))
+	return [(frame.ts, frame.ifname, frame.data[0]) for frame in frames], stats
+
+def test_merge_two_captures():
+	frames, stats = merge(0.0)
+	assert frames == [
+		(1.0, "a", 0x01),
+		(1.1, "b", 0x11),
+		(1.2, "a", 0x02),
+		(1.3, "b", 0x12),
+		#late, passed on as soon as it is read
+		(1.15, "b", 0x13),
+		(1.4, "a", 0x03),
+		(1.5, "b", 0x14),
+		(1.6, "a", 0x04),
+	]
+	assert stats.frames == 8 and stats.late == 1 and stats.dropped == 0
+
+def test_merge_drops_late_frames():
+	frames, stats = merge(0.0, dropLate=True)
+	assert [ts for ts, _, _ in frames] == [1.0, 1.1, 1.2, 1.3, 1.4, 1.5, 1.6]
+	assert stats.frames == 7 and stats.late == 1 and stats.dropped == 1
+
+def test_window_reorders_late_frames():
+	frames, stats = merge(0.2)
+	assert [ts for ts, _, _ in frames] == [1.0, 1.1, 1.15, 1.2, 1.3, 1.4, 1.5, 1.6]
+	assert stats.frames == 8 and stats.late == 0
+
+def test_capture_line_round_trip():
+	frames = [
+		CANFrame(b"\xde\xad\xbe\xef", 0x123, False, 1436509052.249713, "can0"),
+		CANFrame(b"", 0x7DF, False, 1.5, "can1"),
+		CANFrame(b"\x01\x02", 0x18DAF110, False, 2.0, "vcan0"),
+		CANFrame(b"", 0x18FEF100, True, 3.25, "can0"),
+	]
+	for frame in frames:
+		line = format_frame(frame)
+		parsed = parse_line(line)
+		assert (parsed.addr, parsed.data, parsed.rtr, parsed.ifname) == (frame.addr, frame.data, frame.rtr, frame.ifname)
+		assert abs(parsed.ts - frame.ts) < 1e-6
+		assert format_frame(parsed) == line
+	assert format_frame(frames[0]) == "(1436509052.249713) can0 123#DEADBEEF\n"
+	assert format_frame(frames[3]) == "(3.250000) can0 18FEF100#R\n"
+
+def test_parse_line_skips_other_lines():
+	assert parse_line("") is None
+	assert parse_line("(1.0) can0 20000080#0000000000000000") is None
+	assert parse_line("(1.0) can0 12X#00") is None
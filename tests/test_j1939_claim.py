@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+from carbus.can.J1939Port import J1939ClaimError, J1939Port, J1939Protocol
+from carbus.can.J1939Socket import J1939_PGN_ADDRESS_CLAIMED, J1939_PGN_REQUEST, J1939Message
+from carbus.sim.VirtualTimeLoop import run_simulation
+
+NAME = 0x2000
+
+class RecordingSocket(object):
+	"""Stands in for the kernel socket, records what the port sends."""
+
+	def __init__(self):
+		self.sent = []
+		self.rx = []
+
+	def claim_address(self, addr=None):
+		self.sent.append(("claim", addr))
+
+	def cannot_claim(self):
+		self.sent.append(("cannot_claim",))
+
+	def recv(self):
+		return self.rx.pop(0)
+
+def claimed(addr, name):
+	return J1939Message(name.to_bytes(8, "little"), J1939_PGN_ADDRESS_CLAIMED, addr, name)
+
+def run(scenario, addr=0x80):
+	async def main(loop):
+		port = J1939Port("can0", J1939Protocol(), name=NAME, addr=addr, loop=loop)
+		port.socket = RecordingSocket()
+
+		def receive(msg):
+			port.socket.rx.append(msg)
+			port.doRead()
+
+		return await scenario(loop, port, receive)
+
+	return run_simulation(main)
+
+def test_claim_stands():
+	async def scenario(loop, port, receive):
+		await port.claimAddress()
+		return port
+
+	port = run(scenario)
+	assert port.claimed and not port.lost
+	assert port.socket.sent == [("claim", 0x80)]
+
+def test_lower_priority_claim_is_answered():
+	async def scenario(loop, port, receive):
+		loop.call_later(0.1, receive, claimed(0x80, NAME + 1))
+		loop.call_later(0.15, receive, claimed(0x81, NAME - 1))
+		await port.claimAddress()
+		return port
+
+	port = run(scenario)
+	assert port.claimed
+	assert port.socket.sent == [("claim", 0x80), ("claim", 0x80)]
+
+def test_claim_lost_to_higher_priority_name():
+	async def scenario(loop, port, receive):
+		loop.call_later(0.1, receive, claimed(0x80, NAME - 1))
+		with pytest.raises(J1939ClaimError):
+			await port.claimAddress()
+		assert loop.time() == pytest.approx(0.1)
+		#a request for Address Claimed gets Cannot Claim from now on
+		receive(J1939Message(J1939_PGN_ADDRESS_CLAIMED.to_bytes(3, "little"), J1939_PGN_REQUEST, 0x10, 0))
+		await asyncio.sleep(0)
+		return port
+
+	port = run(scenario)
+	assert not port.claimed and port.lost
+	assert port.socket.sent == [("claim", 0x80), ("cannot_claim",), ("cannot_claim",)]
+
+def test_claimed_address_lost_later():
+	async def scenario(loop, port, receive):
+		await port.claimAddress(0x90)
+		receive(claimed(0x90, NAME - 1))
+		await asyncio.sleep(0)
+		return port
+
+	port = run(scenario)
+	assert port.lost and port.addr == 0x90
+	assert port.socket.sent == [("claim", 0x90), ("cannot_claim",)]
+
+def test_claim_needs_a_source_address():
+	async def scenario(loop, port, receive):
+		with pytest.raises(ValueError):
+			await port.claimAddress()
+		return port
+
+	port = run(scenario, addr=0xFF)
+	assert port.socket.sent == []
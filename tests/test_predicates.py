@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+from carbus.can.SocketCAN import CANFrame
+from carbus.sim.VirtualTimeLoop import run_simulation
+from carbus.tools.Predicates import PredicateEngine, PredicateError, parse_duration
+from carbus.tools.Signals import Signal, SignalDecoder
+
+def make_decoder():
+	return SignalDecoder([
+		Signal("speed", 0x100, 0, 16, factor=0.01),
+		Signal("brake", 0x200, 0, 1),
+		Signal("gear", 0x300, 0, 4),
+	])
+
+def send(loop, decoder, can_id, data):
+	decoder.process([CANFrame(data, can_id, False, loop.clock())])
+
+def speed(kmh):
+	return int(kmh * 100).to_bytes(2, "little")
+
+def run(scenario):
+	"""Run scenario(loop, decoder, engine, events) on virtual time."""
+	events = []
+
+	async def main(loop):
+		decoder = make_decoder()
+		engine = PredicateEngine(decoder, clock=loop.clock, loop=loop)
+		await scenario(loop, decoder, engine, events)
+		engine.stop()
+		return engine
+
+	return run_simulation(main), events
+
+def record(events, loop, kind):
+	return lambda name, ts: events.append((kind, name, round(loop.time(), 3)))
+
+def test_parse_duration():
+	assert parse_duration("200ms") == pytest.approx(0.2)
+	assert parse_duration("1.5s") == pytest.approx(1.5)
+	assert parse_duration("500us") == pytest.approx(0.0005)
+	assert parse_duration(2) == 2.0
+
+@pytest.mark.parametrize("expr", ["speed +", "unknown > 1", "within(brake)", "open('x')", "speed.real"])
+def test_invalid_expressions(expr):
+	engine = PredicateEngine(make_decoder())
+	with pytest.raises(PredicateError):
+		engine.add("bad", expr)
+
+def test_only_dependent_predicates_are_evaluated():
+	async def scenario(loop, decoder, engine, events):
+		fast = engine.add("fast", "speed > 80", onTrue=record(events, loop, "T"), onFalse=record(events, loop, "F"))
+		braking = engine.add("braking", "brake")
+		send(loop, decoder, 0x100, speed(90))
+		send(loop, decoder, 0x100, speed(95))
+		send(loop, decoder, 0x100, speed(50))
+		#an unchanged value does not re-evaluate anything
+		send(loop, decoder, 0x100, speed(50))
+		assert fast.evaluations == 4
+		assert braking.evaluations == 1
+
+	engine, events = run(scenario)
+	assert events == [("T", "fast", 0.0), ("F", "fast", 0.0)]
+
+def test_unknown_values_make_comparisons_false():
+	async def scenario(loop, decoder, engine, events):
+		low = engine.add("low", "speed < 10")
+		high = engine.add("high", "speed >= 10")
+		assert not low.state and not high.state
+		send(loop, decoder, 0x100, speed(5))
+		assert low.state and not high.state
+
+	run(scenario)
+
+def test_within_expires_without_frames():
+	async def scenario(loop, decoder, engine, events):
+		send(loop, decoder, 0x300, b"\x03")
+		engine.add("shift", 'within(changed(gear), "200ms")', onTrue=record(events, loop, "T"), onFalse=record(events, loop, "F"))
+		await asyncio.sleep(0.1)
+		send(loop, decoder, 0x300, b"\x04")
+		await asyncio.sleep(0.5)
+
+	engine, events = run(scenario)
+	#true at the change, false 200 ms later plus at most one timer tick
+	assert events[0] == ("T", "shift", 0.1)
+	assert events[1][:2] == ("F", "shift")
+	assert 0.3 <= events[1][2] <= 0.302
+	assert len(events) == 2
+
+def test_held_and_edges():
+	async def scenario(loop, decoder, engine, events):
+		engine.add("held", "held(speed > 100, 0.1)", onTrue=record(events, loop, "held"))
+		engine.add("press", "rising(brake) and gear in (3, 4)", onTrue=record(events, loop, "press"))
+		send(loop, decoder, 0x300, b"\x03")
+		send(loop, decoder, 0x100, speed(120))
+		await asyncio.sleep(0.05)
+		#dropping below resets the hold
+		send(loop, decoder, 0x100, speed(90))
+		send(loop, decoder, 0x100, speed(120))
+		await asyncio.sleep(0.2)
+		#appearing from unknown is not an edge
+		send(loop, decoder, 0x200, b"\x01")
+		send(loop, decoder, 0x200, b"\x00")
+		await asyncio.sleep(0.01)
+		send(loop, decoder, 0x200, b"\x01")
+
+	engine, events = run(scenario)
+	held = [e for e in events if e[1] == "held"]
+	assert len(held) == 1 and 0.15 <= held[0][2] <= 0.152
+	assert [e for e in events if e[1] == "press"] == [("press", "press", 0.26)]
@@ -0,0 +1,91 @@
+import asyncio
+
+from carbus.can.CANProtocol import CANProtocol
+from carbus.can.RecoverySupervisor import RecoverySupervisor
+from carbus.can.SocketCAN import CANFilter, CANFrame
+from carbus.can.VirtualBus import VirtualBus, VirtualCANPort
+from carbus.sim.VirtualTimeLoop import run_simulation
+
+class Listener(CANProtocol):
+
+	def __init__(self):
+		super(Listener, self).__init__()
+		self.frames = []
+		self.events = []
+
+	def getFilters(self):
+		return [CANFilter(0x100, 0x7FF)]
+
+	async def frameReceived(self, frame):
+		self.frames.append(frame.addr)
+
+	def connectionLost(self, reason):
+		self.events.append("lost")
+
+	def connectionResumed(self):
+		self.events.append("resumed")
+
+def setup(loop, **kwargs):
+	bus = VirtualBus(loop=loop, clock=loop.clock)
+	proto = Listener()
+	port = VirtualCANPort(bus, proto, loop)
+	port.startListening()
+	supervisor = RecoverySupervisor(bus.name, loop=loop, **kwargs)
+	supervisor.attach(port)
+	supervisor.start()
+	return bus, proto, port, supervisor
+
+def test_bus_off_recovery_latency():
+	async def main(loop):
+		bus, proto, port, supervisor = setup(loop)
+		await asyncio.sleep(0.01)
+		bus.bus_off()
+		await asyncio.sleep(0.001)
+		assert proto.events == ["lost"]
+		assert port.socket is None
+		await asyncio.sleep(0.5)
+		supervisor.stop()
+		return bus, proto, port, supervisor
+
+	bus, proto, port, supervisor = run_simulation(main)
+	assert proto.events == ["lost", "resumed"]
+	assert bus.restarts == 1
+	assert len(supervisor.recoveries) == 1
+	#restart_delay 50 ms plus the controller restart of 10 ms
+	assert 0.06 <= supervisor.recoveries[0] <= 0.065
+	assert port.socket.get_can_filters() == [CANFilter(0x100, 0x7FF)]
+
+def test_link_down_recovery():
+	async def main(loop):
+		bus, proto, port, supervisor = setup(loop, restart_delay=0.0)
+		tx = VirtualCANPort(bus, CANProtocol(), loop)
+		tx.startListening()
+		bus.set_link(False)
+		await asyncio.sleep(0.001)
+		assert supervisor.lost
+		await asyncio.sleep(0.1)
+		tx.write(CANFrame(b"\x01", 0x100, False))
+		await asyncio.sleep(0.01)
+		supervisor.stop()
+		return bus, proto, supervisor
+
+	bus, proto, supervisor = run_simulation(main)
+	assert bus.up
+	assert proto.events == ["lost", "resumed"]
+	assert supervisor.recoveries[0] <= 0.03
+	assert proto.frames == [0x100]
+
+def test_no_restart_waits_for_link():
+	async def main(loop):
+		bus, proto, port, supervisor = setup(loop, restart=False)
+		bus.bus_off()
+		await asyncio.sleep(1.0)
+		assert supervisor.lost
+		bus.restartLink()
+		await asyncio.sleep(0.02)
+		supervisor.stop()
+		return supervisor
+
+	supervisor = run_simulation(main)
+	assert not supervisor.lost
+	assert 1.0 <= supervisor.recoveries[0] <= 1.05
@@ -0,0 +1,59 @@
+import asyncio
+
+from carbus.can.SocketCAN import CANFrame
+from carbus.sim.VirtualTimeLoop import run_simulation
+from carbus.tools.SignalBus import SignalBus
+from carbus.tools.Signals import Signal, SignalDecoder
+
+def close(got, expected):
+	return len(got) == len(expected) and all(
+		v == ev and abs(t - et) <= 0.0015 for (v, t), (ev, et) in zip(got, expected))
+
+def run(scenario, **subscription):
+	"""Feed scenario's (delay, raw value) steps of one signal through a subscription."""
+	got = []
+
+	async def main(loop):
+		decoder = SignalDecoder([Signal("temp", 0x100, 0, 16, signed=True)])
+		bus = SignalBus(decoder, clock=loop.clock, loop=loop)
+		sub = bus.subscribe("temp", lambda name, value, ts: got.append((value, round(loop.time(), 3))), **subscription)
+		for delay, value in scenario:
+			await asyncio.sleep(delay)
+			decoder.process([CANFrame(value.to_bytes(2, "little", signed=True), 0x100, False, loop.clock())])
+		await asyncio.sleep(0.5)
+		bus.stop()
+		return sub
+
+	sub = run_simulation(main)
+	return got, sub
+
+def test_on_change():
+	got, sub = run([(0, 1), (0.01, 1), (0.01, 2)])
+	assert [v for v, _ in got] == [1, 2]
+
+def test_absolute_deadband():
+	got, sub = run([(0, 100), (0.01, 103), (0.01, 104), (0.01, 105), (0.01, 109), (0.01, 110)], deadband=5)
+	#measured from the last delivered value, not the last decoded one
+	assert [v for v, _ in got] == [100, 105, 110]
+	assert sub.suppressed == 3
+
+def test_percent_deadband():
+	got, sub = run([(0, 200), (0.01, 205), (0.01, 210), (0.01, -10), (0.01, -10)], percent=5)
+	assert [v for v, _ in got] == [200, 210, -10]
+
+def test_max_rate_delivers_the_newest_value_late():
+	steps = [(0, 1)] + [(0.01, v) for v in range(2, 12)]
+	got, sub = run(steps, max_rate=10)
+	#100 ms after the previous delivery the newest suppressed value goes out
+	assert close(got, [(1, 0.0), (10, 0.1), (11, 0.2)])
+	assert all(b - a >= 0.1 for (_, a), (_, b) in zip(got, got[1:]))
+
+def test_deadband_drops_pending_rate_limited_value():
+	got, sub = run([(0, 100), (0.01, 110), (0.01, 101)], deadband=5, max_rate=10)
+	#110 waited for the period to end, 101 is back within the deadband of 100
+	assert [v for v, _ in got] == [100]
+
+def test_sample():
+	got, sub = run([(0, 5), (0.25, 6)], sample=0.1)
+	#the period does not drift by the tick the timer fires late
+	assert close(got, [(5, 0.1), (5, 0.2), (6, 0.3), (6, 0.4), (6, 0.5), (6, 0.6), (6, 0.7)])
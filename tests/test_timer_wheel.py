@@ -0,0 +1,155 @@
+import asyncio
+import math
+import random
+
+from carbus.sim.VirtualTimeLoop import run_simulation
+from carbus.tools.TimerService import TimerService
+from carbus.tools.TimerWheel import LEVEL_BITS, TimerWheel
+
+#whole second ticks keep the expected expiry free of float rounding
+def make_wheel(now=0.0):
+	return TimerWheel(resolution=1.0, now=now)
+
+def test_fires_at_first_tick_after_expiry():
+	wheel = make_wheel()
+	fired = []
+	wheel.schedule(10.5, fired.append, "a")
+	assert wheel.advance(10.0) == 0
+	assert wheel.advance(10.9) == 0
+	assert wheel.advance(11.0) == 1
+	assert fired == ["a"]
+	assert len(wheel) == 0
+	assert wheel.expired_until == 11.0
+
+def test_cancel_and_reschedule():
+	wheel = make_wheel()
+	fired = []
+	a = wheel.schedule(5, fired.append, "a")
+	b = wheel.schedule(5, fired.append, "b")
+	a.cancel()
+	b.reschedule(20)
+	assert len(wheel) == 1
+	wheel.advance(19)
+	assert fired == []
+	wheel.advance(20)
+	assert fired == ["b"]
+	assert not b.active
+	#a fired timer can be armed again
+	b.reschedule(25)
+	assert b.active and len(wheel) == 1
+	wheel.advance(30)
+	assert fired == ["b", "b"]
+
+def test_past_expiry_fires_on_next_tick():
+	wheel = make_wheel(now=100)
+	fired = []
+	wheel.schedule(50, fired.append, "late")
+	wheel.advance(100)
+	assert fired == []
+	wheel.advance(101)
+	assert fired == ["late"]
+
+def test_timer_scheduled_from_callback_waits_for_next_tick():
+	wheel = make_wheel()
+	fired = []
+
+	def first():
+		fired.append(("first", wheel.expired_until))
+		wheel.schedule(0, lambda: fired.append(("second", wheel.expired_until)))
+
+	wheel.schedule(3, first)
+	wheel.advance(3)
+	assert fired == [("first", 3.0)]
+	wheel.advance(4)
+	assert fired == [("first", 3.0), ("second", 4.0)]
+
+def test_cascading_matches_brute_force():
+	rng = random.Random(49)
+	wheel = make_wheel()
+	fired = {}
+	expected = {}
+	step = [0]
+	for i in range(2000):
+		#spread over every level of the wheel
+		when = rng.choice([rng.uniform(0, 300), rng.uniform(0, 20000), rng.uniform(0, 2000000)])
+		wheel.schedule(when, lambda i=i: fired.__setitem__(i, (wheel.expired_until, step[0])))
+		expected[i] = math.ceil(when)
+	steps = []
+	while len(wheel):
+		step[0] += rng.choice([1, 7, 64, 1000, 50000])
+		wheel.advance(step[0])
+		steps.append(step[0])
+	assert len(fired) == len(expected)
+	for i, tick in expected.items():
+		at, advancedTo = fired[i]
+		#fired on its own tick, by the first advance that reached it
+		assert at == tick
+		assert advancedTo == next(s for s in steps if s >= tick)
+
+def test_advance_skips_empty_ticks():
+	cascades = []
+
+	class CountingWheel(TimerWheel):
+		def _cascade(self, tick):
+			cascades.append(tick)
+			super(CountingWheel, self)._cascade(tick)
+
+	wheel = CountingWheel(resolution=1.0)
+	fired = []
+	wheel.schedule(1000000, lambda: fired.append(wheel.expired_until))
+	wheel.advance(999999)
+	assert fired == []
+	wheel.advance(1000000)
+	assert fired == [1000000.0]
+	#only the cascades that move the timer down, not one per level 0 wrap
+	assert len(cascades) <= len(LEVEL_BITS)
+
+def test_next_expiry():
+	wheel = make_wheel()
+	assert wheel.next_expiry() is None
+	wheel.schedule(42.2, lambda: None)
+	assert wheel.next_expiry() == 43.0
+	timer = wheel.schedule(10, lambda: None)
+	assert wheel.next_expiry() == 10.0
+	timer.cancel()
+	assert wheel.next_expiry() == 43.0
+
+def test_service_on_virtual_time():
+	async def main(loop):
+		service = TimerService(resolution=0.001, loop=loop)
+		fired = []
+		for delay in (0.005, 0.010, 0.010, 0.250):
+			service.call_later(delay, lambda d=delay: fired.append((d, loop.time())))
+		timer = service.call_later(0.1, fired.append, "cancelled")
+		timer.cancel()
+		await asyncio.sleep(0.3)
+		return service, fired
+
+	service, fired = run_simulation(main)
+	assert [d for d, _ in fired] == [0.005, 0.010, 0.010, 0.250]
+	for delay, at in fired:
+		assert delay <= at <= delay + 0.001 + 1e-9
+	#one wakeup per tick holding timers, none for the cancelled one
+	assert service.wakeups == 3
+	assert len(service) == 0
+
+def test_service_arm_after_idle():
+	async def main(loop):
+		service = TimerService(resolution=0.001, loop=loop)
+		fired = []
+		service.call_later(0.001, fired.append, "first")
+		await asyncio.sleep(0.01)
+		#an hour without timers, nothing advances the wheel meanwhile
+		await asyncio.sleep(3600)
+		idle = service.expired_until
+		timer = service.call_later(0.005, lambda: fired.append(loop.time()))
+		#armed on the current tick instead of walking 3.6 M empty ones on the next wakeup
+		caughtUp = service.expired_until
+		await asyncio.sleep(0.01)
+		return fired, idle, caughtUp, timer
+
+	fired, idle, caughtUp, timer = run_simulation(main)
+	assert idle < 1.0
+	assert 3600.0 <= caughtUp <= 3600.011
+	assert fired[0] == "first"
+	assert timer.when <= fired[1] <= timer.when + 0.001 + 1e-9
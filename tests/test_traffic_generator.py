@@ -0,0 +1,41 @@
+from carbus.sim.VirtualTimeLoop import run_simulation
+from carbus.tools.TrafficGenerator import IdProfile, TrafficGenerator, TrafficProfile
+
+class FullQueueSocket(object):
+	"""Accepts nothing while the TX queue is `full` (loop time ranges)."""
+
+	def __init__(self, loop, full):
+		self.loop = loop
+		self.full = full
+		self.written = []
+
+	def write_batch(self, frames, ext=False):
+		now = self.loop.time()
+		if any(start <= now < end for start, end in self.full):
+			return 0
+		self.written.extend((round(now, 4), frame.addr) for frame in frames)
+		return len(frames)
+
+def play(full, duration=0.1):
+	async def main(loop):
+		profile = TrafficProfile([IdProfile(0x100, 0.01), IdProfile(0x200, 0.02)])
+		socket = FullQueueSocket(loop, full)
+		gen = TrafficGenerator(socket, profile, seed=34)
+		await gen.run(duration)
+		return gen, socket
+
+	return run_simulation(main)
+
+def test_short_full_queue_is_retried():
+	gen, socket = play([(0.03, 0.033)])
+	assert gen.dropped == 0 and gen.retries > 0
+	assert gen.sent == len(socket.written) == 15
+	#the frames waited for the queue instead of being dropped
+	assert any(0.033 <= at < 0.034 for at, _ in socket.written)
+
+def test_frames_dropped_once_the_next_ones_are_due():
+	gen, socket = play([(0.03, 0.06)])
+	assert gen.dropped > 0
+	assert gen.dropped_ids[0x100] >= 2
+	assert gen.sent + gen.dropped == 15
+	assert all(not 0.03 <= at < 0.06 for at, _ in socket.written)
@@ -0,0 +1,46 @@
+import asyncio
+
+from carbus.can.SocketCAN import CANFrame
+from carbus.tools.TrafficStats import TrafficStats
+
+def frames(addr, start, count, period, data=b"\x00"):
+	return [CANFrame(data, addr, False, start + i * period) for i in range(count)]
+
+def test_offline_fold_and_window():
+	stats = TrafficStats(window=1.0, fold_frames=8)
+	stats.process(frames(0x100, 0.0, 10, 0.1))
+	stats.process(frames(0x100, 1.0, 11, 0.1))
+	st = stats.snapshot()[0x100]
+	assert st.count == 21
+	assert abs(st.period - 0.1) < 1e-9 and st.jitter < 1e-6
+	#the window opened with the first batch (0.9 s) and closed with the batch that crossed it (2 s)
+	assert abs(st.window_rate - 21 / 1.1) < 1e-9
+
+def test_fold_is_deferred_to_the_loop():
+	async def main():
+		stats = TrafficStats(window=1.0, fold_frames=4)
+		stats.process(frames(0x100, 0.0, 4, 0.01))
+		stats.process(frames(0x200, 1.5, 2, 0.01))
+		#arrives after the window closed but before the fold ran
+		stats.process(frames(0x300, 1.6, 1, 0.01))
+		#the read path only queued the frames
+		assert len(stats._pending) == 7 and stats._ids == []
+		await asyncio.sleep(0)
+		assert stats._pending == []
+		return stats
+
+	stats = asyncio.run(main())
+	st = stats.snapshot()
+	assert st[0x100].count == 4 and st[0x200].count == 2
+	#the window from 0.03 s to 1.51 s holds every frame that had arrived by then
+	assert abs(st[0x100].window_rate - 4 / 1.48) < 1e-9
+	assert abs(st[0x200].window_rate - 2 / 1.48) < 1e-9
+	assert st[0x300].count == 1 and st[0x300].window_rate == 0.0
+
+def test_payload_and_dlc_changes():
+	stats = TrafficStats()
+	data = [b"\x01", b"\x01", b"\x02", b"\x02\x00", b"\x02\x00", b"\x03\x00"]
+	stats.process([CANFrame(d, 0x300, False, i * 0.01) for i, d in enumerate(data)])
+	st = stats.snapshot()[0x300]
+	assert st.payload_changes == 3
+	assert st.dlc_changes == 1 and st.dlc == 2
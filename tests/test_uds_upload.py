@@ -0,0 +1,40 @@
+import pytest
+
+from carbus.can.VirtualBus import VirtualBus, VirtualCANPort
+from carbus.obd2.DoCANProtocol import DoCANProtocol, N_TAtype
+from carbus.sim.ECUSimulator import ECUModel, ECUSimulator, start_ecus
+from carbus.sim.VirtualTimeLoop import run_simulation
+from carbus.uds.UDSClient import UDSClient, UDSError
+
+MEMORY = bytes(range(256)) * 12
+
+class PaddedModel(ECUModel):
+	"""Rounds uploads up to 16 byte blocks like flash drivers often do."""
+
+	def read_memory(self, address, size):
+		return super(PaddedModel, self).read_memory(address, (size + 15) & ~15)
+
+def upload(size, model=None, max_rx_size=4095):
+	async def main(loop):
+		bus = VirtualBus(loop=loop, clock=loop.clock)
+		start_ecus(bus, [ECUSimulator(0, model or ECUModel(memory=MEMORY))], loop)
+		proto = DoCANProtocol(n_ai_type=N_TAtype.N_TAtypePhysicalCAN, tx_id=0x7E0, rx_id=0x7E8, max_rx_size=max_rx_size)
+		VirtualCANPort(bus, proto, loop).startListening()
+		client = UDSClient(proto)
+		sink = bytearray()
+		received = await client.upload(0, size, sink)
+		return received, bytes(sink)
+
+	return run_simulation(main)
+
+def test_upload():
+	received, data = upload(len(MEMORY))
+	assert received == len(MEMORY) and data == MEMORY
+
+def test_upload_stops_at_the_requested_size():
+	received, data = upload(1000, PaddedModel(memory=MEMORY))
+	assert received == 1000 and data == MEMORY[:1000]
+
+def test_upload_block_length_above_max_rx_size():
+	with pytest.raises(UDSError, match="exceeds max_rx_size 512"):
+		upload(len(MEMORY), max_rx_size=512)